@@ -1,36 +1,54 @@
 import os
+import sys
+import traceback
 import logging
 import re
 from typing import Dict, Optional, Set, Any, List, Tuple
 import asyncio
 import json
+import openai
 from openai import AsyncOpenAI
 import random
+import hashlib
+import bisect
+import calendar
+from functools import lru_cache, partial
+import itertools
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+import gzip
+import tempfile
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from telegram.constants import ParseMode, ChatAction
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
+    CallbackContext,
     filters,
     ConversationHandler,
+    TypeHandler,
+    BaseUpdateProcessor,
+    BaseRateLimiter,
+    BasePersistence,
+    PersistenceInput,
 )
-from telegram.error import TelegramError
-from datetime import datetime, timedelta
-from logging.handlers import RotatingFileHandler
-
-# --- Настройка логирования ---
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        RotatingFileHandler("bot.log", maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+from telegram.error import TelegramError, RetryAfter, NetworkError, BadRequest, Forbidden, TimedOut
+from datetime import date, datetime, timedelta
+from array import array
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import copy
+import atexit
 
 # --- Конфигурация ---
 CONFIG = {
@@ -38,50 +56,1126 @@ CONFIG = {
     "DELAY_SECONDS_MAIN_SERVICE": 9420,
     "DELAY_SECONDS_REVIEW_REQUEST": 43200,
     "MAX_MESSAGE_LENGTH": 3900,
+    "TELEGRAM_GLOBAL_RATE": 25,
+    "TELEGRAM_PER_CHAT_INTERVAL": 1.1,
+    "TELEGRAM_SEND_MAX_RETRIES": 5,
+    # Если доставка оборвалась после части сообщений, остаток дослается с сохраненной позиции.
+    "DELIVERY_RETRY_DELAY": 120,
+    "DELIVERY_MAX_ATTEMPTS": 5,
     "OPENAI_MAX_TOKENS_TAROT": 4000,
     "OPENAI_MAX_TOKENS_MATRIX": 6000,
+    "OPENAI_MODEL": "gpt-4o",
+    # Маршрутизация по типу услуги: цепочка моделей (первая - основная, остальные - запасные после исчерпания повторов)
+    # и порог в секундах, после которого отправляется дублирующий (hedged) запрос. None - без дублирования.
+    "OPENAI_MODEL_ROUTES": {
+        "tarot": {"models": ["gpt-4o", "gpt-4o-mini"], "hedge_after": 60},
+        "matrix": {"models": ["gpt-4o", "gpt-4o-mini"], "hedge_after": 90},
+    },
     "OPENAI_MAX_CONCURRENT": 3,
-    "RETRY_DELAY": 7,
-    "MAX_RETRIES": 2,
+    "OPENAI_RPM_LIMIT": 500,
+    "OPENAI_TPM_LIMIT": 30000,
+    "OPENAI_SERVICE_PRIORITY": {"tarot": 0, "matrix": 0},
+    "TOKEN_ESTIMATE_CHARS_PER_TOKEN": 2.5,
+    "OPENAI_STREAMING": True,
+    # Контроль длины потока: маркер последнего раздела, сколько знаков допускается после него и жесткий предел.
+    "STREAM_LENGTH_LIMITS": {
+        "tarot": {"final_section": "Итог расклада", "final_section_max_chars": 1800, "hard_cap_chars": 6000},
+        "matrix": {"final_section": "Заключение по периодам", "final_section_max_chars": 2000, "hard_cap_chars": 9000},
+    },
+    "MAX_INPUT_TOKENS_TAROT_BACKSTORY": 1600,
+    "MAX_INPUT_TOKENS_TAROT_OTHER_PEOPLE": 400,
+    "MAX_INPUT_TOKENS_TAROT_QUESTION": 800,
+    # Цены в долларах за 1M токенов (prompt, completion) - только для оценки расходов в /usage.
+    "OPENAI_PRICING_PER_1M_TOKENS": {"gpt-4o": (2.5, 10.0), "gpt-4o-mini": (0.15, 0.6)},
+    # Дневные бюджеты токенов (prompt + completion); при превышении новые заявки не принимаются до следующего дня. None - без ограничения.
+    "OPENAI_DAILY_TOKEN_BUDGET": {"tarot": 3_000_000, "matrix": 3_000_000, "total": None},
+    "USAGE_HISTOGRAM_BIN": 50,
+    "USAGE_RETENTION_DAYS": 90,
+    "OPENAI_RETRY_MAX_ATTEMPTS": 4,
+    "OPENAI_RETRY_BASE_DELAY": 2,
+    "OPENAI_RETRY_MAX_DELAY": 60,
+    "CIRCUIT_FAILURE_THRESHOLD": 5,
+    "CIRCUIT_OPEN_SECONDS": 120,
     "COMPLETED_USERS_FILE": "completed_users.json",
     "MIN_TEXT_LENGTH_TAROT_BACKSTORY": 100,
     "MIN_TEXT_LENGTH_TAROT_QUESTION": 100,
+    "MAX_CONCURRENT_UPDATES": 64,
+    "STATE_DB_FILE": "bot_state.db",
+    "COMPLETED_USERS_SNAPSHOT_INTERVAL": 600,
+    "PERSISTENCE_UPDATE_INTERVAL": 30,
+    "CONVERSATION_SWEEP_INTERVAL": 300,
+    "CONVERSATION_DEFAULT_TIMEOUT": 86400,
+    "CONVERSATION_STATE_TIMEOUTS": {
+        "CHOOSE_SERVICE": 3 * 3600,
+        "ASK_TAROT_BACKSTORY": 2 * 86400,
+        "ASK_TAROT_QUESTIONS": 2 * 86400,
+        "SHOW_TAROT_CONFIRM_OPTIONS": 2 * 86400,
+    },
+    "CONVERSATION_MAX_ACTIVE": 5000,
+    "CONVERSATION_EXPIRY_NUDGE": True,
+    "GENERATION_WORKERS": 3,
+    "GENERATION_MAX_ATTEMPTS": 3,
+    "GENERATION_RETRY_DELAY": 300,
+    "GENERATION_SAFETY_MARGIN": 1800,
+    "GENERATION_IDLE_UTILIZATION": 0.5,
+    "SPECULATIVE_GENERATION": False,
+    "SPECULATIVE_MAX_SPEND_RATIO": 1.5,
+    "SPECULATIVE_MIN_BUDGET": 5,
+    "SPECULATIVE_RESULT_TTL": 1800,  # Сколько секунд хранится готовая, но не востребованная заготовка
+    "RESULT_CACHE_ENABLED": True,
+    "RESULT_CACHE_MAX_BYTES": 50 * 1024 * 1024,
+    # Batch API гарантирует выполнение только в пределах 24 ч, а доставка идет через DELAY_SECONDS_MAIN_SERVICE (~2.6 ч):
+    # экономия есть лишь для пакетов, завершившихся раньше срока минус OPENAI_BATCH_SYNC_MARGIN, остальные заявки
+    # генерируются синхронно. Перед включением стоит проверить долю "из пакета" в /stats на реальном трафике.
+    "OPENAI_BATCH_MODE": False,
+    "OPENAI_BATCH_POLL_INTERVAL": 120,
+    "OPENAI_BATCH_SYNC_MARGIN": 1800,
+    "OPENAI_BATCH_MAX_REQUESTS": 1000,
+    "TRACE_FILE": "traces.jsonl",
+    "TRACE_FILE_MAX_BYTES": 10 * 1024 * 1024,
+    "TRACE_FILE_BACKUP_COUNT": 3,
+    "TRACE_FLUSH_INTERVAL": 5,
+    "TRACE_BUFFER_MAX_SPANS": 50000,  # Если запись отстает, старейшие спаны буфера отбрасываются
+    "LOG_FILE": "bot.log",
+    "LOG_FILE_BACKUP_COUNT": 3,
+    "LOG_INDEX_BLOCK_BYTES": 64 * 1024,
+    # Уровни и сэмплирование логов по имени логгера ({module} - имя этого модуля).
+    "LOG_LEVELS": {"{module}.prompts": "INFO", "httpx": "WARNING"},
+    "LOG_SAMPLING": {"{module}.prompts": 0.1},
+    "LOOP_LAG_INTERVAL": 0.25,
+    "LOOP_LAG_STALL_THRESHOLD": 0.5,
+    "PROFILE_SAMPLE_INTERVAL": 0.005,
+    "PROFILE_MAX_SECONDS": 120,
+    "METRICS_HOST": "127.0.0.1",
+    "METRICS_PORT": 9108,  # None - эндпоинт /metrics выключен
+    "JOB_CATCHUP_SPACING_SECONDS": 2,
+    "REVIEW_REQUEST_MAX_LATENESS": 86400,
 }
+# Переопределение параметров без правки кода: JSON-объект в BOT_CONFIG_OVERRIDES (так их задает нагрузочный стенд loadtest.py).
+# Неизвестный ключ верхнего уровня - ошибка запуска (опечатка иначе молча игнорируется); вложенные словари
+# сливаются с умолчаниями, а не заменяются целиком.
+def apply_config_overrides(config: Dict[str, Any], overrides: Dict[str, Any], strict: bool = True):
+    for key, value in overrides.items():
+        if strict and key not in config:
+            raise ValueError(f"BOT_CONFIG_OVERRIDES: неизвестный параметр {key!r}")
+        if isinstance(config.get(key), dict) and isinstance(value, dict):
+            apply_config_overrides(config[key], value, strict=False)
+        else:
+            config[key] = value
+
+apply_config_overrides(CONFIG, json.loads(os.getenv("BOT_CONFIG_OVERRIDES") or "{}"))
+
+# --- SQLite ---
+def open_sqlite(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# --- Настройка логирования ---
+# Обработчики (JSON в bot.log и текст в консоль) работают в фоновом потоке QueueListener; в потоке event loop
+# остается только подготовка записи и put в очередь. К каждой записи добавляются user_id, state, service и trace_id
+# из контекста (contextvars) обрабатываемого обновления или задачи.
+log_context: ContextVar[Dict[str, Any]] = ContextVar("log_context", default={})
+current_span: ContextVar[Optional[Tuple[str, str, Optional[int]]]] = ContextVar("current_span", default=None)
+
+@contextmanager
+def log_fields(**fields: Any):
+    token = log_context.set({**log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+class ContextQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение собирается здесь (нужны args до их изменения), трассировка исключения - пока оно живо;
+        # форматирование в JSON/текст и запись в файл остаются фоновому потоку.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = JSON_LOG_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        fields = dict(log_context.get())
+        span = current_span.get()
+        if span:
+            fields.setdefault("trace_id", span[0])
+            if span[2] is not None:
+                fields.setdefault("user_id", span[2])
+        record.context_fields = fields
+        return record
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "context_fields", {}),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    # Пропускает долю rate записей уровня ниже WARNING; предупреждения и ошибки проходят всегда.
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+LOG_LEVEL_BITS = {"DEBUG": 1, "INFO": 2, "WARNING": 4, "ERROR": 8, "CRITICAL": 16}
+
+class LogIndex:
+    # Разреженный индекс bot.log: файл делится на блоки ~LOG_INDEX_BLOCK_BYTES, для каждого блока хранятся смещения,
+    # диапазон времени, маска уровней, типы услуг и user_id. Запрос читает только подходящие блоки.
+    # Сегмент - номер файла с начала ведения индекса: текущий bot.log имеет номер self.segment, bot.log.N - segment - N.
+    # Номер хранится отдельной строкой log_index_meta: ротация без единого закрытого блока тоже должна пережить перезапуск.
+    def __init__(self, path: str, block_bytes: int):
+        self.block_bytes = block_bytes
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS log_blocks (block_id INTEGER PRIMARY KEY, segment INTEGER NOT NULL, start_offset INTEGER NOT NULL, "
+            "end_offset INTEGER NOT NULL, ts_min REAL NOT NULL, ts_max REAL NOT NULL, levels INTEGER NOT NULL, services TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS log_block_users (user_id INTEGER NOT NULL, block_id INTEGER NOT NULL, PRIMARY KEY (user_id, block_id))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS log_index_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        row = self._conn.execute("SELECT value FROM log_index_meta WHERE key = 'segment'").fetchone()
+        self.segment = row[0] if row else self._conn.execute("SELECT COALESCE(MAX(segment), 0) FROM log_blocks").fetchone()[0]
+        self._open_block: Optional[Dict[str, Any]] = None
+
+    def add(self, offset: int, end_offset: int, record: logging.LogRecord):
+        fields = getattr(record, "context_fields", {})
+        with self._lock:
+            block = self._open_block
+            if block is None:
+                block = self._open_block = {"segment": self.segment, "start_offset": offset, "end_offset": end_offset, "ts_min": record.created,
+                                            "ts_max": record.created, "levels": 0, "services": set(), "users": set()}
+            block["end_offset"] = end_offset
+            block["ts_min"] = min(block["ts_min"], record.created)
+            block["ts_max"] = max(block["ts_max"], record.created)
+            block["levels"] |= LOG_LEVEL_BITS.get(record.levelname, 0)
+            if fields.get("service"):
+                block["services"].add(str(fields["service"]))
+            if isinstance(fields.get("user_id"), int):
+                block["users"].add(fields["user_id"])
+            if end_offset - block["start_offset"] >= self.block_bytes:
+                self._close_block_locked()
+
+    def _close_block_locked(self):
+        block, self._open_block = self._open_block, None
+        if block is None:
+            return
+        block_id = self._conn.execute(
+            "INSERT INTO log_blocks (segment, start_offset, end_offset, ts_min, ts_max, levels, services) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (block["segment"], block["start_offset"], block["end_offset"], block["ts_min"], block["ts_max"], block["levels"],
+             ",".join(sorted(block["services"]))),
+        ).lastrowid
+        self._conn.executemany("INSERT OR IGNORE INTO log_block_users (user_id, block_id) VALUES (?, ?)", [(u, block_id) for u in block["users"]])
+
+    def close_open_block(self):
+        with self._lock:
+            self._close_block_locked()
+
+    def rotate(self, backup_count: int):
+        with self._lock:
+            self._close_block_locked()
+            self.segment += 1
+            self._conn.execute("INSERT OR REPLACE INTO log_index_meta (key, value) VALUES ('segment', ?)", (self.segment,))
+            stale = [row[0] for row in self._conn.execute("SELECT block_id FROM log_blocks WHERE segment < ?", (self.segment - backup_count,))]
+            self._conn.executemany("DELETE FROM log_block_users WHERE block_id = ?", [(b,) for b in stale])
+            self._conn.execute("DELETE FROM log_blocks WHERE segment < ?", (self.segment - backup_count,))
+
+    def candidate_blocks(self, user_id: Optional[int], since: Optional[float], until: Optional[float], min_level: int,
+                         service: Optional[str]) -> List[Tuple[int, int, int]]:
+        # Возвращает (сегмент, начало, конец) подходящих блоков, включая еще не закрытый текущий.
+        level_mask = sum(bit for bit in LOG_LEVEL_BITS.values() if bit >= min_level)
+        query = "SELECT segment, start_offset, end_offset, ts_min, ts_max, levels, services FROM log_blocks"
+        params: List[Any] = []
+        if user_id is not None:
+            query += " WHERE block_id IN (SELECT block_id FROM log_block_users WHERE user_id = ?)"
+            params.append(user_id)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY segment, start_offset", params).fetchall()
+            block = self._open_block
+            if block and (user_id is None or user_id in block["users"]):
+                rows.append((block["segment"], block["start_offset"], block["end_offset"], block["ts_min"], block["ts_max"],
+                             block["levels"], ",".join(block["services"])))
+        return [(segment, start, end) for segment, start, end, ts_min, ts_max, levels, services in rows
+                if (since is None or ts_max >= since) and (until is None or ts_min <= until) and levels & level_mask
+                and (service is None or service in services.split(","))]
+
+class IndexedRotatingFileHandler(RotatingFileHandler):
+    # Пишет как RotatingFileHandler и после каждой записи обновляет LogIndex (в потоке QueueListener).
+    def __init__(self, filename: str, log_index: LogIndex, **kwargs: Any):
+        super().__init__(filename, **kwargs)
+        self.log_index = log_index
+
+    def doRollover(self):
+        super().doRollover()
+        self.log_index.rotate(self.backupCount)
+
+    def close(self):
+        # Незакрытый блок живет только в памяти: без этого записи с последнего блока до остановки не попадут в индекс.
+        self.log_index.close_open_block()
+        super().close()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            offset = self.stream.tell()
+            logging.FileHandler.emit(self, record)
+            self.log_index.add(offset, self.stream.tell(), record)
+        except Exception:
+            self.handleError(record)
+
+JSON_LOG_FORMATTER = JsonLogFormatter()
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_index = LogIndex(CONFIG["STATE_DB_FILE"], CONFIG["LOG_INDEX_BLOCK_BYTES"])
+_log_file_handler = IndexedRotatingFileHandler(CONFIG["LOG_FILE"], log_index, maxBytes=5 * 1024 * 1024,
+                                               backupCount=CONFIG["LOG_FILE_BACKUP_COUNT"], encoding='utf-8')
+_log_file_handler.setFormatter(JSON_LOG_FORMATTER)
+_log_console_handler = logging.StreamHandler()
+_log_console_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+log_listener = QueueListener(log_queue, _log_file_handler, _log_console_handler, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[ContextQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
+for _logger_name, _level in CONFIG["LOG_LEVELS"].items():
+    logging.getLogger(_logger_name.replace("{module}", __name__)).setLevel(_level)
+for _logger_name, _rate in CONFIG["LOG_SAMPLING"].items():
+    logging.getLogger(_logger_name.replace("{module}", __name__)).addFilter(SamplingFilter(_rate))
+
+logger = logging.getLogger(__name__)
+# Отрывки промптов - самый объемный поток логов; уровень и доля сэмплирования задаются в LOG_LEVELS / LOG_SAMPLING.
+prompt_logger = logging.getLogger(f"{__name__}.prompts")
 
 # --- Настройка API ---
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Другой адрес Bot API (локальный telegram-bot-api или заглушка loadtest.py). Адрес OpenAI клиент сам берет из OPENAI_BASE_URL.
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
 
 if not BOT_TOKEN or not OPENAI_API_KEY:
     logger.critical("Отсутствуют переменные окружения: TELEGRAM_TOKEN или OPENAI_API_KEY")
     raise ValueError("Установите TELEGRAM_TOKEN и OPENAI_API_KEY в настройках окружения")
 
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Встроенные повторы клиента отключены: ими управляет RetryPolicy (классификация ошибок, джиттер, предохранитель).
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 logger.info("Переменные окружения успешно загружены")
 
+# --- Метрики (формат Prometheus) ---
+# Запись метрик идет только из потока event loop и не содержит await, поэтому обходится без блокировок:
+# счетчик - одно обращение к dict, гистограмма - bisect по фиксированным границам и два инкремента в списке.
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_metric_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # Для каждого набора меток: счетчики по корзинам (последняя - +Inf), затем сумма значений.
+        self.series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{format_metric_labels(self.label_names + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_metric_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_metric_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+def format_metric_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+LATENCY_BUCKETS_FAST = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENCY_BUCKETS_GPT = (1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0, 180.0, 300.0)
+
+METRIC_ASK_GPT_SECONDS = Histogram("zamira_ask_gpt_seconds", "ask_gpt latency including retries", ("service", "attempt", "outcome"), LATENCY_BUCKETS_GPT)
+METRIC_OPENAI_REQUEST_SECONDS = Histogram("zamira_openai_request_seconds", "Single OpenAI request latency", ("service", "model", "purpose"), LATENCY_BUCKETS_GPT)
+METRIC_SEND_CHUNK_SECONDS = Histogram("zamira_send_chunk_seconds", "send_long_message chunk send latency", (), LATENCY_BUCKETS_FAST)
+METRIC_HANDLER_SECONDS = Histogram("zamira_handler_seconds", "Update handling time by conversation state", ("state",), LATENCY_BUCKETS_FAST)
+METRIC_JOB_LAG_SECONDS = Histogram("zamira_job_lag_seconds", "JobQueue lag between due time and actual start", ("job",), LATENCY_BUCKETS_FAST)
+METRIC_FUNNEL_TOTAL = Counter("zamira_funnel_total", "Conversion funnel: start -> confirm -> delivered", ("stage", "service"))
+METRIC_QUEUE_DEPTH = Gauge("zamira_queue_depth", "Queue depths sampled at scrape time", ("queue",))
+METRIC_LOOP_LAG_SECONDS = Histogram("zamira_event_loop_lag_seconds", "Event loop scheduling delay", (), LATENCY_BUCKETS_FAST)
+METRICS = [METRIC_LOOP_LAG_SECONDS, METRIC_ASK_GPT_SECONDS, METRIC_OPENAI_REQUEST_SECONDS, METRIC_SEND_CHUNK_SECONDS, METRIC_HANDLER_SECONDS,
+           METRIC_JOB_LAG_SECONDS, METRIC_FUNNEL_TOTAL, METRIC_QUEUE_DEPTH]
+
+def observe_job_lag(context: ContextTypes.DEFAULT_TYPE, job_kind: str):
+    due_at = (context.job.data or {}).get("due_at") if context.job else None
+    if due_at is not None:
+        METRIC_JOB_LAG_SECONDS.observe(max(time.time() - due_at, 0.0), job_kind)
+
+# --- Трассировка заявок ---
+# Каждая заявка получает trace_id при /start; спаны (этапы диалога, генерация, каждая попытка запроса к OpenAI,
+# доставка и каждая часть сообщения) пишутся в TRACE_FILE строками OTLP/JSON (resourceSpans) с ротацией.
+# Родительский спан передается через contextvar current_span и наследуется задачами asyncio.
+# Буфер между сбросами ограничен TRACE_BUFFER_MAX_SPANS: при отставании записи теряются самые старые спаны (dropped_spans).
+
+class Tracer:
+    def __init__(self, path: str, max_bytes: int, backup_count: int, max_buffered_spans: int):
+        self.path = path
+        self.backup_count = backup_count
+        self._buffer: deque = deque(maxlen=max_buffered_spans)
+        self.dropped_spans = 0
+        self._dropped_since_take = 0
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+
+    @staticmethod
+    def new_trace_id() -> str:
+        return uuid.uuid4().hex
+
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str] = None, user_id: Optional[int] = None, start_ns: Optional[int] = None, **attributes: Any):
+        parent = current_span.get()
+        if trace_id is None:
+            trace_id = parent[0] if parent else self.new_trace_id()
+        if user_id is None and parent:
+            user_id = parent[2]
+        span_id = os.urandom(8).hex()
+        if user_id is not None:
+            attributes["user.id"] = user_id
+        record = {"name": name, "traceId": trace_id, "spanId": span_id,
+                  "parentSpanId": parent[1] if parent and parent[0] == trace_id else "",
+                  "startTimeUnixNano": start_ns or time.time_ns(), "attributes": attributes, "status": {"code": 1}}
+        token = current_span.set((trace_id, span_id, user_id))
+        try:
+            yield attributes
+        except BaseException as e:
+            record["status"] = {"code": 2, "message": f"{type(e).__name__}: {e}"}
+            raise
+        finally:
+            current_span.reset(token)
+            record["endTimeUnixNano"] = time.time_ns()
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped_spans += 1
+                self._dropped_since_take += 1
+            self._buffer.append(record)
+
+    @staticmethod
+    def _otlp_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def take_buffer(self) -> List[Dict[str, Any]]:
+        spans = list(self._buffer)
+        self._buffer.clear()
+        if self._dropped_since_take:
+            logger.warning(f"Буфер трассировки переполнен: отброшено {self._dropped_since_take} старейших спанов")
+            self._dropped_since_take = 0
+        return spans
+
+    def write(self, spans: List[Dict[str, Any]]):
+        if not spans:
+            return
+        otlp_spans = [{**span, "kind": 1, "startTimeUnixNano": str(span["startTimeUnixNano"]), "endTimeUnixNano": str(span["endTimeUnixNano"]),
+                       "attributes": [{"key": k, "value": self._otlp_value(v)} for k, v in span["attributes"].items()]} for span in spans]
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "zamira-bot"}}]},
+            "scopeSpans": [{"scope": {"name": "zamira"}, "spans": otlp_spans}],
+        }]}, ensure_ascii=False)
+        self._handler.emit(logging.makeLogRecord({"msg": line, "levelno": logging.INFO, "levelname": "INFO"}))
+
+    def _spans_newest_first(self):
+        # Файлы от текущего к самому старому, строки (пачки спанов в порядке записи) - с конца файла.
+        for path in [self.path] + [f"{self.path}.{i}" for i in range(1, self.backup_count + 1)]:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            for line in reversed(lines):
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    continue
+                for resource_spans in batch.get("resourceSpans", []):
+                    for scope_spans in resource_spans.get("scopeSpans", []):
+                        yield from reversed(scope_spans.get("spans", []))
+
+    def find_latest_trace(self, user_id: int) -> List[Dict[str, Any]]:
+        # Последний trace пользователя: первый найденный с конца спан с его user.id задает trace_id, затем собираются
+        # спаны этого trace. Поиск останавливается на более раннем trace того же пользователя, а не читает все файлы.
+        trace_id = None
+        spans = []
+        for span in self._spans_newest_first():
+            attributes = {a["key"]: a["value"] for a in span.get("attributes", [])}
+            is_user_span = attributes.get("user.id", {}).get("intValue") == str(user_id)
+            if trace_id is None:
+                if not is_user_span:
+                    continue
+                trace_id = span["traceId"]
+            if span["traceId"] == trace_id:
+                spans.append(span)
+            elif is_user_span:
+                break
+        return sorted(spans, key=lambda span: int(span["startTimeUnixNano"]))
+
+tracer = Tracer(CONFIG["TRACE_FILE"], CONFIG["TRACE_FILE_MAX_BYTES"], CONFIG["TRACE_FILE_BACKUP_COUNT"], CONFIG["TRACE_BUFFER_MAX_SPANS"])
+
+async def flush_traces():
+    await asyncio.to_thread(tracer.write, tracer.take_buffer())
+
+async def trace_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await flush_traces()
+    except Exception as e:
+        logger.error(f"Не удалось записать спаны трассировки: {e}")
+
+def format_trace(spans: List[Dict[str, Any]]) -> str:
+    depth: Dict[str, int] = {}
+    trace_start = int(spans[0]["startTimeUnixNano"])
+    lines = [f"Trace {spans[0]['traceId']}"]
+    for span in spans:
+        depth[span["spanId"]] = depth.get(span.get("parentSpanId") or "", -1) + 1
+        offset = (int(span["startTimeUnixNano"]) - trace_start) / 1e9
+        duration = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+        attributes = ", ".join(f"{a['key']}={next(iter(a['value'].values()))}" for a in span.get("attributes", []) if a["key"] != "user.id")
+        status = " ❌" if span.get("status", {}).get("code") == 2 else ""
+        lines.append(f"{'  ' * depth[span['spanId']]}+{offset:.1f}s {span['name']} ({duration:.2f}s){status}" + (f" [{attributes}]" if attributes else ""))
+    return "\n".join(lines)
+
 # --- Хранилище данных (completed_users) ---
-completed_users: Set[int] = set()
+class CompletedUsersStore:
+    # Каждое добавление/удаление - одна строка в SQLite вместо перезаписи всего JSON-файла.
+    # JSON-файл COMPLETED_USERS_FILE остается как периодический атомарный снимок (для /get_completed_list).
+    def __init__(self, path: str, legacy_json_path: str):
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS completed_users (user_id INTEGER PRIMARY KEY, added_at REAL NOT NULL)")
+        self.dirty = False
+        self._import_legacy_json(legacy_json_path)
+
+    def _import_legacy_json(self, legacy_json_path: str):
+        if not os.path.exists(legacy_json_path):
+            return
+        if self._conn.execute("SELECT 1 FROM completed_users LIMIT 1").fetchone():
+            return
+        try:
+            with open(legacy_json_path, 'r', encoding='utf-8') as f:
+                user_ids = json.load(f)
+            now = time.time()
+            with self._lock:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT OR IGNORE INTO completed_users (user_id, added_at) VALUES (?, ?)", ((int(uid), now) for uid in user_ids))
+                self._conn.execute("COMMIT")
+            logger.info(f"Импортировано {len(user_ids)} пользователей из {legacy_json_path} в SQLite")
+        except Exception as e:
+            logger.error(f"Ошибка импорта {legacy_json_path}: {e}")
+
+    def iter_user_ids(self):
+        with self._lock:
+            cursor = self._conn.execute("SELECT user_id FROM completed_users")
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for (user_id,) in rows:
+                    yield user_id
+
+    def add(self, user_id: int):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO completed_users (user_id, added_at) VALUES (?, ?)", (user_id, time.time()))
+            self.dirty = True
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM completed_users WHERE user_id = ?", (user_id,))
+            self.dirty = True
+
+    def write_snapshot(self, snapshot_path: str) -> int:
+        tmp_path = f"{snapshot_path}.tmp"
+        user_ids = list(self.iter_user_ids())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(user_ids, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snapshot_path)
+        self.dirty = False
+        return len(user_ids)
+
+    def compact(self):
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+completed_users_store = CompletedUsersStore(CONFIG["STATE_DB_FILE"], CONFIG["COMPLETED_USERS_FILE"])
 
 def load_completed_users() -> Set[int]:
     try:
-        if os.path.exists(CONFIG["COMPLETED_USERS_FILE"]):
-            with open(CONFIG["COMPLETED_USERS_FILE"], 'r', encoding='utf-8') as f:
-                user_ids = json.load(f)
-                logger.info(f"Загружено {len(user_ids)} пользователей из {CONFIG['COMPLETED_USERS_FILE']}")
-                return set(user_ids)
+        users = set(completed_users_store.iter_user_ids())
+        logger.info(f"Загружено {len(users)} пользователей из {CONFIG['STATE_DB_FILE']}")
+        return users
     except Exception as e:
-        logger.error(f"Ошибка загрузки {CONFIG['COMPLETED_USERS_FILE']}: {e}")
+        logger.error(f"Ошибка загрузки completed_users из {CONFIG['STATE_DB_FILE']}: {e}")
     return set()
 
-def save_completed_users(users_set: Set[int]):
+def snapshot_completed_users():
     try:
-        with open(CONFIG["COMPLETED_USERS_FILE"], 'w', encoding='utf-8') as f:
-            json.dump(list(users_set), f, indent=4)
-            logger.info(f"Сохранено {len(users_set)} пользователей в {CONFIG['COMPLETED_USERS_FILE']}")
+        if completed_users_store.dirty or not os.path.exists(CONFIG["COMPLETED_USERS_FILE"]):
+            count = completed_users_store.write_snapshot(CONFIG["COMPLETED_USERS_FILE"])
+            logger.info(f"Снимок: сохранено {count} пользователей в {CONFIG['COMPLETED_USERS_FILE']}")
+        completed_users_store.compact()
     except Exception as e:
-        logger.error(f"Ошибка сохранения {CONFIG['COMPLETED_USERS_FILE']}: {e}")
+        logger.error(f"Ошибка сохранения снимка {CONFIG['COMPLETED_USERS_FILE']}: {e}")
+
+async def completed_users_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(snapshot_completed_users)
+
+completed_users: Set[int] = load_completed_users()
+
+# --- Хранилище отложенных задач (SQLite, WAL) ---
+class JobStore:
+    # Хранит запланированные main_service_job / review_request_job, чтобы они переживали перезапуск.
+    # Payload (в т.ч. сгенерированный результат) хранится сжатым и в память не загружается до момента отправки.
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scheduled_jobs ("
+            "job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id INTEGER NOT NULL, "
+            "run_at REAL NOT NULL, payload BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_run_at ON scheduled_jobs (run_at)")
+
+    def add(self, kind: str, user_id: int, run_at: float, payload: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), 6)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO scheduled_jobs (job_id, kind, user_id, run_at, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, user_id, run_at, blob, time.time()),
+            )
+        return job_id
 
-completed_users = load_completed_users()
+    def get_payload(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM scheduled_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def reschedule(self, job_id: str, run_at: float, payload: Dict[str, Any]):
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), 6)
+        with self._lock:
+            self._conn.execute("UPDATE scheduled_jobs SET run_at = ?, payload = ? WHERE job_id = ?", (run_at, blob, job_id))
+
+    def remove(self, job_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM scheduled_jobs WHERE job_id = ?", (job_id,))
+
+    def pending(self) -> List[Tuple[str, str, int, float]]:
+        with self._lock:
+            return self._conn.execute("SELECT job_id, kind, user_id, run_at FROM scheduled_jobs ORDER BY run_at").fetchall()
+
+job_store = JobStore(CONFIG["STATE_DB_FILE"])
+
+# --- Очередь генерации (SQLite) ---
+class GenerationQueue:
+    # Подтвержденные заявки ждут генерации здесь; после перезапуска незавершенные заявки возвращаются в очередь.
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_queue ("
+            "request_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, service_type TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, not_before REAL NOT NULL, "
+            "deliver_at REAL NOT NULL, payload BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_queue_status ON generation_queue (status, not_before)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS generation_batches (batch_id TEXT PRIMARY KEY, submitted_at REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS generation_batch_items (request_id TEXT PRIMARY KEY, batch_id TEXT NOT NULL)")
+
+    @staticmethod
+    def _row_to_item(row) -> Dict[str, Any]:
+        request_id, user_id, service_type, attempts, deliver_at, blob = row
+        item = json.loads(zlib.decompress(blob).decode("utf-8"))
+        item.update(request_id=request_id, user_id=user_id, service_type=service_type, attempts=attempts, deliver_at=deliver_at)
+        return item
+
+    def enqueue(self, user_id: int, service_type: str, user_prompt: str, max_tokens: int, user_name_for_log: str, deliver_at: float,
+                status: str = "pending", extra: Optional[Dict[str, Any]] = None, request_id: Optional[str] = None) -> str:
+        request_id = request_id or uuid.uuid4().hex
+        payload = {"user_prompt": user_prompt, "max_tokens": max_tokens, "user_name_for_log": user_name_for_log, **(extra or {})}
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO generation_queue (request_id, user_id, service_type, status, attempts, not_before, deliver_at, payload, created_at) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)",
+                (request_id, user_id, service_type, status, now, deliver_at, blob, now),
+            )
+        return request_id
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT request_id, user_id, service_type, attempts, deliver_at, payload FROM generation_queue "
+                "WHERE status = 'pending' AND not_before <= ? ORDER BY deliver_at LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if not row:
+                return None
+            self._conn.execute("UPDATE generation_queue SET status = 'running', attempts = attempts + 1 WHERE request_id = ?", (row[0],))
+        item = self._row_to_item(row)
+        item["attempts"] += 1
+        return item
+
+    def ready_deliver_times(self) -> List[float]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT deliver_at FROM generation_queue WHERE status = 'pending' AND not_before <= ? ORDER BY deliver_at",
+                (time.time(),),
+            )]
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT request_id, user_id, service_type, attempts, deliver_at, payload FROM generation_queue WHERE request_id = ?",
+                (request_id,),
+            ).fetchone()
+        return self._row_to_item(row) if row else None
+
+    def claim_for_batch(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT request_id, user_id, service_type, attempts, deliver_at, payload FROM generation_queue "
+                "WHERE status = 'batch_pending' ORDER BY deliver_at LIMIT ?",
+                (limit,),
+            ).fetchall()
+            self._conn.executemany("UPDATE generation_queue SET status = 'batching' WHERE request_id = ?", ((row[0],) for row in rows))
+        return [self._row_to_item(row) for row in rows]
+
+    def record_batch(self, batch_id: str, request_ids: List[str]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("INSERT INTO generation_batches (batch_id, submitted_at) VALUES (?, ?)", (batch_id, time.time()))
+            self._conn.executemany("INSERT OR REPLACE INTO generation_batch_items (request_id, batch_id) VALUES (?, ?)", ((rid, batch_id) for rid in request_ids))
+            self._conn.executemany("UPDATE generation_queue SET status = 'batched' WHERE request_id = ?", ((rid,) for rid in request_ids))
+            self._conn.execute("COMMIT")
+
+    def open_batches(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT batch_id FROM generation_batches ORDER BY submitted_at")]
+
+    def batch_members(self, batch_id: str) -> List[Tuple[str, float]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT q.request_id, q.deliver_at FROM generation_batch_items b JOIN generation_queue q ON q.request_id = b.request_id "
+                "WHERE b.batch_id = ? AND q.status = 'batched'",
+                (batch_id,),
+            ).fetchall()
+
+    def close_batch(self, batch_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM generation_batch_items WHERE batch_id = ?", (batch_id,))
+            self._conn.execute("DELETE FROM generation_batches WHERE batch_id = ?", (batch_id,))
+
+    def to_sync(self, request_ids: List[str]):
+        # Возвращает заявки в обычную (синхронную) очередь воркеров; поздний результат пакета для них игнорируется.
+        with self._lock:
+            self._conn.executemany("DELETE FROM generation_batch_items WHERE request_id = ?", ((rid,) for rid in request_ids))
+            self._conn.executemany("UPDATE generation_queue SET status = 'pending', not_before = 0 WHERE request_id = ?", ((rid,) for rid in request_ids))
+
+    def retry_later(self, request_id: str, not_before: float, refund_attempt: bool = False):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE generation_queue SET status = 'pending', not_before = ?, attempts = attempts - ? WHERE request_id = ?",
+                (not_before, 1 if refund_attempt else 0, request_id),
+            )
+
+    def complete(self, request_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM generation_queue WHERE request_id = ?", (request_id,))
+
+    def requeue_running(self) -> int:
+        with self._lock:
+            requeued = self._conn.execute("UPDATE generation_queue SET status = 'pending' WHERE status = 'running'").rowcount
+            self._conn.execute("UPDATE generation_queue SET status = 'batch_pending' WHERE status = 'batching'")
+            return requeued
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM generation_queue").fetchone()[0]
+
+generation_queue = GenerationQueue(CONFIG["STATE_DB_FILE"])
+
+# --- Кэш готовых разборов Матрицы ---
+class ResultCache:
+    # Ключ - хэш нормализованных имени и даты рождения, версии промпта и прогнозного периода.
+    # Запись живет до смены прогнозного периода; при превышении RESULT_CACHE_MAX_BYTES вытесняются
+    # давно не использованные записи (LRU по last_access).
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS result_cache (cache_key TEXT PRIMARY KEY, result BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_last_access ON result_cache (last_access)")
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        return " ".join(name.lower().replace("ё", "е").split())
+
+    @staticmethod
+    def make_key(service_type: str, inputs: List[str], prompt_version: str, window_start: datetime) -> str:
+        raw = "\x1f".join([service_type, *inputs, prompt_version, window_start.strftime("%Y-%m")])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT result, expires_at FROM result_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row and row[1] > now:
+                self._conn.execute("UPDATE result_cache SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+                self.hits += 1
+                return zlib.decompress(row[0]).decode("utf-8")
+            if row:
+                self._conn.execute("DELETE FROM result_cache WHERE cache_key = ?", (cache_key,))
+            self.misses += 1
+            return None
+
+    def put(self, cache_key: str, result: str, expires_at: float):
+        blob = zlib.compress(result.encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO result_cache (cache_key, result, size, created_at, last_access, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, blob, len(blob), now, now, expires_at),
+            )
+            self.evictions += self._conn.execute("DELETE FROM result_cache WHERE expires_at <= ?", (now,)).rowcount
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in self._conn.execute("SELECT cache_key, size FROM result_cache ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM result_cache WHERE cache_key = ?", (key,))
+                    total -= size
+                    self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": entries, "bytes": size}
+
+result_cache = ResultCache(CONFIG["STATE_DB_FILE"], CONFIG["RESULT_CACHE_MAX_BYTES"])
+
+# --- Реестр заявок (идемпотентность) ---
+class SubmissionRegistry:
+    # Одна активная заявка на пользователя: request_id служит ключом идемпотентности на всех этапах
+    # (подтверждение -> генерация -> доставка). Повторное подтверждение получает статус существующей заявки.
+    # Флаг bypass_cache (/clear_user <ID> nocache) хранится в строке пользователя и переживает перезапуск
+    # до следующей регистрации заявки, которая его забирает.
+    # trace_id заявки тоже хранится здесь: оценка и отзыв после доставки попадают в тот же trace,
+    # а user_data после завершения диалога остается пустым.
+    ACTIVE_STATUSES = ("queued", "generating", "scheduled", "delivering")
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS submissions (user_id INTEGER PRIMARY KEY, request_id TEXT NOT NULL UNIQUE, "
+            "service_type TEXT NOT NULL, status TEXT NOT NULL, updated_at REAL NOT NULL, bypass_cache INTEGER NOT NULL DEFAULT 0, trace_id TEXT)"
+        )
+        existing_columns = {row[1] for row in self._conn.execute("PRAGMA table_info(submissions)")}
+        for column, definition in (("bypass_cache", "INTEGER NOT NULL DEFAULT 0"), ("trace_id", "TEXT")):
+            if column not in existing_columns:
+                self._conn.execute(f"ALTER TABLE submissions ADD COLUMN {column} {definition}")
+
+    def get(self, user_id: int) -> Optional[Tuple[str, str, str]]:
+        with self._lock:
+            return self._conn.execute("SELECT request_id, service_type, status FROM submissions WHERE user_id = ?", (user_id,)).fetchone()
+
+    def trace_id(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT trace_id FROM submissions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def try_register(self, user_id: int, service_type: str, trace_id: Optional[str] = None) -> Tuple[bool, str, str, bool]:
+        # Возвращает (создана ли новая заявка, request_id, статус, генерировать ли без кэша результатов).
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            row = self._conn.execute("SELECT request_id, status, bypass_cache FROM submissions WHERE user_id = ?", (user_id,)).fetchone()
+            if row and row[1] in self.ACTIVE_STATUSES + ("delivered",):
+                return False, row[0], row[1], False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO submissions (user_id, request_id, service_type, status, updated_at, trace_id) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (user_id, request_id, service_type, time.time(), trace_id),
+            )
+        return True, request_id, "queued", bool(row and row[2])
+
+    def transition(self, request_id: str, new_status: str, allowed_from: Tuple[str, ...]) -> bool:
+        with self._lock:
+            placeholders = ",".join("?" * len(allowed_from))
+            return self._conn.execute(
+                f"UPDATE submissions SET status = ?, updated_at = ? WHERE request_id = ? AND status IN ({placeholders})",
+                (new_status, time.time(), request_id, *allowed_from),
+            ).rowcount == 1
+
+    def discard(self, request_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM submissions WHERE request_id = ?", (request_id,))
+
+    def clear_user(self, user_id: int, bypass_cache: bool = False):
+        with self._lock:
+            if bypass_cache:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO submissions (user_id, request_id, service_type, status, updated_at, bypass_cache) VALUES (?, ?, '', 'cleared', ?, 1)",
+                    (user_id, uuid.uuid4().hex, time.time()),
+                )
+            else:
+                self._conn.execute("DELETE FROM submissions WHERE user_id = ?", (user_id,))
+
+submission_registry = SubmissionRegistry(CONFIG["STATE_DB_FILE"])
+
+# --- Учет токенов OpenAI ---
+class UsageStore:
+    # Почасовые корзины (сервис, модель, назначение вызова) с суммами токенов и дневная гистограмма completion-токенов
+    # (шаг USAGE_HISTOGRAM_BIN) - по ней считаются p50/p95 без хранения каждого вызова. Суммы за текущий день
+    # держатся в памяти для быстрой проверки дневных бюджетов.
+    def __init__(self, path: str, histogram_bin: int):
+        self.histogram_bin = histogram_bin
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS openai_usage (bucket_start INTEGER NOT NULL, day TEXT NOT NULL, service_type TEXT NOT NULL, "
+            "model TEXT NOT NULL, purpose TEXT NOT NULL, calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+            "completion_tokens INTEGER NOT NULL, PRIMARY KEY (bucket_start, service_type, model, purpose))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_openai_usage_day ON openai_usage (day)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS openai_completion_histogram (day TEXT NOT NULL, service_type TEXT NOT NULL, "
+            "bin INTEGER NOT NULL, calls INTEGER NOT NULL, PRIMARY KEY (day, service_type, bin))"
+        )
+        self._today = ""
+        self._today_tokens: Dict[str, int] = {}
+        self.budget_alerted: set = set()
+
+    @staticmethod
+    def day_of(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+    def _refresh_today_locked(self, day: str):
+        if day == self._today:
+            return
+        self._today = day
+        self.budget_alerted = set()
+        rows = self._conn.execute(
+            "SELECT service_type, SUM(prompt_tokens + completion_tokens) FROM openai_usage WHERE day = ? GROUP BY service_type", (day,)
+        ).fetchall()
+        self._today_tokens = {service_type: tokens for service_type, tokens in rows}
+
+    def record(self, service_type: str, model: str, purpose: str, prompt_tokens: int, completion_tokens: int):
+        now = time.time()
+        day = self.day_of(now)
+        bucket_start = int(now // 3600 * 3600)
+        with self._lock:
+            self._refresh_today_locked(day)
+            self._conn.execute(
+                "INSERT INTO openai_usage (bucket_start, day, service_type, model, purpose, calls, prompt_tokens, completion_tokens) "
+                "VALUES (?, ?, ?, ?, ?, 1, ?, ?) ON CONFLICT (bucket_start, service_type, model, purpose) DO UPDATE SET "
+                "calls = calls + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens, completion_tokens = completion_tokens + excluded.completion_tokens",
+                (bucket_start, day, service_type, model, purpose, prompt_tokens, completion_tokens),
+            )
+            self._conn.execute(
+                "INSERT INTO openai_completion_histogram (day, service_type, bin, calls) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (day, service_type, bin) DO UPDATE SET calls = calls + 1",
+                (day, service_type, completion_tokens // self.histogram_bin),
+            )
+            self._today_tokens[service_type] = self._today_tokens.get(service_type, 0) + prompt_tokens + completion_tokens
+
+    def tokens_today(self, service_type: Optional[str] = None) -> int:
+        with self._lock:
+            self._refresh_today_locked(self.day_of(time.time()))
+            if service_type is None:
+                return sum(self._today_tokens.values())
+            return self._today_tokens.get(service_type, 0)
+
+    def summary(self, first_day: str) -> Dict[str, Any]:
+        # Суммы по (сервис, модель, назначение) и перцентили completion-токенов по сервисам начиная с first_day.
+        with self._lock:
+            totals = self._conn.execute(
+                "SELECT service_type, model, purpose, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens) FROM openai_usage "
+                "WHERE day >= ? GROUP BY service_type, model, purpose ORDER BY service_type, model, purpose", (first_day,)
+            ).fetchall()
+            histogram_rows = self._conn.execute(
+                "SELECT service_type, bin, SUM(calls) FROM openai_completion_histogram WHERE day >= ? GROUP BY service_type, bin ORDER BY service_type, bin",
+                (first_day,),
+            ).fetchall()
+        histograms: Dict[str, List[Tuple[int, int]]] = {}
+        for service_type, bin_index, calls in histogram_rows:
+            histograms.setdefault(service_type, []).append((bin_index, calls))
+        percentiles = {service_type: {p: self._percentile(bins, p) for p in (50, 95)} for service_type, bins in histograms.items()}
+        return {"totals": totals, "percentiles": percentiles}
+
+    def _percentile(self, bins: List[Tuple[int, int]], p: int) -> int:
+        # Верхняя граница корзины, в которую попадает перцентиль.
+        total = sum(calls for _, calls in bins)
+        threshold = total * p / 100
+        seen = 0
+        for bin_index, calls in bins:
+            seen += calls
+            if seen >= threshold:
+                return (bin_index + 1) * self.histogram_bin
+        return 0
+
+    def prune(self, keep_days: int):
+        first_day = self.day_of(time.time() - keep_days * 86400)
+        with self._lock:
+            self._conn.execute("DELETE FROM openai_usage WHERE day < ?", (first_day,))
+            self._conn.execute("DELETE FROM openai_completion_histogram WHERE day < ?", (first_day,))
+
+usage_store = UsageStore(CONFIG["STATE_DB_FILE"], CONFIG["USAGE_HISTOGRAM_BIN"])
+
+async def usage_prune_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(usage_store.prune, CONFIG["USAGE_RETENTION_DAYS"])
+
+def estimate_cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    pricing = CONFIG["OPENAI_PRICING_PER_1M_TOKENS"].get(model)
+    if not pricing:
+        return None
+    return (prompt_tokens * pricing[0] + completion_tokens * pricing[1]) / 1_000_000
+
+def daily_budget_exceeded(service_type: str) -> bool:
+    budgets = CONFIG["OPENAI_DAILY_TOKEN_BUDGET"]
+    service_budget = budgets.get(service_type)
+    total_budget = budgets.get("total")
+    return bool((service_budget and usage_store.tokens_today(service_type) >= service_budget)
+                or (total_budget and usage_store.tokens_today() >= total_budget))
+
+# --- Персистентность диалогов (user_data и состояния ConversationHandler) ---
+class SQLitePersistence(BasePersistence):
+    # Application сам вызывает update_* пачкой раз в update_interval секунд (и при остановке),
+    # поэтому запись в SQLite не происходит на каждом обновлении.
+    def __init__(self, path: str, update_interval: float):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS persisted_user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS persisted_conversations (name TEXT NOT NULL, conv_key TEXT NOT NULL, state TEXT NOT NULL, "
+            "PRIMARY KEY (name, conv_key))"
+        )
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        rows = await asyncio.to_thread(self._execute, "SELECT user_id, data FROM persisted_user_data")
+        return {user_id: json.loads(zlib.decompress(blob).decode("utf-8")) for user_id, blob in rows}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        rows = await asyncio.to_thread(self._execute, "SELECT conv_key, state FROM persisted_conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(conv_key)): json.loads(state) for conv_key, state in rows}
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        if new_state is None:
+            await asyncio.to_thread(self._execute, "DELETE FROM persisted_conversations WHERE name = ? AND conv_key = ?", (name, json.dumps(list(key))))
+        else:
+            await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO persisted_conversations (name, conv_key, state) VALUES (?, ?, ?)",
+                                    (name, json.dumps(list(key)), json.dumps(new_state)))
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False, default=str).encode("utf-8"), 6)
+        await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO persisted_user_data (user_id, data) VALUES (?, ?)", (user_id, blob))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM persisted_user_data WHERE user_id = ?", (user_id,))
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await asyncio.to_thread(self._execute, "PRAGMA wal_checkpoint(PASSIVE)")
 
 # --- Текстовые константы (оставляем утвержденные ранее) ---
 WELCOME_TEXT = """Здравствуйте. Меня зовут Замира.
@@ -178,6 +1272,18 @@ OPENAI_ERROR_MESSAGE = """К сожалению, в данный момент е
 Пожалуйста, попробуйте подтвердить ваш запрос через несколько минут.
 Если это не поможет, свяжитесь со мной напрямую: @zamira_esoteric."""
 
+GENERATION_FAILED_TEXT = """К сожалению, при подготовке вашего ответа возникла техническая неполадка. 🛠️
+Пожалуйста, оформите запрос заново через /start немного позже.
+Если это не поможет, свяжитесь со мной напрямую: @zamira_esoteric."""
+
+INPUT_TOO_LONG_TEXT = "Текст получился очень длинным ({length} знаков). Пожалуйста, сократите его до {max_chars} знаков, оставив самое важное – так я смогу уделить внимание каждой детали."
+
+DAILY_LIMIT_REACHED_TEXT = """Сегодня я уже приняла максимальное число заявок и не смогу уделить вашей заявке должного внимания. 🙏
+Все ваши данные сохранены – пожалуйста, нажмите «Подтвердить» завтра, и я возьмусь за ваш запрос."""
+
+SUBMISSION_IN_PROGRESS_TEXT = """Ваша заявка уже принята и находится в работе. 🔮
+Повторно отправлять ее не нужно – ответ придет сюда, в этот чат, в течение 2-3 часов с момента подтверждения."""
+
 SATISFACTION_PROMPT_TEXT = """Ваш {service_type_rus} готов, я его вам отправила. 🔮
 Очень надеюсь, что информация из него была для вас полезной и дала пищу для размышлений.
 
@@ -210,6 +1316,9 @@ CONTACT_TEXT = """Если у вас остались вопросы или вы
 Мой контакт в Телеграм: @zamira_esoteric 🌟
 Обращайтесь, буду рада помочь."""
 
+DRAFT_EXPIRED_TEXT = """Ваш незавершенный запрос был давно без движения, поэтому я его закрыла. 🌿
+Если захотите вернуться к нему, просто нажмите /start и заполните данные заново."""
+
 CANCEL_TEXT = """Хорошо, я вас поняла. Ваш текущий запрос отменен.
 Если захотите вернуться и начать снова, вы всегда можете это сделать через команду /start из главного меню."""
 
@@ -230,9 +1339,7 @@ PROMPT_TAROT_SYSTEM = """
 3.  **Человечность:** Используй фразы, характерные для опытного практика: «Давайте посмотрим внимательнее…», «Здесь важно понимать…», «Как показывает практика…», «Я бы обратила Ваше внимание на…». Твоя речь должна быть наполнена смыслом, без «воды».
 4.  **Эмодзи:** Крайне умеренно, только для смыслового акцента (🔮, ✨, 🙏, 🌱).
 
-ВРЕМЕННЫЕ РАМКИ:
-* Текущая дата: {current_date}.
-* Прогнозы и советы по будущему: Начиная С {future_start_date}.
+ДАТЫ: текущая дата и начало прогнозного периода указаны в блоке «ВРЕМЕННЫЕ РАМКИ» в конце инструкций.
 
 СТРУКТУРА ОТВЕТА (СТРОГО – ТОЛЬКО ЭТО, БЕЗ ВСЯКИХ ВСТУПЛЕНИЙ И ПРОЩАНИЙ):
 А. **Название расклада:** Краткое, емкое, по сути запроса (придумай сама).
@@ -259,9 +1366,7 @@ PROMPT_MATRIX_SYSTEM = """
 4.  **Доступность изложения:** Сложные концепции (карма, предназначение, родовые задачи) объясняй простыми словами, можно через понятные жизненные аналогии или метафоры (но без излишеств).
 5.  **Эмодзи:** Очень умеренно (🌟, 🌱, 💡, ✨).
 
-ВРЕМЕННЫЕ РАМКИ:
-* Текущая дата: {current_date}.
-* Прогнозы и советы по будущему: Начиная С {future_start_date}.
+ДАТЫ: текущая дата и начало прогнозного периода указаны в блоке «ВРЕМЕННЫЕ РАМКИ» в конце инструкций.
 
 СТРУКТУРА ОТВЕТА (СТРОГО – ТОЛЬКО ЭТО, БЕЗ ВСЯКИХ ВСТУПЛЕНИЙ И ПРОЩАНИЙ):
 А. **Название разбора:** «Разбор Матрицы Судьбы для [Имя клиента]» (или «Разбор Вашей Матрицы Судьбы», если имя не дано).
@@ -271,15 +1376,21 @@ PROMPT_MATRIX_SYSTEM = """
         * Ключевые энергии (арканы) клиента в этом блоке.
         * **Подробное раскрытие (обращаясь к клиенту):** Как эти энергии проявляются в ЕГО жизни (в плюсе и минусе), какие задачи ставят, какие возможности дают. Практические советы по гармонизации.
     * Названия 9 блоков: 1️⃣ Ваш личный потенциал и таланты; 2️⃣ Ваше духовное предназначение и кармические задачи; 3️⃣ Ваши отношения; 4️⃣ Ваши родовые программы; 5️⃣ Ваша социальная реализация; 6️⃣ Ваши финансы; 7️⃣ Ваше здоровье; 8️⃣ Ваши ключевые точки выбора и возрастные этапы; 9️⃣ Ваша итоговая энергия Матрицы.
-В. **Заключение по периодам ({future_start_date_year} – {future_end_date_year} гг.):**
-    * Ключевые тенденции для КЛИЕНТА (обращаясь к нему) на этот период. Основные возможности и вызовы.
+В. **Заключение по периодам:**
+    * Ключевые тенденции для КЛИЕНТА (обращаясь к нему) на прогнозный период из блока «ВРЕМЕННЫЕ РАМКИ». Основные возможности и вызовы.
     * Заверши одной теплой, мотивирующей фразой-напутствием для клиента на этот период.
 
 ОБЪЕМ: Качество и глубина важнее знаков. Разбор должен быть полным и содержательным, но без «воды». Ориентир ~5000-5500 знаков.
-ИСХОДНЫЕ ДАННЫЕ КЛИЕНТА: Имя и дата рождения. Анализ – ИСКЛЮЧИТЕЛЬНО по ним.
+ИСХОДНЫЕ ДАННЫЕ КЛИЕНТА: Имя, дата рождения и уже рассчитанные позиции арканов Матрицы (включая арканы по возрастам). Используй ИМЕННО эти значения и не пересчитывай их – твоя задача трактовка, а не арифметика. Анализ – ИСКЛЮЧИТЕЛЬНО по этим данным.
 ЗАПРЕЩЕНО: Любые приветствия, представления, благодарности, реклама, прощания, упоминания себя как ИИ.
 """
 
+# Динамическая часть системного промпта - добавляется в конец, чтобы не менять префикс.
+PROMPT_DATE_FACTS_BLOCK = """ВРЕМЕННЫЕ РАМКИ:
+* Текущая дата: {current_date}.
+* Прогнозы и советы по будущему: Начиная С {future_start_date}.
+* Прогнозный период: {future_start_date_year} – {future_end_date_year} гг."""
+
 # --- Утилитарные функции ---
 def get_random_variant(variants_list: List[str]) -> str:
     return random.choice(variants_list)
@@ -314,76 +1425,976 @@ def is_valid_name(name: str) -> bool:
         return True
     return False
 
-async def retry_operation(coro, max_retries=CONFIG["MAX_RETRIES"], delay=CONFIG["RETRY_DELAY"]):
-    for attempt in range(max_retries):
-        try:
-            return await coro()
-        except Exception as e:
-            logger.warning(f"Попытка {attempt + 1} не удалась: {e}")
-            if attempt == max_retries - 1:
-                raise
-            await asyncio.sleep(delay * (2 ** attempt))
-    return None
+# --- Расчет Матрицы Судьбы ---
+def reduce_arcana(value: int) -> int:
+    while value > 22:
+        value = sum(int(digit) for digit in str(value))
+    return value
+
+# Порядок позиций в строке таблицы; названия используются и в промпте.
+MATRIX_BASE_FIELDS = [
+    ("A", "Личные качества (день рождения, левая точка)"),
+    ("B", "Таланты от Бога (месяц, верхняя точка)"),
+    ("C", "Материальная сфера (год, правая точка)"),
+    ("D", "Кармическая задача (нижняя точка)"),
+    ("E", "Центр Матрицы, зона комфорта"),
+    ("F", "Род по отцу, верх (левый верхний угол)"),
+    ("G", "Род по матери, верх (правый верхний угол)"),
+    ("H", "Род по отцу, низ (правый нижний угол)"),
+    ("I", "Род по матери, низ (левый нижний угол)"),
+    ("A1", "Внутренняя точка личных качеств"),
+    ("B1", "Внутренняя точка талантов"),
+    ("C1", "Внутренняя точка материальной сферы"),
+    ("D1", "Внутренняя точка кармической задачи"),
+    ("A2", "Промежуточная точка личных качеств"),
+    ("B2", "Промежуточная точка талантов"),
+    ("C2", "Промежуточная точка материальной сферы"),
+    ("D2", "Промежуточная точка кармической задачи"),
+    ("X", "Точка баланса в канале любви и денег"),
+    ("SKY", "Линия Неба"),
+    ("EARTH", "Линия Земли"),
+    ("PERSONAL", "Личное предназначение (20-40 лет)"),
+    ("MALE", "Мужская родовая линия"),
+    ("FEMALE", "Женская родовая линия"),
+    ("SOCIAL", "Социальное предназначение (40-60 лет)"),
+    ("SPIRITUAL", "Духовное предназначение (после 60 лет)"),
+    ("PLANETARY", "Планетарное предназначение"),
+]
+# Внешний восьмиугольник: главные точки через каждые 10 лет (0 лет - A, 10 - F, 20 - B, ... 70 - I),
+# внутри каждого отрезка 7 промежуточных точек с шагом 1.25 года.
+MATRIX_PERIOD_ANCHORS = ["A", "F", "B", "G", "C", "H", "D", "I"]
+MATRIX_PERIOD_AGES = [segment * 10 + step * 1.25 for segment in range(8) for step in range(8)]
+MATRIX_ROW_SIZE = len(MATRIX_BASE_FIELDS) + len(MATRIX_PERIOD_AGES)
+MATRIX_TABLE_FIRST_YEAR = 1900
+
+def compute_destiny_matrix(day: int, month: int, year: int) -> List[int]:
+    return list(_compute_destiny_matrix_row(reduce_arcana(day), reduce_arcana(month), reduce_arcana(sum(int(digit) for digit in str(year)))))
+
+@lru_cache(maxsize=None)
+def _compute_destiny_matrix_row(a: int, b: int, c: int) -> Tuple[int, ...]:
+    # Вся матрица определяется тремя внешними арканами, поэтому различных строк не больше 22^3.
+    r = reduce_arcana
+    p: Dict[str, int] = {"A": a, "B": b, "C": c}
+    p["D"] = r(p["A"] + p["B"] + p["C"])
+    p["E"] = r(p["A"] + p["B"] + p["C"] + p["D"])
+    p["F"] = r(p["A"] + p["B"])
+    p["G"] = r(p["B"] + p["C"])
+    p["H"] = r(p["C"] + p["D"])
+    p["I"] = r(p["D"] + p["A"])
+    for outer in ("A", "B", "C", "D"):
+        p[f"{outer}1"] = r(p[outer] + p["E"])
+        p[f"{outer}2"] = r(p[outer] + p[f"{outer}1"])
+    p["X"] = r(p["C1"] + p["D1"])
+    p["SKY"] = r(p["B"] + p["D"])
+    p["EARTH"] = r(p["A"] + p["C"])
+    p["PERSONAL"] = r(p["SKY"] + p["EARTH"])
+    p["MALE"] = r(p["F"] + p["H"])
+    p["FEMALE"] = r(p["G"] + p["I"])
+    p["SOCIAL"] = r(p["MALE"] + p["FEMALE"])
+    p["SPIRITUAL"] = r(p["PERSONAL"] + p["SOCIAL"])
+    p["PLANETARY"] = r(p["SOCIAL"] + p["SPIRITUAL"])
+
+    row = [p[key] for key, _ in MATRIX_BASE_FIELDS]
+    for segment, anchor in enumerate(MATRIX_PERIOD_ANCHORS):
+        start = p[anchor]
+        end = p[MATRIX_PERIOD_ANCHORS[(segment + 1) % len(MATRIX_PERIOD_ANCHORS)]]
+        mid = r(start + end)
+        q1 = r(start + mid)
+        q3 = r(mid + end)
+        row.extend([start, r(start + q1), q1, r(q1 + mid), mid, r(mid + q3), q3, r(q3 + end)])
+    return tuple(row)
+
+class DestinyMatrixTable:
+    # Все даты от MATRIX_TABLE_FIRST_YEAR до текущего года + 5 (как в validate_date_semantic) в одном array('B'):
+    # строка даты находится по ее порядковому номеру за O(1).
+    def __init__(self):
+        self._data: Optional[array] = None
+        self._first_ordinal = date(MATRIX_TABLE_FIRST_YEAR, 1, 1).toordinal()
+        self._last_ordinal = 0
+        self._build_lock = threading.Lock()
+
+    def _build(self):
+        last_day = date(datetime.now().year + 5, 12, 31)
+        data = array("B")
+        for year in range(MATRIX_TABLE_FIRST_YEAR, last_day.year + 1):
+            c = reduce_arcana(sum(int(digit) for digit in str(year)))
+            for month in range(1, 13):
+                for day in range(1, calendar.monthrange(year, month)[1] + 1):
+                    data.extend(_compute_destiny_matrix_row(reduce_arcana(day), month, c))
+        self._data = data
+        self._last_ordinal = last_day.toordinal()
+        logger.info(f"Таблица Матрицы Судьбы построена: {len(data) // MATRIX_ROW_SIZE} дат, {len(data)} байт")
+
+    def ensure_built(self):
+        if self._data is None:
+            with self._build_lock:
+                if self._data is None:
+                    self._build()
+
+    def lookup(self, dob: date) -> List[int]:
+        self.ensure_built()
+        ordinal = dob.toordinal()
+        if not self._first_ordinal <= ordinal <= self._last_ordinal:
+            return compute_destiny_matrix(dob.day, dob.month, dob.year)
+        offset = (ordinal - self._first_ordinal) * MATRIX_ROW_SIZE
+        return self._data[offset:offset + MATRIX_ROW_SIZE].tolist()
+
+destiny_matrix_table = DestinyMatrixTable()
+
+def get_destiny_matrix(dob_text: str) -> Optional[Dict[str, Any]]:
+    if not validate_date_semantic(dob_text):
+        return None
+    row = destiny_matrix_table.lookup(datetime.strptime(dob_text, "%d.%m.%Y").date())
+    base_count = len(MATRIX_BASE_FIELDS)
+    return {
+        "positions": {key: row[idx] for idx, (key, _) in enumerate(MATRIX_BASE_FIELDS)},
+        "periods": list(zip(MATRIX_PERIOD_AGES, row[base_count:])),
+    }
 
-semaphore = asyncio.Semaphore(CONFIG["OPENAI_MAX_CONCURRENT"])
+def format_destiny_matrix_for_prompt(matrix: Dict[str, Any]) -> str:
+    lines = ["Рассчитанные позиции Матрицы Судьбы (арканы 1-22):"]
+    for key, title in MATRIX_BASE_FIELDS:
+        lines.append(f"- {title}: {matrix['positions'][key]}")
+    periods = ", ".join(f"{age:g}: {arcana}" for age, arcana in matrix["periods"])
+    lines.append(f"Арканы по возрастам (лет: аркан): {periods}")
+    return "\n".join(lines)
+
+# --- Повторы запросов к OpenAI и автомат-предохранитель ---
+class CircuitOpenError(Exception):
+    def __init__(self, retry_at: float):
+        super().__init__(f"OpenAI временно недоступен, повтор не раньше чем через {int(max(retry_at - time.time(), 0))} с")
+        self.retry_at = retry_at
+
+def classify_openai_error(error: Exception) -> Tuple[bool, Optional[float]]:
+    # Возвращает (можно ли повторить, пауза из Retry-After). 429/408/409/5xx и сетевые ошибки повторяем,
+    # остальные 4xx (неверный запрос, авторизация, нет модели) считаем фатальными.
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True, None
+    if isinstance(error, openai.APIStatusError):
+        retry_after = None
+        headers = error.response.headers if error.response is not None else {}
+        try:
+            if headers.get("retry-after-ms"):
+                retry_after = float(headers["retry-after-ms"]) / 1000
+            elif headers.get("retry-after"):
+                retry_after = float(headers["retry-after"])
+        except ValueError:
+            retry_after = None
+        return error.status_code in (408, 409, 429) or error.status_code >= 500, retry_after
+    return False, None
+
+def is_model_unavailable_error(error: Exception) -> bool:
+    # Фатальная ошибка, относящаяся к самой модели (нет доступа, модель снята или переименована):
+    # повторять бессмысленно, но запасная модель цепочки может ответить.
+    if not isinstance(error, openai.APIStatusError):
+        return False
+    code = getattr(error, "code", None) or ""
+    return error.status_code == 404 or code in ("model_not_found", "model_deprecated") or "deprecated" in str(error).lower()
+
+class CircuitBreaker:
+    # closed -> open после CIRCUIT_FAILURE_THRESHOLD подряд неудачных (повторяемых) ошибок; через CIRCUIT_OPEN_SECONDS
+    # пропускается один пробный запрос (half_open). Успех закрывает предохранитель, неудача снова открывает.
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self.alert_pending = False
+
+    @property
+    def retry_at(self) -> float:
+        return self.opened_at + self.open_seconds
+
+    def unavailable_until(self) -> Optional[float]:
+        # None, если before_call пропустит запрос; иначе - когда пробовать снова (как в CircuitOpenError).
+        if self.state == "closed" or (self.state == "open" and time.time() >= self.retry_at):
+            return None
+        if self.state == "half_open" and not self._probe_in_flight:
+            return None
+        return self.retry_at if self.state == "open" else time.time() + self.open_seconds
 
-async def ask_gpt(system_prompt_template: str, user_prompt_content: str, max_tokens: int, context: ContextTypes.DEFAULT_TYPE, user_id_for_error: int) -> Optional[str]:
-    async with semaphore:
-        async def gpt_call():
-            now = datetime.now()
-            months_genitive = ["января", "февраля", "марта", "апреля", "мая", "июня",
-                               "июля", "августа", "сентября", "октября", "ноября", "декабря"]
-            current_date_str = f"конец {months_genitive[now.month-1]} {now.year} года"
+    def before_call(self):
+        if self.state == "closed":
+            return
+        if self.state == "open" and time.time() >= self.retry_at:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(self.retry_at if self.state == "open" else time.time() + self.open_seconds)
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"Предохранитель {self.name}: пробный запрос успешен, закрываю")
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        # Возвращает True, если предохранитель только что открылся (тогда же взводится alert_pending для уведомления админа).
+        self.consecutive_failures += 1
+        was_probe = self._probe_in_flight
+        self._probe_in_flight = False
+        if was_probe or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.time()
+            self.times_opened += 1
+            logger.warning(f"Предохранитель {self.name} открыт после {self.consecutive_failures} ошибок подряд на {self.open_seconds} с")
+            self.alert_pending = self.alert_pending or not was_probe
+            return not was_probe
+        return False
 
-            if now.day <= 10:
-                future_start_dt_obj = (now.replace(day=1) + timedelta(days=32)).replace(day=1)
+    def release_probe(self):
+        # Пробный запрос завершился фатальной ошибкой запроса (не сбоем сервиса) или был отменен - даем пройти следующему.
+        self._probe_in_flight = False
+
+class RetryPolicy:
+    # Повторы с "декоррелированным" джиттером: пауза = min(cap, uniform(base, prev * 3)); Retry-After сервера имеет приоритет.
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries: Dict[str, int] = {}
+        self.fatal_errors = 0
+
+    def next_delay(self, previous_delay: float, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), self.max_delay)
+        return min(self.max_delay, random.uniform(self.base_delay, previous_delay * 3))
+
+    async def run(self, operation, breaker: CircuitBreaker):
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            breaker.before_call()
+            try:
+                with tracer.span("openai.attempt", attempt=attempt, circuit=breaker.name):
+                    result = await operation()
+            except Exception as e:
+                retryable, retry_after = classify_openai_error(e)
+                if not retryable:
+                    self.fatal_errors += 1
+                    breaker.release_probe()
+                    logger.error(f"Фатальная ошибка OpenAI, без повторов: {e}")
+                    raise
+                breaker.record_failure()
+                if attempt == self.max_attempts or breaker.state == "open":
+                    raise
+                delay = self.next_delay(delay, retry_after)
+                error_kind = type(e).__name__
+                self.retries[error_kind] = self.retries.get(error_kind, 0) + 1
+                logger.warning(f"Попытка {attempt} не удалась ({error_kind}): {e}. Повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Отмена (проигравший дубль, остановка бота) ничего не говорит о состоянии сервиса,
+                # но пробный запрос не должен остаться "в полете" навсегда.
+                breaker.release_probe()
+                raise
             else:
-                future_start_dt_obj = (now.replace(day=1) + timedelta(days=63)).replace(day=1)
-
-            future_start_date_str = f"начала {months_genitive[future_start_dt_obj.month-1]} {future_start_dt_obj.year} года"
-            future_start_date_year_str = str(future_start_dt_obj.year)
-            future_end_date_year_str = str(future_start_dt_obj.year + 3)
+                breaker.record_success()
+                return result
+        return None
+
+openai_circuits: Dict[str, CircuitBreaker] = {}
+
+def circuit_for(model: str) -> CircuitBreaker:
+    # У каждой модели свой предохранитель: сбой основной модели не должен блокировать запасную.
+    if model not in openai_circuits:
+        openai_circuits[model] = CircuitBreaker(model, CONFIG["CIRCUIT_FAILURE_THRESHOLD"], CONFIG["CIRCUIT_OPEN_SECONDS"])
+    return openai_circuits[model]
+
+openai_retry_policy = RetryPolicy(CONFIG["OPENAI_RETRY_MAX_ATTEMPTS"], CONFIG["OPENAI_RETRY_BASE_DELAY"], CONFIG["OPENAI_RETRY_MAX_DELAY"])
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CONFIG["TOKEN_ESTIMATE_CHARS_PER_TOKEN"]) + 1
+
+def estimate_progress_tokens(progress: Dict[str, int]) -> int:
+    # Оценка оплачиваемых токенов оборванного запроса: промпт (если запрос ушел) и уже полученная часть потока.
+    chars = progress.get("chars", 0)
+    return progress.get("prompt_tokens", 0) + (int(chars / CONFIG["TOKEN_ESTIMATE_CHARS_PER_TOKEN"]) + 1 if chars else 0)
+
+class OpenAIScheduler:
+    # Выдает слоты на запросы к OpenAI с учетом параллельности и лимитов RPM/TPM (скользящее окно 60 с).
+    # Среди ожидающих выбирается запрос с наименьшим приоритетом, а при равном приоритете - тот тип услуги,
+    # который потребил меньше токенов (справедливое деление пропускной способности между tarot и matrix).
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, max_concurrent: int, rpm_limit: int, tpm_limit: int):
+        self.max_concurrent = max_concurrent
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.in_flight = 0
+        self._window: deque = deque()  # [timestamp, tokens]
+        self._window_tokens = 0
+        self._waiters: List[Tuple[int, int, str, int, asyncio.Future]] = []
+        self._served_tokens: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self._wakeup_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def utilization(self) -> float:
+        self._prune_window(time.monotonic())
+        return max(self.in_flight / self.max_concurrent, len(self._window) / self.rpm_limit, self._window_tokens / self.tpm_limit)
+
+    def _prune_window(self, now: float):
+        while self._window and now - self._window[0][0] >= self.WINDOW_SECONDS:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _fits(self, tokens: int) -> bool:
+        if self.in_flight >= self.max_concurrent:
+            return False
+        if len(self._window) >= self.rpm_limit:
+            return False
+        # Запрос больше всего TPM-бюджета пропускаем, когда окно пустое, иначе он не выполнится никогда.
+        return self._window_tokens + tokens <= self.tpm_limit or not self._window
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self._prune_window(now)
+        while self._waiters:
+            self._waiters = [w for w in self._waiters if not w[4].done()]
+            if not self._waiters:
+                break
+            waiter = min(self._waiters, key=lambda w: (w[0], self._served_tokens.get(w[2], 0), w[1]))
+            priority, seq, service_type, tokens, future = waiter
+            if not self._fits(tokens):
+                break
+            self._waiters.remove(waiter)
+            entry = [now, tokens]
+            self._window.append(entry)
+            self._window_tokens += tokens
+            self._served_tokens[service_type] = self._served_tokens.get(service_type, 0) + tokens
+            self.in_flight += 1
+            future.set_result(entry)
+        self._schedule_wakeup()
+
+    def _schedule_wakeup(self):
+        if self._wakeup_handle:
+            self._wakeup_handle.cancel()
+            self._wakeup_handle = None
+        if self._waiters and self._window and self.in_flight < self.max_concurrent:
+            delay = max(self._window[0][0] + self.WINDOW_SECONDS - time.monotonic(), 0.01)
+            self._wakeup_handle = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _release(self, entry: list, actual_tokens: Optional[int]):
+        self.in_flight -= 1
+        if actual_tokens is not None and entry in self._window:
+            self._window_tokens += actual_tokens - entry[1]
+            entry[1] = actual_tokens
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int, service_type: str):
+        priority = CONFIG["OPENAI_SERVICE_PRIORITY"].get(service_type, 0)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((priority, next(self._seq), service_type, estimated_tokens, future))
+        self._dispatch()
+        try:
+            entry = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(future.result(), None)
+            raise
+        usage = {"total_tokens": None}
+        try:
+            yield usage
+        finally:
+            self._release(entry, usage["total_tokens"])
 
-            system_prompt = system_prompt_template.format(
-                current_date=current_date_str,
-                future_start_date=future_start_date_str,
-                future_start_date_year=future_start_date_year_str,
-                future_end_date_year=future_end_date_year_str
-            )
+openai_scheduler = OpenAIScheduler(CONFIG["OPENAI_MAX_CONCURRENT"], CONFIG["OPENAI_RPM_LIMIT"], CONFIG["OPENAI_TPM_LIMIT"])
 
-            logger.info(f"OpenAI запрос для {user_id_for_error}: system_prompt (начало): {system_prompt[:200]}...")
-            logger.info(f"OpenAI запрос для {user_id_for_error}: user_prompt (начало): {user_prompt_content[:200]}...")
-
-            response = await openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt_content}
-                ],
-                temperature=0.75,
-                max_tokens=max_tokens,
+def get_forecast_window(now: datetime) -> Tuple[datetime, datetime]:
+    # Возвращает начало прогнозного периода и момент, когда оно сменится (11-е число месяца перед ним).
+    if now.day <= 10:
+        future_start_dt_obj = (now.replace(day=1) + timedelta(days=32)).replace(day=1)
+    else:
+        future_start_dt_obj = (now.replace(day=1) + timedelta(days=63)).replace(day=1)
+    window_end = (future_start_dt_obj - timedelta(days=1)).replace(day=11, hour=0, minute=0, second=0, microsecond=0)
+    return future_start_dt_obj, window_end
+
+MONTHS_GENITIVE = ["января", "февраля", "марта", "апреля", "мая", "июня",
+                   "июля", "августа", "сентября", "октября", "ноября", "декабря"]
+
+@lru_cache(maxsize=32)
+def _render_system_prompt_for_window(system_prompt_template: str, year: int, month: int, future_start_year: int, future_start_month: int) -> str:
+    # Статичные инструкции идут неизменным префиксом (его кэширует провайдер), даты - коротким блоком в конце.
+    date_facts = PROMPT_DATE_FACTS_BLOCK.format(
+        current_date=f"конец {MONTHS_GENITIVE[month - 1]} {year} года",
+        future_start_date=f"начала {MONTHS_GENITIVE[future_start_month - 1]} {future_start_year} года",
+        future_start_date_year=future_start_year,
+        future_end_date_year=future_start_year + 3,
+    )
+    return f"{system_prompt_template.strip()}\n\n{date_facts}"
+
+def render_system_prompt(system_prompt_template: str, now: Optional[datetime] = None) -> str:
+    # Текст меняется только со сменой месяца или прогнозного периода, поэтому рендерится один раз на окно.
+    now = now or datetime.now()
+    future_start_dt_obj, _ = get_forecast_window(now)
+    return _render_system_prompt_for_window(system_prompt_template, now.year, now.month, future_start_dt_obj.year, future_start_dt_obj.month)
+
+def input_token_limit_error(text: str, limit_key: str) -> Optional[str]:
+    # Оценка токенов без обращения к API; слишком длинный ввод отклоняется до отправки запроса.
+    limit_tokens = CONFIG[limit_key]
+    if estimate_tokens(text) <= limit_tokens:
+        return None
+    max_chars = int(limit_tokens * CONFIG["TOKEN_ESTIMATE_CHARS_PER_TOKEN"])
+    return INPUT_TOO_LONG_TEXT.format(length=len(text), max_chars=max_chars)
+
+# --- Потоковая генерация с контролем длины ---
+class StreamLengthGuard:
+    # Накапливает текст потока и решает, когда его остановить: после маркера финального раздела
+    # ("Итог расклада" / "Заключение по периодам") разрешено не более final_section_max_chars знаков,
+    # а всего - не более hard_cap_chars. Обрезка идет по последней границе предложения (или абзаца), чтобы
+    # заключительный абзац не пропадал целиком, а обрывался на законченной фразе.
+    SENTENCE_ENDS = (". ", "! ", "? ", "… ", ".\n", "!\n", "?\n", "…\n")
+
+    def __init__(self, limits: Dict[str, Any]):
+        self.final_marker = limits["final_section"].lower()
+        self.final_section_max_chars = limits["final_section_max_chars"]
+        self.hard_cap_chars = limits["hard_cap_chars"]
+        self._parts: List[str] = []
+        self._tail = ""
+        self.length = 0
+        self.final_section_at: Optional[int] = None
+        self.stop_reason: Optional[str] = None
+
+    def feed(self, delta: str) -> bool:
+        self._parts.append(delta)
+        self.length += len(delta)
+        if self.final_section_at is None:
+            # Маркер ищется только в хвосте буфера, а не во всем тексте на каждом чанке.
+            self._tail = (self._tail + delta.lower())[-(len(self.final_marker) + len(delta)):]
+            if self.final_marker in self._tail:
+                self.final_section_at = self.length
+        if self.final_section_at is not None and self.length - self.final_section_at >= self.final_section_max_chars:
+            self.stop_reason = "final_section"
+        elif self.length >= self.hard_cap_chars:
+            self.stop_reason = "hard_cap"
+        return self.stop_reason is not None
+
+    def text(self) -> str:
+        text = "".join(self._parts)
+        if self.stop_reason is None:
+            return text.strip()
+        min_pos = self.final_section_at or 0
+        boundaries = [text.rfind("\n\n")] + [pos + 1 for pos in (text.rfind(mark) for mark in self.SENTENCE_ENDS) if pos >= 0]
+        cut = max(boundaries)
+        if cut > min_pos:
+            return text[:cut].strip()
+        return text.strip()
+
+class StreamStats:
+    # Время до первого токена и до конца генерации (последние 200 вызовов на услугу), ранние остановки и
+    # оценка сэкономленных токенов (верхняя граница: max_tokens минус фактически сгенерированное).
+    def __init__(self):
+        self.first_token_times: Dict[str, deque] = {}
+        self.complete_times: Dict[str, deque] = {}
+        self.early_stops: Dict[str, int] = {}
+        self.tokens_saved: Dict[str, int] = {}
+
+    def record(self, service_type: str, first_token_time: Optional[float], complete_time: float, stop_reason: Optional[str], tokens_saved: int):
+        if first_token_time is not None:
+            self.first_token_times.setdefault(service_type, deque(maxlen=200)).append(first_token_time)
+        self.complete_times.setdefault(service_type, deque(maxlen=200)).append(complete_time)
+        if stop_reason:
+            key = f"{service_type}:{stop_reason}"
+            self.early_stops[key] = self.early_stops.get(key, 0) + 1
+            self.tokens_saved[service_type] = self.tokens_saved.get(service_type, 0) + tokens_saved
+
+    def summary(self, service_type: str) -> Optional[Dict[str, float]]:
+        times = sorted(self.complete_times.get(service_type, ()))
+        if not times:
+            return None
+        first_token_times = self.first_token_times.get(service_type) or [0.0]
+        return {
+            "p50": times[len(times) // 2],
+            "p95": times[min(int(len(times) * 0.95), len(times) - 1)],
+            "first_token_avg": sum(first_token_times) / len(first_token_times),
+            "tokens_saved": self.tokens_saved.get(service_type, 0),
+        }
+
+stream_stats = StreamStats()
+
+def chunk_usage(chunk) -> Optional[Tuple[int, int]]:
+    # openai 1.12 не знает поля usage у чанка и оставляет его как есть (dict); в новых версиях это объект.
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return usage.prompt_tokens, usage.completion_tokens
+
+async def stream_completion(model: str, messages: List[Dict[str, str]], max_tokens: int, service_type: str,
+                            progress: Optional[Dict[str, int]] = None) -> Tuple[str, Tuple[int, int]]:
+    # Возвращает текст и (prompt_tokens, completion_tokens). Точный расход приходит в последнем чанке потока;
+    # если поток остановлен раньше, расход оценивается по промпту и всему полученному тексту (включая обрезанную часть).
+    guard = StreamLengthGuard(CONFIG["STREAM_LENGTH_LIMITS"][service_type])
+    started = time.monotonic()
+    first_token_time: Optional[float] = None
+    usage: Optional[Tuple[int, int]] = None
+    stream = await openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.75,
+        max_tokens=max_tokens,
+        stream=True,
+        # stream_options появился в API позже openai 1.12, поэтому передается через extra_body.
+        extra_body={"stream_options": {"include_usage": True}},
+    )
+    try:
+        async for chunk in stream:
+            usage = chunk_usage(chunk) or usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token_time is None:
+                first_token_time = time.monotonic() - started
+            stop = guard.feed(chunk.choices[0].delta.content)
+            if progress is not None:
+                progress["chars"] = guard.length
+            if stop:
+                break
+    finally:
+        # Закрытие соединения обрывает генерацию на стороне API - оставшиеся токены не оплачиваются.
+        await stream.close()
+    text = guard.text()
+    tokens_saved = max(max_tokens - estimate_tokens(text), 0) if guard.stop_reason else 0
+    stream_stats.record(service_type, first_token_time, time.monotonic() - started, guard.stop_reason, tokens_saved)
+    if guard.stop_reason:
+        logger.info(f"Поток {service_type} ({model}) остановлен ({guard.stop_reason}) на {guard.length} знаках, итог {len(text)} знаков")
+    if usage is None:
+        usage = (sum(estimate_tokens(message["content"]) for message in messages), estimate_progress_tokens({"chars": guard.length}))
+    return text, usage
+
+class ModelRouter:
+    # Политика запросов по типу услуги: если ответ не пришел за hedge_after секунд и у планировщика нет очереди,
+    # отправляется дубликат запроса; побеждает первый успешный, второй отменяется. Расход на дубли учитывается
+    # отдельно: токены проигравшего запроса, а если он отменен - оценка по его ходу (промпт и уже полученная часть потока).
+    def __init__(self, routes: Dict[str, Dict[str, Any]]):
+        self.routes = routes
+        self.hedges_started: Dict[str, int] = {}
+        self.hedges_won: Dict[str, int] = {}
+        self.hedge_tokens: Dict[str, int] = {}
+        self.fallbacks: Dict[str, int] = {}
+
+    def models(self, service_type: str) -> List[str]:
+        return self.routes.get(service_type, {}).get("models") or [CONFIG["OPENAI_MODEL"]]
+
+    def unavailable_until(self, service_type: str) -> Optional[float]:
+        # None, если хотя бы одна модель цепочки принимает запросы; иначе - ближайшее время пробного запроса.
+        retry_times = []
+        for model in self.models(service_type):
+            circuit = openai_circuits.get(model)
+            retry_at = circuit.unavailable_until() if circuit is not None else None
+            if retry_at is None:
+                return None
+            retry_times.append(retry_at)
+        return min(retry_times)
+
+    def record_fallback(self, service_type: str):
+        self.fallbacks[service_type] = self.fallbacks.get(service_type, 0) + 1
+
+    async def hedged_call(self, service_type: str, model: str, call_model, purpose: str,
+                          progress: Optional[Dict[str, int]] = None) -> Tuple[str, int]:
+        hedge_after = self.routes.get(service_type, {}).get("hedge_after")
+        if not hedge_after:
+            return await call_model(model, purpose, progress)
+        primary_progress = progress if progress is not None else {}
+        hedge_progress: Dict[str, int] = {}
+        primary = asyncio.create_task(call_model(model, purpose, primary_progress))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if done or openai_scheduler.queue_depth:
+                return await primary
+            hedge = asyncio.create_task(call_model(model, "hedge", hedge_progress))
+            pending = {primary, hedge}
+            self.hedges_started[service_type] = self.hedges_started.get(service_type, 0) + 1
+            logger.info(f"Запрос {service_type} к {model} идет дольше {hedge_after} с, отправлен дублирующий запрос")
+            errors = []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        continue
+                    loser = primary if task is hedge else hedge
+                    if task is hedge:
+                        self.hedges_won[service_type] = self.hedges_won.get(service_type, 0) + 1
+                    if loser.done() and not loser.cancelled() and loser.exception() is None:
+                        loser_tokens = loser.result()[1]
+                    else:
+                        loser_tokens = estimate_progress_tokens(primary_progress if loser is primary else hedge_progress)
+                    self.hedge_tokens[service_type] = self.hedge_tokens.get(service_type, 0) + loser_tokens
+                    return task.result()
+            raise errors[-1]
+        finally:
+            for task in pending:
+                task.cancel()
+
+model_router = ModelRouter(CONFIG["OPENAI_MODEL_ROUTES"])
+
+async def generate_completion(system_prompt_template: str, user_prompt_content: str, max_tokens: int, user_id_for_log: int,
+                              service_type: str = "tarot", usage_sink: Optional[Dict[str, Any]] = None, purpose: str = "main") -> str:
+    system_prompt = render_system_prompt(system_prompt_template)
+
+    prompt_logger.info("OpenAI запрос для %s: system_prompt (начало): %.200s...", user_id_for_log, system_prompt)
+    prompt_logger.info("OpenAI запрос для %s: user_prompt (начало): %.200s...", user_id_for_log, user_prompt_content)
+
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt_content)
+
+    async def call_model(model: str, call_purpose: str, progress: Optional[Dict[str, int]] = None) -> Tuple[str, int]:
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt_content}
+        ]
+        # Слот держится только на время самого запроса: пауза между попытками в RetryPolicy идет без слота.
+        with tracer.span("openai.request", model=model, purpose=call_purpose) as span_attributes:
+            text, total_tokens, call_prompt_tokens, call_completion_tokens = await request_model(model, messages, call_purpose, progress)
+            span_attributes.update(prompt_tokens=call_prompt_tokens, completion_tokens=call_completion_tokens)
+        if total_tokens:
+            # Учитывается каждый завершенный вызов, включая повторы и дублирующие запросы.
+            try:
+                await asyncio.to_thread(usage_store.record, service_type, model, call_purpose, call_prompt_tokens, call_completion_tokens)
+            except Exception as e:
+                logger.error(f"Не удалось записать расход токенов: {e}")
+        return text, total_tokens
+
+    async def request_model(model: str, messages: List[Dict[str, str]], call_purpose: str,
+                            progress: Optional[Dict[str, int]]) -> Tuple[str, int, int, int]:
+        async with openai_scheduler.slot(prompt_tokens + max_tokens, service_type) as usage:
+            request_started = time.monotonic()
+            if progress is not None:
+                progress.update(prompt_tokens=prompt_tokens, chars=0)
+            if CONFIG["OPENAI_STREAMING"]:
+                text, (call_prompt_tokens, call_completion_tokens) = await stream_completion(model, messages, max_tokens, service_type, progress)
+            else:
+                response = await openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.75,
+                    max_tokens=max_tokens,
+                )
+                text = response.choices[0].message.content.strip()
+                if response.usage:
+                    call_prompt_tokens, call_completion_tokens = response.usage.prompt_tokens, response.usage.completion_tokens
+                else:
+                    call_prompt_tokens, call_completion_tokens = 0, 0
+            METRIC_OPENAI_REQUEST_SECONDS.observe(time.monotonic() - request_started, service_type, model, call_purpose)
+            total_tokens = call_prompt_tokens + call_completion_tokens
+            usage["total_tokens"] = total_tokens
+        return text, total_tokens, call_prompt_tokens, call_completion_tokens
+
+    # Ход текущего запроса виден вызывающему через usage_sink["progress"]: по нему оценивается расход отмененной генерации.
+    progress = usage_sink.setdefault("progress", {}) if usage_sink is not None else None
+    last_error: Optional[Exception] = None
+    for index, model in enumerate(model_router.models(service_type)):
+        if index:
+            model_router.record_fallback(service_type)
+            logger.warning(f"OpenAI запрос для {user_id_for_log}: переход на запасную модель {model} после ошибки: {last_error}")
+        try:
+            text, total_tokens = await openai_retry_policy.run(
+                lambda: model_router.hedged_call(service_type, model, call_model, purpose, progress), circuit_for(model)
             )
-            return response.choices[0].message.content.strip()
+        except CircuitOpenError as e:
+            last_error = e
+            continue
+        except Exception as e:
+            if not classify_openai_error(e)[0] and not is_model_unavailable_error(e):
+                raise
+            last_error = e
+            continue
+        if usage_sink is not None:
+            usage_sink["total_tokens"] = usage_sink.get("total_tokens", 0) + total_tokens
+            usage_sink["model"] = model
+        return text
+    raise last_error
 
+async def ask_gpt(system_prompt_template: str, user_prompt_content: str, max_tokens: int, context: ContextTypes.DEFAULT_TYPE, user_id_for_error: int,
+                  service_type: str = "tarot", attempt: int = 1, usage_sink: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    started = time.monotonic()
+    # Время пишется при любом исходе (ok / circuit_open / error / cancelled), иначе медленные сбои не видны в гистограмме.
+    outcome = "cancelled"
+    try:
+        await context.bot.send_chat_action(chat_id=user_id_for_error, action=ChatAction.TYPING)
+        with tracer.span("ask_gpt", service=service_type, attempt=attempt):
+            result = await generate_completion(system_prompt_template, user_prompt_content, max_tokens, user_id_for_error, service_type,
+                                               usage_sink=usage_sink)
+        outcome = "ok"
+        return result
+    except CircuitOpenError as e:
+        # Пробрасывается вызывающему: заявка вернется в очередь без расхода попытки.
+        outcome = "circuit_open"
+        logger.warning(f"Запрос OpenAI для пользователя {user_id_for_error} отклонен: {e}")
+        raise
+    except Exception as e:
+        outcome = "error"
+        error_msg = f"Критическая ошибка OpenAI для пользователя {user_id_for_error}: {e}"
+        for circuit in openai_circuits.values():
+            if circuit.alert_pending:
+                circuit.alert_pending = False
+                error_msg += (f"\n⚡ Предохранитель {circuit.name} открыт на {int(circuit.open_seconds)} с: "
+                              f"новые запросы к этой модели не отправляются.")
+        logger.error(error_msg, exc_info=True)
+        await send_admin_notification(context, error_msg, critical=True)
+        return None
+    finally:
+        METRIC_ASK_GPT_SECONDS.observe(time.monotonic() - started, service_type, str(attempt), outcome)
+
+# --- Спекулятивная генерация на экране подтверждения Таро ---
+class SpeculativeGenerator:
+    # Пока пользователь читает сводку Таро, расклад уже генерируется в фоне. Правка поля или отмена
+    # сбрасывает заготовку; при подтверждении воркер генерации забирает ее вместо нового запроса.
+    # Число спекулятивных запросов ограничено SPECULATIVE_MAX_SPEND_RATIO на одно подтверждение (за последний час).
+    # Готовая заготовка, которую никто не забрал за SPECULATIVE_RESULT_TTL секунд, выбрасывается (evict_expired).
+    # Подтвержденная заготовка ждет воркер: DeadlinePacer может отложить генерацию почти до срока выдачи,
+    # поэтому она хранится до DELAY_SECONDS_MAIN_SERVICE + SPECULATIVE_RESULT_TTL секунд от подтверждения.
+    WINDOW_SECONDS = 3600
+
+    def __init__(self):
+        self._tasks: Dict[int, Tuple[str, asyncio.Task, Dict[str, Any]]] = {}
+        self._finished_at: Dict[int, float] = {}
+        self._confirmed_at: Dict[int, float] = {}
+        self._recent_starts: deque = deque()
+        self._recent_confirms: deque = deque()
+        self.started = 0
+        self.used = 0
+        self.wasted = 0
+        self.wasted_tokens = 0
+
+    @staticmethod
+    def prompt_key(user_prompt: str) -> str:
+        return hashlib.sha256(user_prompt.encode("utf-8")).hexdigest()
+
+    def _trim(self, now: float):
+        for events in (self._recent_starts, self._recent_confirms):
+            while events and now - events[0] > self.WINDOW_SECONDS:
+                events.popleft()
+
+    def _budget_allows(self) -> bool:
+        now = time.time()
+        self._trim(now)
+        budget = CONFIG["SPECULATIVE_MAX_SPEND_RATIO"] * max(len(self._recent_confirms), CONFIG["SPECULATIVE_MIN_BUDGET"])
+        return len(self._recent_starts) < budget
+
+    async def start(self, user_id: int, user_prompt: str, max_tokens: int, service_type: str):
+        if not CONFIG["SPECULATIVE_GENERATION"]:
+            return
+        key = self.prompt_key(user_prompt)
+        existing = self._tasks.get(user_id)
+        if existing and existing[0] == key:
+            return
+        self.invalidate(user_id)
+        if (not self._budget_allows() or openai_scheduler.utilization() >= CONFIG["GENERATION_IDLE_UTILIZATION"]
+                or await asyncio.to_thread(daily_budget_exceeded, service_type)):
+            return
+        system_prompt_template = PROMPT_TAROT_SYSTEM if service_type == "tarot" else PROMPT_MATRIX_SYSTEM
+        usage: Dict[str, Any] = {}
+        task = asyncio.create_task(generate_completion(system_prompt_template, user_prompt, max_tokens, user_id, service_type,
+                                                       usage_sink=usage, purpose="speculative"))
+        task.add_done_callback(partial(self._on_task_done, user_id))
+        self._tasks[user_id] = (key, task, usage)
+        self._recent_starts.append(time.time())
+        self.started += 1
+        logger.info(f"Запущена спекулятивная генерация ({service_type}) для {user_id}")
+
+    def _on_task_done(self, user_id: int, task: asyncio.Task):
+        entry = self._tasks.get(user_id)
+        if entry and entry[1] is task:
+            self._finished_at[user_id] = time.time()
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Спекулятивная генерация для {user_id} завершилась ошибкой: {task.exception()}")
+
+    @staticmethod
+    def _spent_tokens(usage: Dict[str, Any]) -> int:
+        # Завершенная генерация знает точный расход; отмененная на полпути - только оценку по ходу запроса.
+        return usage.get("total_tokens") or estimate_progress_tokens(usage.get("progress", {}))
+
+    def invalidate(self, user_id: int):
+        entry = self._tasks.pop(user_id, None)
+        self._finished_at.pop(user_id, None)
+        self._confirmed_at.pop(user_id, None)
+        if not entry:
+            return
+        _, task, usage = entry
+        task.cancel()
+        self.wasted += 1
+        self.wasted_tokens += self._spent_tokens(usage)
+        logger.info(f"Спекулятивная генерация для {user_id} отброшена")
+
+    def evict_expired(self):
+        now = time.time()
+        expired = []
+        for user_id, finished_at in self._finished_at.items():
+            confirmed_at = self._confirmed_at.get(user_id)
+            if confirmed_at is None:
+                expired_now = now - finished_at > CONFIG["SPECULATIVE_RESULT_TTL"]
+            else:
+                expired_now = now - confirmed_at > CONFIG["DELAY_SECONDS_MAIN_SERVICE"] + CONFIG["SPECULATIVE_RESULT_TTL"]
+            if expired_now:
+                expired.append(user_id)
+        for user_id in expired:
+            self.invalidate(user_id)
+        if expired:
+            logger.info(f"Выброшено {len(expired)} невостребованных спекулятивных заготовок")
+
+    def record_confirm(self, user_id: int, speculation_key: Optional[str]):
+        now = time.time()
+        self._recent_confirms.append(now)
+        entry = self._tasks.get(user_id)
+        if entry and speculation_key and entry[0] == speculation_key:
+            self._confirmed_at[user_id] = now
+
+    async def take(self, user_id: int, speculation_key: Optional[str]) -> Optional[str]:
+        entry = self._tasks.get(user_id)
+        if not entry or not speculation_key:
+            return None
+        if entry[0] != speculation_key:
+            self.invalidate(user_id)
+            return None
+        self._tasks.pop(user_id, None)
+        self._finished_at.pop(user_id, None)
+        self._confirmed_at.pop(user_id, None)
         try:
-            await context.bot.send_chat_action(chat_id=user_id_for_error, action=ChatAction.TYPING)
-            return await retry_operation(gpt_call)
-        except Exception as e:
-            error_msg = f"Критическая ошибка OpenAI для пользователя {user_id_for_error}: {e}"
-            logger.error(error_msg, exc_info=True)
-            await send_admin_notification(context, error_msg, critical=True)
+            result = await entry[1]
+        except (Exception, asyncio.CancelledError) as e:
+            logger.warning(f"Спекулятивная генерация для {user_id} не удалась: {e}")
+            self.wasted += 1
+            self.wasted_tokens += self._spent_tokens(entry[2])
             return None
-
-async def send_long_message(chat_id: int, message: str, bot_instance):
+        self.used += 1
+        return result
+
+speculative_generator = SpeculativeGenerator()
+
+# --- Исходящие запросы к Telegram ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # Все запросы бота к Telegram проходят через общий token bucket (~30 сообщений/с на бота),
+    # сообщения в один чат идут по очереди с интервалом TELEGRAM_PER_CHAT_INTERVAL (~1 сообщение/с на чат).
+    # RetryAfter приостанавливает все отправки на указанное время, после чего запрос повторяется;
+    # пока повторяется часть длинного сообщения, следующие части в этот чат ждут своей очереди.
+    # Повторяются только сбои соединения: BadRequest (в PTB наследник NetworkError) и Forbidden пробрасываются сразу,
+    # а TimedOut у отправки нового сообщения не повторяется - сообщение могло дойти, и повтор его продублирует.
+    PACED_ENDPOINTS_PREFIXES = ("send", "edit", "copy", "forward")
+    NON_IDEMPOTENT_ENDPOINTS_PREFIXES = ("send", "copy", "forward")
+
+    def __init__(self, global_rate: float, per_chat_interval: float, max_retries: int):
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._per_chat_interval = per_chat_interval
+        self._max_retries = max_retries
+        self._chat_locks: Dict[Any, asyncio.Lock] = {}
+        self._chat_waiters: Dict[Any, int] = {}
+        self._chat_last_sent: Dict[Any, float] = {}
+        self._paused_until = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self._chat_waiters.values())
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+        self._chat_waiters.clear()
+
+    async def _call_with_retries(self, callback, args, kwargs, endpoint: str, chat_id):
+        for attempt in range(self._max_retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._bucket.acquire()
+            if chat_id is not None:
+                wait = self._chat_last_sent.get(chat_id, 0.0) + self._per_chat_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after + 0.1)
+                logger.warning(f"Telegram RetryAfter {retry_after} с для {endpoint} (чат {chat_id}), попытка {attempt + 1}")
+                if attempt == self._max_retries:
+                    raise
+            except (BadRequest, Forbidden):
+                raise
+            except NetworkError as e:
+                if isinstance(e, TimedOut) and endpoint.startswith(self.NON_IDEMPOTENT_ENDPOINTS_PREFIXES):
+                    raise
+                logger.warning(f"Сетевая ошибка Telegram для {endpoint} (чат {chat_id}), попытка {attempt + 1}: {e}")
+                if attempt == self._max_retries:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+            finally:
+                if chat_id is not None:
+                    self._chat_last_sent[chat_id] = time.monotonic()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id") if endpoint.startswith(self.PACED_ENDPOINTS_PREFIXES) else None
+        if chat_id is None:
+            return await self._call_with_retries(callback, args, kwargs, endpoint, None)
+
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                return await self._call_with_retries(callback, args, kwargs, endpoint, chat_id)
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if self._chat_waiters[chat_id] == 0:
+                del self._chat_waiters[chat_id]
+                self._chat_locks.pop(chat_id, None)
+                if time.monotonic() - self._chat_last_sent.get(chat_id, 0.0) > self._per_chat_interval:
+                    self._chat_last_sent.pop(chat_id, None)
+
+outbound_rate_limiter = OutboundRateLimiter(CONFIG["TELEGRAM_GLOBAL_RATE"], CONFIG["TELEGRAM_PER_CHAT_INTERVAL"], CONFIG["TELEGRAM_SEND_MAX_RETRIES"])
+
+async def send_long_message(chat_id: int, message: str, bot_instance, progress: Optional[Dict[str, int]] = None):
+    # Паузы между частями и повторы при RetryAfter обеспечивает OutboundRateLimiter.
+    # progress["parts_sent"] - сколько частей уже доставлено: отправка начинается с этой части и
+    # обновляет счетчик после каждой успешной, чтобы при ошибке вызывающий мог дослать остаток.
+    if progress is None:
+        progress = {}
     parts = [message[i:i + CONFIG["MAX_MESSAGE_LENGTH"]] for i in range(0, len(message), CONFIG["MAX_MESSAGE_LENGTH"])]
-    for part_idx, part in enumerate(parts):
+    for part_idx in range(progress.setdefault("parts_sent", 0), len(parts)):
+        part = parts[part_idx]
         if part.strip():
             try:
-                await bot_instance.send_message(chat_id=chat_id, text=part)
-                if part_idx < len(parts) - 1:
-                    await asyncio.sleep(1.5)
+                chunk_started = time.monotonic()
+                with tracer.span("telegram.send_chunk", part=part_idx + 1, parts=len(parts), chars=len(part)):
+                    await bot_instance.send_message(chat_id=chat_id, text=part)
+                METRIC_SEND_CHUNK_SECONDS.observe(time.monotonic() - chunk_started)
             except Exception as e:
-                logger.error(f"Ошибка отправки части сообщения пользователю {chat_id}: {e}")
+                logger.error(f"Ошибка отправки части {part_idx + 1}/{len(parts)} сообщения пользователю {chat_id}: {e}")
+                raise
+        progress["parts_sent"] = part_idx + 1
 
 async def send_admin_notification(context: ContextTypes.DEFAULT_TYPE, message: str, critical: bool = False):
     full_message = f"🔔 Уведомление Бота Замиры ({'КРИТИЧЕСКАЯ ОШИБКА 🆘' if critical else 'Инфо'}) 🔔\n{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n{message}"
@@ -402,53 +2413,688 @@ async def safe_edit_message_text(bot, chat_id, message_id, text, reply_markup=No
             return False
         raise
 
+# --- Параллельная обработка обновлений ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно,
+    # обновления одного пользователя - строго по очереди (состояния ConversationHandler).
+    __slots__ = ("_user_locks", "_user_waiters")
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_waiters: Dict[int, int] = {}
+
+    @staticmethod
+    def _get_update_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine) -> None:
+        # Сначала очередь пользователя, затем общий слот: обновления, ждущие своей очереди, не занимают
+        # слоты MAX_CONCURRENT_UPDATES, и один активный пользователь не блокирует остальных.
+        key = self._get_update_key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        lock = self._user_locks.setdefault(key, asyncio.Lock())
+        self._user_waiters[key] = self._user_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            self._user_waiters[key] -= 1
+            if self._user_waiters[key] == 0:
+                del self._user_waiters[key]
+                self._user_locks.pop(key, None)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # Поля контекста логов, заданные обработчиками обновления (touch_conversation_activity), сбрасываются по его завершении.
+        with log_fields():
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._user_locks.clear()
+        self._user_waiters.clear()
+
 # --- Callbacks для JobQueue ---
 async def main_service_job(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
+    observe_job_lag(context, "main")
+    job_id: str = context.job.data["job_id"]
+    job_data = await asyncio.to_thread(job_store.get_payload, job_id)
+    if job_data is None:
+        logger.warning(f"main_service_job: задача {job_id} не найдена в хранилище, пропускаю")
+        return
     user_id: int = job_data["user_id"]
     result: str = job_data["result"]
     service_type: str = job_data["service_type"]
     user_name_for_log = job_data.get("user_name_for_log", str(user_id))
+    request_id = job_data.get("request_id")
 
     service_type_rus_map = {"tarot": "расклад Таро", "matrix": "разбор Матрицы Судьбы"}
     service_type_rus = service_type_rus_map.get(service_type, "услугу")
 
-    logger.info(f"Выполняю отложенную задачу ({service_type_rus}) для {user_name_for_log} ({user_id})")
-    try:
-        cleaned_result = clean_text(result)
-        await send_long_message(user_id, cleaned_result, context.bot)
+    # Дослать остаток после частичной доставки может только эта же задача: заявка уже в статусе delivering.
+    progress = {"parts_sent": job_data.get("parts_sent", 0)}
+    allowed_from = ("delivering",) if progress["parts_sent"] else ("scheduled",)
+    if request_id and not await asyncio.to_thread(submission_registry.transition, request_id, "delivering", allowed_from):
+        logger.warning(f"Доставка заявки {request_id} пользователю {user_id} уже выполнялась, повтор пропущен")
+        await asyncio.to_thread(job_store.remove, job_id)
+        return
 
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("👍 Да, доволен(льна)", callback_data=f"satisfaction_yes_{service_type}")],
-            [InlineKeyboardButton("👎 Нет, не совсем", callback_data=f"satisfaction_no_{service_type}")],
-        ])
-        await context.bot.send_message(user_id, clean_text(SATISFACTION_PROMPT_TEXT.format(service_type_rus=service_type_rus)), reply_markup=keyboard)
+    with log_fields(user_id=user_id, service=service_type, request_id=request_id), \
+            tracer.span("delivery", trace_id=job_data.get("trace_id"), user_id=user_id, request_id=request_id or "", service=service_type):
+        logger.info(f"Выполняю отложенную задачу ({service_type_rus}) для {user_name_for_log} ({user_id})")
+        keep_job = False
+        try:
+            cleaned_result = clean_text(result)
+            await send_long_message(user_id, cleaned_result, context.bot, progress)
 
-        completed_users.add(user_id)
-        save_completed_users(completed_users)
-        logger.info(f"Пользователь {user_name_for_log} ({user_id}) успешно получил {service_type_rus} и добавлен в completed_users.")
-        await send_admin_notification(context, f"✅ Пользователь {user_name_for_log} (ID: {user_id}) успешно получил {service_type_rus}.")
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("👍 Да, доволен(льна)", callback_data=f"satisfaction_yes_{service_type}")],
+                [InlineKeyboardButton("👎 Нет, не совсем", callback_data=f"satisfaction_no_{service_type}")],
+            ])
+            await context.bot.send_message(user_id, clean_text(SATISFACTION_PROMPT_TEXT.format(service_type_rus=service_type_rus)), reply_markup=keyboard)
 
-    except Exception as e:
-        error_message = f"Критическая ошибка в main_service_job для пользователя {user_name_for_log} ({user_id}): {e}"
-        logger.error(error_message, exc_info=True)
+            completed_users.add(user_id)
+            await asyncio.to_thread(completed_users_store.add, user_id)
+            METRIC_FUNNEL_TOTAL.inc("delivered", service_type)
+            if request_id:
+                await asyncio.to_thread(submission_registry.transition, request_id, "delivered", ("delivering",))
+            logger.info(f"Пользователь {user_name_for_log} ({user_id}) успешно получил {service_type_rus} и добавлен в completed_users.")
+            await send_admin_notification(context, f"✅ Пользователь {user_name_for_log} (ID: {user_id}) успешно получил {service_type_rus}.")
+
+        except Exception as e:
+            if progress["parts_sent"]:
+                # Пользователь уже получил начало ответа: заявку не сбрасываем (иначе возможна повторная заявка),
+                # а досылаем остаток с сохраненной позиции.
+                keep_job = await retry_partial_delivery(context, job_id, job_data, progress["parts_sent"], e)
+                return
+            error_message = f"Критическая ошибка в main_service_job для пользователя {user_name_for_log} ({user_id}): {e}"
+            logger.error(error_message, exc_info=True)
+            await send_admin_notification(context, error_message, critical=True)
+            try:
+                await context.bot.send_message(user_id, clean_text("К сожалению, при подготовке вашего ответа произошла серьезная ошибка. Администратор уже уведомлен. Пожалуйста, свяжитесь с @zamira_esoteric для уточнения деталей."))
+            except Exception as e_nested:
+                logger.error(f"Не удалось отправить сообщение об ошибке в main_service_job пользователю {user_id}: {e_nested}")
+            if request_id:
+                await asyncio.to_thread(submission_registry.discard, request_id)
+        finally:
+            if not keep_job:
+                await asyncio.to_thread(job_store.remove, job_id)
+
+async def retry_partial_delivery(context: ContextTypes.DEFAULT_TYPE, job_id: str, job_data: Dict[str, Any], parts_sent: int,
+                                 error: Exception) -> bool:
+    # Возвращает True, если задача перепланирована и должна остаться в хранилище.
+    user_id = job_data["user_id"]
+    attempts = job_data.get("delivery_attempts", 0) + 1
+    if isinstance(error, Forbidden) or attempts >= CONFIG["DELIVERY_MAX_ATTEMPTS"]:
+        error_message = (f"Доставка заявки {job_data.get('request_id')} пользователю {user_id} прервана после {parts_sent} частей "
+                         f"(попыток: {attempts}): {error}. Остаток нужно отправить вручную.")
+        logger.error(error_message, exc_info=error)
         await send_admin_notification(context, error_message, critical=True)
-        try:
-            await context.bot.send_message(user_id, clean_text("К сожалению, при подготовке вашего ответа произошла серьезная ошибка. Администратор уже уведомлен. Пожалуйста, свяжитесь с @zamira_esoteric для уточнения деталей."))
-        except Exception as e_nested:
-            logger.error(f"Не удалось отправить сообщение об ошибке в main_service_job пользователю {user_id}: {e_nested}")
+        return False
+    run_at = time.time() + CONFIG["DELIVERY_RETRY_DELAY"]
+    await asyncio.to_thread(job_store.reschedule, job_id, run_at, {**job_data, "parts_sent": parts_sent, "delivery_attempts": attempts})
+    context.job_queue.run_once(main_service_job, CONFIG["DELIVERY_RETRY_DELAY"], data={"job_id": job_id, "due_at": run_at},
+                               name=f"{PERSISTENT_JOBS['main'][1]}{user_id}")
+    logger.warning(f"Доставка пользователю {user_id} прервана после {parts_sent} частей: {error}. "
+                   f"Остаток будет отправлен через {CONFIG['DELIVERY_RETRY_DELAY']} с (попытка {attempts + 1})")
+    return True
 
 async def review_request_job(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
+    observe_job_lag(context, "review")
+    job_id: str = context.job.data["job_id"]
+    job_data = await asyncio.to_thread(job_store.get_payload, job_id)
+    if job_data is None:
+        logger.warning(f"review_request_job: задача {job_id} не найдена в хранилище, пропускаю")
+        return
     user_id: int = job_data["user_id"]
     service_type: str = job_data["service_type"]
     service_type_rus_map = {"tarot": "расклад Таро", "matrix": "разбор Матрицы Судьбы"}
     service_type_rus = service_type_rus_map.get(service_type, "услугу")
-    logger.info(f"Отправка отложенного запроса на отзыв пользователю {user_id} для {service_type_rus}")
+    with log_fields(user_id=user_id, service=service_type), \
+            tracer.span("review_request", trace_id=job_data.get("trace_id"), user_id=user_id, service=service_type):
+        logger.info(f"Отправка отложенного запроса на отзыв пользователю {user_id} для {service_type_rus}")
+        try:
+            await context.bot.send_message(user_id, clean_text(REVIEW_TEXT_DELAYED.format(service_type_rus=service_type_rus)))
+        except Exception as e:
+            logger.error(f"Ошибка при отправке запроса на отзыв пользователю {user_id}: {e}", exc_info=True)
+        finally:
+            await asyncio.to_thread(job_store.remove, job_id)
+
+PERSISTENT_JOBS = {
+    "main": (main_service_job, "main_job_"),
+    "review": (review_request_job, "review_req_job_"),
+}
+
+async def schedule_persistent_job(job_queue, kind: str, delay_seconds: float, payload: Dict[str, Any]) -> Optional[str]:
+    callback, name_prefix = PERSISTENT_JOBS[kind]
+    user_id = payload["user_id"]
+    job_name = f"{name_prefix}{user_id}"
+    if job_queue.get_jobs_by_name(job_name):
+        logger.warning(f"Задача {job_name} уже запланирована, дубликат не создаю")
+        return None
+    due_at = time.time() + delay_seconds
+    job_id = await asyncio.to_thread(job_store.add, kind, user_id, due_at, payload)
+    job_queue.run_once(callback, delay_seconds, data={"job_id": job_id, "due_at": due_at}, name=job_name)
+    return job_id
+
+def rehydrate_persistent_jobs(job_queue) -> Tuple[int, int]:
+    now = time.time()
+    restored, dropped, overdue = 0, 0, 0
+    for job_id, kind, user_id, run_at in job_store.pending():
+        if kind not in PERSISTENT_JOBS:
+            logger.warning(f"Неизвестный тип отложенной задачи {kind} ({job_id}), удаляю")
+            job_store.remove(job_id)
+            dropped += 1
+            continue
+        delay = run_at - now
+        if delay <= 0:
+            # Политика догоняния: просроченные отзывы старше REVIEW_REQUEST_MAX_LATENESS отбрасываем,
+            # остальные просроченные задачи выполняем сразу, разнося по времени, чтобы не упереться в лимиты Telegram.
+            if kind == "review" and -delay > CONFIG["REVIEW_REQUEST_MAX_LATENESS"]:
+                job_store.remove(job_id)
+                dropped += 1
+                continue
+            delay = overdue * CONFIG["JOB_CATCHUP_SPACING_SECONDS"]
+            overdue += 1
+        callback, name_prefix = PERSISTENT_JOBS[kind]
+        # due_at - сохраненный срок, а не время догоняния: задержка из-за перезапуска должна попасть в zamira_job_lag_seconds.
+        job_queue.run_once(callback, delay, data={"job_id": job_id, "due_at": run_at}, name=f"{name_prefix}{user_id}")
+        restored += 1
+    logger.info(f"Восстановлено отложенных задач: {restored} (просроченных: {overdue}), отброшено: {dropped}")
+    return restored, dropped
+
+# --- Воркеры генерации ---
+generation_wakeup = asyncio.Event()
+generation_worker_tasks: List[asyncio.Task] = []
+
+class DeadlinePacer:
+    # Срок генерации заявки = время доставки - GENERATION_SAFETY_MARGIN. Заявки берутся по ближайшему сроку (EDF),
+    # а старты разносятся с минимальной частотой, при которой все сроки выполнимы. Если OpenAI недогружен
+    # (утилизация ниже GENERATION_IDLE_UTILIZATION), работа берется сразу, с опережением.
+    def __init__(self):
+        self.last_start = 0.0
+        self.history: deque = deque(maxlen=500)  # (slack, lateness) по завершенным генерациям
+
+    @staticmethod
+    def deadline(deliver_at: float) -> float:
+        return deliver_at - CONFIG["GENERATION_SAFETY_MARGIN"]
+
+    def required_rate(self, deliver_times: List[float], now: float) -> float:
+        rate = 0.0
+        for position, deliver_at in enumerate(sorted(deliver_times), start=1):
+            rate = max(rate, position / max(self.deadline(deliver_at) - now, 1.0))
+        return rate
+
+    def start_delay(self, deliver_times: List[float]) -> float:
+        if not deliver_times or openai_scheduler.utilization() < CONFIG["GENERATION_IDLE_UTILIZATION"]:
+            return 0.0
+        now = time.time()
+        rate = self.required_rate(deliver_times, now)
+        return max(self.last_start + 1.0 / rate - now, 0.0)
+
+    def record_start(self, item: Dict[str, Any]):
+        self.last_start = time.time()
+        item["slack"] = self.deadline(item["deliver_at"]) - self.last_start
+
+    def record_finish(self, item: Dict[str, Any]):
+        lateness = max(time.time() - self.deadline(item["deliver_at"]), 0.0)
+        self.history.append((item["slack"], lateness))
+        logger.info(f"Генерация {item['request_id']}: запас при старте {int(item['slack'])} с, опоздание {int(lateness)} с")
+
+    def summary(self) -> Optional[Dict[str, float]]:
+        if not self.history:
+            return None
+        slacks = [slack for slack, _ in self.history]
+        late = [lateness for _, lateness in self.history if lateness > 0]
+        return {"count": len(self.history), "min_slack": min(slacks), "avg_slack": sum(slacks) / len(slacks),
+                "late_count": len(late), "max_lateness": max(late, default=0.0)}
+
+deadline_pacer = DeadlinePacer()
+
+async def process_generation_item(context: ContextTypes.DEFAULT_TYPE, item: Dict[str, Any]) -> bool:
+    request_id = item["request_id"]
+    user_id = item["user_id"]
+    service_type = item["service_type"]
+    system_prompt_template = PROMPT_TAROT_SYSTEM if service_type == "tarot" else PROMPT_MATRIX_SYSTEM
+    await asyncio.to_thread(submission_registry.transition, request_id, "generating", ("queued", "generating"))
+
+    cached_result = await lookup_cached_result(item)
+    if cached_result is not None:
+        logger.info(f"Генерация {request_id} для {user_id}: результат взят из кэша")
+        await hand_off_generated_result(context, item, cached_result)
+        return True
+
+    speculative_result = await speculative_generator.take(user_id, item.get("speculation_key"))
+    if speculative_result is not None:
+        logger.info(f"Генерация {request_id} для {user_id}: использована спекулятивная заготовка")
+        await hand_off_generated_result(context, item, speculative_result)
+        return True
+
+    unavailable_until = model_router.unavailable_until(service_type)
+    if unavailable_until is not None:
+        # Пока все модели цепочки недоступны, заявка ждет в очереди, не расходуя попыток.
+        await asyncio.to_thread(generation_queue.retry_later, request_id, unavailable_until, True)
+        return False
+
+    usage: Dict[str, Any] = {}
+    try:
+        result = await ask_gpt(system_prompt_template, item["user_prompt"], item["max_tokens"], context, user_id, service_type=service_type,
+                               attempt=item["attempts"], usage_sink=usage)
+    except CircuitOpenError as e:
+        await asyncio.to_thread(generation_queue.retry_later, request_id, e.retry_at, True)
+        return False
+
+    if result is None:
+        await retry_or_drop_generation(context, item)
+        return False
+
+    await hand_off_generated_result(context, item, result, usage.get("model"))
+    return True
+
+async def retry_or_drop_generation(context: ContextTypes.DEFAULT_TYPE, item: Dict[str, Any]):
+    # Неудачная попытка: повтор через GENERATION_RETRY_DELAY, после GENERATION_MAX_ATTEMPTS - снятие заявки с уведомлением.
+    request_id = item["request_id"]
+    user_id = item["user_id"]
+    if item["attempts"] < CONFIG["GENERATION_MAX_ATTEMPTS"]:
+        logger.warning(f"Генерация {request_id} для {user_id} не удалась (попытка {item['attempts']}), повтор через {CONFIG['GENERATION_RETRY_DELAY']} с")
+        await asyncio.to_thread(generation_queue.retry_later, request_id, time.time() + CONFIG["GENERATION_RETRY_DELAY"])
+        return
+    await asyncio.to_thread(generation_queue.complete, request_id)
+    await asyncio.to_thread(submission_registry.discard, request_id)
+    await send_admin_notification(context, f"❌ Генерация для {item['user_name_for_log']} (ID: {user_id}, {item['service_type']}) не удалась после {item['attempts']} попыток. Заявка снята.", critical=True)
     try:
-        await context.bot.send_message(user_id, clean_text(REVIEW_TEXT_DELAYED.format(service_type_rus=service_type_rus)))
+        await context.bot.send_message(user_id, clean_text(GENERATION_FAILED_TEXT))
     except Exception as e:
-        logger.error(f"Ошибка при отправке запроса на отзыв пользователю {user_id}: {e}", exc_info=True)
+        logger.error(f"Не удалось сообщить пользователю {user_id} об ошибке генерации: {e}")
+
+def result_cache_key(item: Dict[str, Any], model: str) -> Optional[Tuple[str, float]]:
+    if not CONFIG["RESULT_CACHE_ENABLED"] or not item.get("cache_inputs"):
+        return None
+    system_prompt_template = PROMPT_TAROT_SYSTEM if item["service_type"] == "tarot" else PROMPT_MATRIX_SYSTEM
+    prompt_version = hashlib.sha256(f"{model}\x1f{system_prompt_template}".encode("utf-8")).hexdigest()[:16]
+    window_start, window_end = get_forecast_window(datetime.now())
+    return ResultCache.make_key(item["service_type"], item["cache_inputs"], prompt_version, window_start), window_end.timestamp()
+
+async def lookup_cached_result(item: Dict[str, Any]) -> Optional[str]:
+    # Из кэша выдаются только разборы основной модели цепочки.
+    cache_key = result_cache_key(item, model_router.models(item["service_type"])[0])
+    if cache_key is None or item.get("bypass_cache"):
+        return None
+    return await asyncio.to_thread(result_cache.get, cache_key[0])
+
+async def hand_off_generated_result(context: ContextTypes.DEFAULT_TYPE, item: Dict[str, Any], result: str, model: Optional[str] = None):
+    # model - модель, которая на самом деле дала ответ (None для результата из кэша или спекулятивной заготовки).
+    # Ответ запасной модели в кэш не кладется, чтобы следующие пользователи не получали его под ключом основной.
+    user_id = item["user_id"]
+    cache_key = result_cache_key(item, model) if model == model_router.models(item["service_type"])[0] else None
+    if cache_key is not None:
+        await asyncio.to_thread(result_cache.put, cache_key[0], result, cache_key[1])
+    if not await asyncio.to_thread(submission_registry.transition, item["request_id"], "scheduled", ("queued", "generating")):
+        logger.warning(f"Заявка {item['request_id']} для {user_id} уже запланирована или снята, повторную доставку не планирую")
+        await asyncio.to_thread(generation_queue.complete, item["request_id"])
+        return
+    job_payload = {"user_id": user_id, "result": result, "service_type": item["service_type"], "user_name_for_log": item["user_name_for_log"],
+                   "request_id": item["request_id"], "trace_id": item.get("trace_id")}
+    delay = max(item["deliver_at"] - time.time(), 0)
+    await schedule_persistent_job(context.job_queue, "main", delay, job_payload)
+    await asyncio.to_thread(generation_queue.complete, item["request_id"])
+    logger.info(f"Генерация {item['request_id']} для {item['user_name_for_log']} ({user_id}) ({item['service_type']}) готова, доставка через {int(delay)} с.")
+
+async def generation_worker(application, worker_idx: int):
+    context = CallbackContext(application)
+    while True:
+        try:
+            deliver_times = await asyncio.to_thread(generation_queue.ready_deliver_times)
+            delay = deadline_pacer.start_delay(deliver_times)
+            if delay > 0:
+                await asyncio.sleep(min(delay, 5))
+                continue
+            deadline_pacer.last_start = time.time()
+            item = await asyncio.to_thread(generation_queue.claim)
+        except Exception as e:
+            logger.error(f"Воркер генерации {worker_idx}: ошибка чтения очереди: {e}", exc_info=True)
+            item = None
+        if item is None:
+            generation_wakeup.clear()
+            try:
+                await asyncio.wait_for(generation_wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        deadline_pacer.record_start(item)
+        try:
+            with log_fields(user_id=item["user_id"], service=item["service_type"], request_id=item["request_id"]), \
+                    tracer.span("generation", trace_id=item.get("trace_id"), user_id=item["user_id"], service=item["service_type"],
+                                request_id=item["request_id"], attempt=item["attempts"]) as span_attributes:
+                processed = await process_generation_item(context, item)
+                span_attributes["completed"] = processed
+            if processed:
+                deadline_pacer.record_finish(item)
+        except Exception as e:
+            logger.error(f"Воркер генерации {worker_idx}: ошибка обработки {item['request_id']}: {e}", exc_info=True)
+            try:
+                await retry_or_drop_generation(context, item)
+            except Exception as e_nested:
+                logger.error(f"Воркер генерации {worker_idx}: не удалось вернуть {item['request_id']} в очередь: {e_nested}", exc_info=True)
+
+# --- Пакетная генерация (OpenAI Batch API) ---
+# Сколько заявок ушло в пакеты, сколько из них получено из пакета, а сколько пришлось генерировать синхронно
+# (пакет не успел к сроку, завершился ошибкой или не вернул результат) - по этой доле видно, окупается ли пакетный режим.
+batch_stats: Dict[str, int] = {"submitted": 0, "completed": 0, "to_sync": 0}
+
+class OpenAIBatchBackend:
+    # client.batches появился в openai 1.16; с закрепленной openai 1.12 тот же эндпоинт вызывается напрямую.
+    async def submit(self, jsonl: bytes) -> str:
+        file_obj = await openai_client.files.create(file=("zamira_batch.jsonl", jsonl), purpose="batch")
+        batches = getattr(openai_client, "batches", None)
+        if batches is not None:
+            batch = await batches.create(input_file_id=file_obj.id, endpoint="/v1/chat/completions", completion_window="24h")
+            return batch.id
+        batch = await openai_client.post(
+            "/batches",
+            body={"input_file_id": file_obj.id, "endpoint": "/v1/chat/completions", "completion_window": "24h"},
+            cast_to=object,
+        )
+        return batch["id"]
+
+    async def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        batches = getattr(openai_client, "batches", None)
+        if batches is not None:
+            batch = await batches.retrieve(batch_id)
+            return {"id": batch.id, "status": batch.status, "output_file_id": batch.output_file_id}
+        return await openai_client.get(f"/batches/{batch_id}", cast_to=object)
+
+    async def download(self, file_id: str) -> bytes:
+        return (await openai_client.files.content(file_id)).content
+
+batch_backend = OpenAIBatchBackend()
+
+async def record_batch_usage(service_type: str, body: Dict[str, Any]):
+    # Пакетные вызовы учитываются так же, как синхронные: по полю usage ответа, с назначением "batch".
+    usage = body.get("usage") or {}
+    if not usage:
+        return
+    try:
+        await asyncio.to_thread(usage_store.record, service_type, model_router.models(service_type)[0], "batch",
+                                usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    except Exception as e:
+        logger.error(f"Не удалось записать расход токенов пакета: {e}")
+
+def build_batch_jsonl(items: List[Dict[str, Any]]) -> bytes:
+    lines = []
+    for item in items:
+        system_prompt_template = PROMPT_TAROT_SYSTEM if item["service_type"] == "tarot" else PROMPT_MATRIX_SYSTEM
+        body = {
+            "model": model_router.models(item["service_type"])[0],
+            "messages": [
+                {"role": "system", "content": render_system_prompt(system_prompt_template)},
+                {"role": "user", "content": item["user_prompt"]},
+            ],
+            "temperature": 0.75,
+            "max_tokens": item["max_tokens"],
+        }
+        # custom_id несет и тип услуги: расход записывается даже для заявок, которые к приходу результата уже ушли в синхронный режим.
+        custom_id = f"{item['request_id']}:{item['service_type']}"
+        lines.append(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False))
+    return "\n".join(lines).encode("utf-8")
+
+async def submit_pending_batch(application):
+    items = await asyncio.to_thread(generation_queue.claim_for_batch, CONFIG["OPENAI_BATCH_MAX_REQUESTS"])
+    if not items:
+        return
+    now = time.time()
+    late = [item["request_id"] for item in items if item["deliver_at"] - now < CONFIG["OPENAI_BATCH_SYNC_MARGIN"]]
+    items = [item for item in items if item["request_id"] not in late]
+    if late:
+        await asyncio.to_thread(generation_queue.to_sync, late)
+        batch_stats["to_sync"] += len(late)
+        generation_wakeup.set()
+    if not items:
+        return
+    context = CallbackContext(application)
+    uncached_items = []
+    for item in items:
+        cached_result = await lookup_cached_result(item)
+        if cached_result is not None:
+            await hand_off_generated_result(context, item, cached_result)
+        else:
+            uncached_items.append(item)
+    items = uncached_items
+    if not items:
+        return
+    request_ids = [item["request_id"] for item in items]
+    try:
+        batch_id = await batch_backend.submit(build_batch_jsonl(items))
+    except Exception as e:
+        logger.error(f"Не удалось отправить пакет из {len(items)} заявок, перевожу в синхронный режим: {e}", exc_info=True)
+        await asyncio.to_thread(generation_queue.to_sync, request_ids)
+        batch_stats["to_sync"] += len(request_ids)
+        generation_wakeup.set()
+        return
+    await asyncio.to_thread(generation_queue.record_batch, batch_id, request_ids)
+    batch_stats["submitted"] += len(request_ids)
+    logger.info(f"Отправлен пакет {batch_id} из {len(items)} заявок")
+
+async def poll_open_batch(context: ContextTypes.DEFAULT_TYPE, batch_id: str):
+    members = await asyncio.to_thread(generation_queue.batch_members, batch_id)
+    if not members:
+        await asyncio.to_thread(generation_queue.close_batch, batch_id)
+        return
+    try:
+        batch = await batch_backend.retrieve(batch_id)
+    except Exception as e:
+        logger.warning(f"Не удалось получить статус пакета {batch_id}: {e}")
+        batch = {"status": "unknown"}
+
+    status = batch.get("status")
+    if status == "completed" and batch.get("output_file_id"):
+        member_ids = {request_id for request_id, _ in members}
+        output = await batch_backend.download(batch["output_file_id"])
+        delivered = 0
+        for line in output.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            request_id, _, service_type = (record.get("custom_id") or "").partition(":")
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            # Токены потрачены, даже если заявку уже забрал синхронный режим.
+            await record_batch_usage(service_type or "unknown", response.get("body") or {})
+            if request_id not in member_ids:
+                continue
+            item = await asyncio.to_thread(generation_queue.get, request_id)
+            if item is None:
+                continue
+            result = response["body"]["choices"][0]["message"]["content"].strip()
+            await hand_off_generated_result(context, item, result, model_router.models(item["service_type"])[0])
+            member_ids.discard(request_id)
+            delivered += 1
+        batch_stats["completed"] += delivered
+        if member_ids:
+            await asyncio.to_thread(generation_queue.to_sync, list(member_ids))
+            batch_stats["to_sync"] += len(member_ids)
+            generation_wakeup.set()
+        await asyncio.to_thread(generation_queue.close_batch, batch_id)
+        logger.info(f"Пакет {batch_id} завершен: получено {delivered}, в синхронный режим {len(member_ids)}")
+    elif status in ("failed", "expired", "cancelled", "cancelling"):
+        logger.warning(f"Пакет {batch_id} завершился со статусом {status}, перевожу {len(members)} заявок в синхронный режим")
+        await asyncio.to_thread(generation_queue.to_sync, [request_id for request_id, _ in members])
+        batch_stats["to_sync"] += len(members)
+        await asyncio.to_thread(generation_queue.close_batch, batch_id)
+        generation_wakeup.set()
+    else:
+        # Пакет еще выполняется: заявки, которые иначе не успеют к сроку доставки, генерируем синхронно.
+        now = time.time()
+        late = [request_id for request_id, deliver_at in members if deliver_at - now < CONFIG["OPENAI_BATCH_SYNC_MARGIN"]]
+        if late:
+            logger.info(f"Пакет {batch_id}: {len(late)} заявок не успевают к сроку, перевожу в синхронный режим")
+            await asyncio.to_thread(generation_queue.to_sync, late)
+            batch_stats["to_sync"] += len(late)
+            generation_wakeup.set()
+
+async def openai_batch_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await submit_pending_batch(context.application)
+        for batch_id in await asyncio.to_thread(generation_queue.open_batches):
+            await poll_open_batch(context, batch_id)
+    except Exception as e:
+        logger.error(f"Ошибка в openai_batch_job: {e}", exc_info=True)
+
+# --- Диагностика: задержка event loop и сэмплирующий профилировщик ---
+class LoopLagMonitor:
+    # Задача в event loop просыпается каждые LOOP_LAG_INTERVAL секунд и измеряет опоздание (задержку планирования).
+    # Отдельный поток-сторож следит за ее "пульсом": если loop не отвечает дольше LOOP_LAG_STALL_THRESHOLD,
+    # он снимает стек потока event loop прямо во время зависания и пишет его в лог (один раз за зависание).
+    def __init__(self, interval: float, stall_threshold: float):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _tick(self):
+        while True:
+            scheduled = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(now - scheduled, 0.0)
+            self.max_lag = max(self.max_lag, lag)
+            METRIC_LOOP_LAG_SECONDS.observe(lag)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stop.wait(self.interval):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.stall_threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен"
+            logger.warning(f"Event loop заблокирован уже {blocked_for:.2f} с, стек потока loop:\n{stack}")
+
+loop_lag_monitor = LoopLagMonitor(CONFIG["LOOP_LAG_INTERVAL"], CONFIG["LOOP_LAG_STALL_THRESHOLD"])
+
+def frame_label(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+def sample_stacks(seconds: float, interval: float) -> Tuple[Dict[str, int], int]:
+    # Сэмплирующий профилировщик: раз в interval снимает стеки всех потоков (кроме своего) через sys._current_frames()
+    # и считает одинаковые стеки. Результат - collapsed stacks ("поток;f1;f2;f3 N"), вход для flamegraph.pl/speedscope.
+    own_thread_id = threading.get_ident()
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    counts: Dict[str, int] = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            name = thread_names.get(thread_id) or str(thread_id)
+            key = ";".join([name.replace(" ", "_"), *reversed(stack)])
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+profile_lock = asyncio.Lock()
+
+# --- HTTP-эндпоинт /metrics ---
+async def refresh_queue_depth_metrics():
+    METRIC_QUEUE_DEPTH.set(await asyncio.to_thread(generation_queue.depth), "generation")
+    METRIC_QUEUE_DEPTH.set(openai_scheduler.queue_depth, "openai_waiting")
+    METRIC_QUEUE_DEPTH.set(openai_scheduler.in_flight, "openai_in_flight")
+    METRIC_QUEUE_DEPTH.set(outbound_rate_limiter.queue_depth, "telegram_outbound")
+    METRIC_QUEUE_DEPTH.set(len(conversation_sweeper.last_seen), "conversations")
+
+async def handle_metrics_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            await refresh_queue_depth_metrics()
+            body = ("\n".join(line for metric in METRICS for line in metric.render()) + "\n").encode("utf-8")
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, content_type = b"not found\n", "404 Not Found", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Ошибка обработки запроса /metrics: {e}")
+    finally:
+        writer.close()
+
+metrics_server: Optional[asyncio.AbstractServer] = None
+
+async def on_startup(application):
+    global metrics_server
+    loop_lag_monitor.start()
+    if CONFIG["METRICS_PORT"]:
+        metrics_server = await asyncio.start_server(handle_metrics_connection, CONFIG["METRICS_HOST"], CONFIG["METRICS_PORT"])
+        logger.info(f"Метрики доступны на http://{CONFIG['METRICS_HOST']}:{CONFIG['METRICS_PORT']}/metrics")
+    await asyncio.to_thread(destiny_matrix_table.ensure_built)
+    await asyncio.to_thread(rehydrate_persistent_jobs, application.job_queue)
+    requeued = await asyncio.to_thread(generation_queue.requeue_running)
+    if requeued:
+        logger.info(f"Возвращено в очередь генерации незавершенных заявок: {requeued}")
+    for worker_idx in range(CONFIG["GENERATION_WORKERS"]):
+        generation_worker_tasks.append(asyncio.create_task(generation_worker(application, worker_idx)))
+    application.job_queue.run_repeating(conversation_sweep_job, CONFIG["CONVERSATION_SWEEP_INTERVAL"], first=CONFIG["CONVERSATION_SWEEP_INTERVAL"], name="conversation_sweep")
+    if CONFIG["OPENAI_BATCH_MODE"]:
+        application.job_queue.run_repeating(openai_batch_job, CONFIG["OPENAI_BATCH_POLL_INTERVAL"], first=CONFIG["OPENAI_BATCH_POLL_INTERVAL"], name="openai_batch")
+    application.job_queue.run_repeating(completed_users_snapshot_job, CONFIG["COMPLETED_USERS_SNAPSHOT_INTERVAL"],
+                                        first=CONFIG["COMPLETED_USERS_SNAPSHOT_INTERVAL"], name="completed_users_snapshot")
+    application.job_queue.run_repeating(usage_prune_job, 86400, first=3600, name="usage_prune")
+    application.job_queue.run_repeating(trace_flush_job, CONFIG["TRACE_FLUSH_INTERVAL"], first=CONFIG["TRACE_FLUSH_INTERVAL"], name="trace_flush")
+
+async def on_shutdown(application):
+    await loop_lag_monitor.stop()
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    for task in generation_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*generation_worker_tasks, return_exceptions=True)
+    generation_worker_tasks.clear()
+    await flush_traces()
 
 # --- ConversationHandler состояния ---
 (CHOOSE_SERVICE,
@@ -460,6 +3106,142 @@ async def review_request_job(context: ContextTypes.DEFAULT_TYPE):
 CANCEL_CALLBACK_DATA = "cancel_conv_inline"
 EDIT_PREFIX_TAROT = "edit_field_tarot_"
 
+CONVERSATION_STATE_NAMES = {
+    CHOOSE_SERVICE: "CHOOSE_SERVICE",
+    ASK_MATRIX_NAME: "ASK_MATRIX_NAME", ASK_MATRIX_DOB: "ASK_MATRIX_DOB", CONFIRM_MATRIX_DATA: "CONFIRM_MATRIX_DATA",
+    ASK_TAROT_MAIN_PERSON_NAME: "ASK_TAROT_MAIN_PERSON_NAME", ASK_TAROT_MAIN_PERSON_DOB: "ASK_TAROT_MAIN_PERSON_DOB",
+    ASK_TAROT_BACKSTORY: "ASK_TAROT_BACKSTORY", ASK_TAROT_OTHER_PEOPLE: "ASK_TAROT_OTHER_PEOPLE", ASK_TAROT_QUESTIONS: "ASK_TAROT_QUESTIONS",
+    SHOW_TAROT_CONFIRM_OPTIONS: "SHOW_TAROT_CONFIRM_OPTIONS",
+}
+
+# --- Очистка брошенных диалогов ---
+class ConversationSweeper:
+    # Закрывает диалоги, простоявшие дольше таймаута своего состояния (CONVERSATION_STATE_TIMEOUTS),
+    # и самые давние диалоги сверх CONVERSATION_MAX_ACTIVE (LRU), освобождая их user_data.
+    # Встроенный conversation_timeout задает один таймаут на все состояния и не ограничивает число диалогов,
+    # поэтому используются приватные ConversationHandler._conversations/_update_state (PTB закреплена в requirements.txt,
+    # tests/test_conversation_sweeper.py падает, если они исчезнут). Обращения к ним - только в этом классе.
+    PTB_PRIVATE_ATTRIBUTES = ("_conversations", "_update_state")
+
+    def __init__(self):
+        self.conv_handler: Optional[ConversationHandler] = None
+        self.last_seen: "OrderedDict[int, float]" = OrderedDict()
+        self.total_evicted = 0
+        self.total_bytes_reclaimed = 0
+
+    def attach(self, conv_handler: ConversationHandler):
+        missing = [name for name in self.PTB_PRIVATE_ATTRIBUTES if not hasattr(conv_handler, name)]
+        if missing:
+            raise RuntimeError(f"ConversationHandler этой версии python-telegram-bot не содержит {', '.join(missing)}: очистка диалогов невозможна")
+        self.conv_handler = conv_handler
+
+    def current_state(self, chat_id: int, user_id: int) -> object:
+        if self.conv_handler is None:
+            return None
+        return self.conv_handler._conversations.get((chat_id, user_id))
+
+    def touch(self, user_id: int):
+        self.last_seen[user_id] = time.time()
+        self.last_seen.move_to_end(user_id)
+
+    @staticmethod
+    def state_timeout(state: object) -> float:
+        state_name = CONVERSATION_STATE_NAMES.get(state)
+        return CONFIG["CONVERSATION_STATE_TIMEOUTS"].get(state_name, CONFIG["CONVERSATION_DEFAULT_TIMEOUT"])
+
+    def find_stale(self, conversations: Dict[Tuple[int, ...], object]) -> List[Tuple[Tuple[int, ...], object]]:
+        now = time.time()
+        active_users = set()
+        stale = []
+        for key, state in list(conversations.items()):
+            if not isinstance(state, int):
+                continue
+            user_id = key[-1]
+            active_users.add(user_id)
+            if user_id not in self.last_seen:
+                # Диалог восстановлен из персистентности после перезапуска: отсчет начинаем с текущего момента.
+                self.last_seen[user_id] = now
+                self.last_seen.move_to_end(user_id, last=False)
+            if now - self.last_seen[user_id] > self.state_timeout(state):
+                stale.append((key, state))
+
+        for user_id in [uid for uid in self.last_seen if uid not in active_users]:
+            del self.last_seen[user_id]
+
+        overflow = len(active_users) - len(stale) - CONFIG["CONVERSATION_MAX_ACTIVE"]
+        if overflow > 0:
+            stale_users = {key[-1] for key, _ in stale}
+            lru_users = set(itertools.islice((uid for uid in self.last_seen if uid not in stale_users), overflow))
+            stale.extend((key, state) for key, state in conversations.items() if key[-1] in lru_users)
+        return stale
+
+    async def sweep(self, context: ContextTypes.DEFAULT_TYPE):
+        if self.conv_handler is None:
+            return
+        stale = self.find_stale(self.conv_handler._conversations)
+        reclaimed_bytes = 0
+        for key, state in stale:
+            user_id = key[-1]
+            user_data = context.application.user_data.get(user_id)
+            if user_data:
+                reclaimed_bytes += len(json.dumps(user_data, ensure_ascii=False, default=str).encode("utf-8"))
+            self.conv_handler._update_state(ConversationHandler.END, key)
+            context.application.drop_user_data(user_id)
+            speculative_generator.invalidate(user_id)
+            self.last_seen.pop(user_id, None)
+            logger.info(f"Диалог пользователя {user_id} закрыт по таймауту (состояние {CONVERSATION_STATE_NAMES.get(state, state)})")
+            if CONFIG["CONVERSATION_EXPIRY_NUDGE"]:
+                try:
+                    await context.bot.send_message(key[0], clean_text(DRAFT_EXPIRED_TEXT))
+                except Exception as e:
+                    logger.warning(f"Не удалось отправить уведомление об истекшем черновике пользователю {user_id}: {e}")
+        if stale:
+            self.total_evicted += len(stale)
+            self.total_bytes_reclaimed += reclaimed_bytes
+            logger.info(f"Очистка диалогов: закрыто {len(stale)}, освобождено ~{reclaimed_bytes} байт user_data")
+
+conversation_sweeper = ConversationSweeper()
+
+# Начало обработки обновления (monotonic, состояние, time_ns): задается в группе -1 и читается в группе
+# HANDLER_TIMING_GROUP той же задачи. Если она не выполнится (исключение, ApplicationHandlerStop), значение
+# пропадает вместе с задачей.
+HANDLER_TIMING_GROUP = 2
+handler_started: ContextVar[Optional[Tuple[float, str, int]]] = ContextVar("handler_started", default=None)
+
+async def touch_conversation_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        conversation_sweeper.touch(update.effective_user.id)
+        state_name = "none"
+        if update.effective_chat:
+            state = conversation_sweeper.current_state(update.effective_chat.id, update.effective_user.id)
+            state_name = CONVERSATION_STATE_NAMES.get(state, "none")
+        handler_started.set((time.monotonic(), state_name, time.time_ns()))
+        # Действует для всех групп обработчиков этого обновления; PerUserUpdateProcessor.do_process_update
+        # восстанавливает прежнее значение после обработки.
+        user_data = context.user_data or {}
+        log_context.set({"user_id": update.effective_user.id, "state": state_name,
+                         "service": user_data.get("service_type"), "trace_id": user_data.get("trace_id")})
+
+async def observe_handler_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Группа HANDLER_TIMING_GROUP: выполняется после ConversationHandler (группа 0) и post_fallback_message (группа 1).
+    started = handler_started.get()
+    handler_started.set(None)
+    if started:
+        METRIC_HANDLER_SECONDS.observe(time.monotonic() - started[0], started[1])
+        trace_id = context.user_data.get("trace_id") if context.user_data is not None else None
+        if trace_id and update.effective_user:
+            # Спан этапа диалога закрывается задним числом: начало зафиксировано в группе -1.
+            with tracer.span(f"handler.{started[1]}", trace_id=trace_id, user_id=update.effective_user.id, start_ns=started[2],
+                             update_kind="callback" if update.callback_query else "message"):
+                pass
+
+async def conversation_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await conversation_sweeper.sweep(context)
+        speculative_generator.evict_expired()
+    except Exception as e:
+        logger.error(f"Ошибка очистки диалогов: {e}", exc_info=True)
+
 # --- Клавиатуры ---
 def get_cancel_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data=CANCEL_CALLBACK_DATA)]])
@@ -487,8 +3269,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text(clean_text(PRIVATE_MESSAGE))
         return ConversationHandler.END
 
+    submission = await asyncio.to_thread(submission_registry.get, user.id)
+    if submission and submission[2] in SubmissionRegistry.ACTIVE_STATUSES:
+        await update.message.reply_text(clean_text(SUBMISSION_IN_PROGRESS_TEXT))
+        return ConversationHandler.END
+
     if context.user_data:
         context.user_data.clear()
+    context.user_data["trace_id"] = Tracer.new_trace_id()
+    speculative_generator.invalidate(user.id)
+    METRIC_FUNNEL_TOTAL.inc("start", "any")
 
     keyboard = [
         [InlineKeyboardButton("🃏 Расклад Таро", callback_data="tarot")],
@@ -649,6 +3439,10 @@ async def ask_tarot_backstory_message(update: Update, context: ContextTypes.DEFA
     if not backstory_input or len(backstory_input.strip()) < min_len:
         await update.message.reply_text(f"Пожалуйста, опишите ситуацию подробнее (не менее {min_len} символов). Это важно для точности расклада.", reply_markup=get_cancel_keyboard())
         return ASK_TAROT_BACKSTORY
+    too_long_error = input_token_limit_error(backstory_input.strip(), "MAX_INPUT_TOKENS_TAROT_BACKSTORY")
+    if too_long_error:
+        await update.message.reply_text(too_long_error, reply_markup=get_cancel_keyboard())
+        return ASK_TAROT_BACKSTORY
 
     user_data["tarot_backstory"] = clean_text(backstory_input.strip())
 
@@ -665,6 +3459,10 @@ async def ask_tarot_other_people_message(update: Update, context: ContextTypes.D
     if not other_people_input or len(other_people_input.strip()) < 2:
         await update.message.reply_text("Пожалуйста, укажите других участников или напишите 'нет', если их нет.", reply_markup=get_cancel_keyboard())
         return ASK_TAROT_OTHER_PEOPLE
+    too_long_error = input_token_limit_error(other_people_input.strip(), "MAX_INPUT_TOKENS_TAROT_OTHER_PEOPLE")
+    if too_long_error:
+        await update.message.reply_text(too_long_error, reply_markup=get_cancel_keyboard())
+        return ASK_TAROT_OTHER_PEOPLE
 
     user_data["tarot_other_people"] = clean_text(other_people_input.strip())
 
@@ -682,6 +3480,10 @@ async def ask_tarot_questions_message(update: Update, context: ContextTypes.DEFA
     if not questions_input or len(questions_input.strip()) < min_len:
         await update.message.reply_text(f"Пожалуйста, сформулируйте ваш вопрос(ы) к картам (не менее {min_len} символов). Если вопросов несколько, напишите их все в одном сообщении.", reply_markup=get_cancel_keyboard())
         return ASK_TAROT_QUESTIONS
+    too_long_error = input_token_limit_error(questions_input.strip(), "MAX_INPUT_TOKENS_TAROT_QUESTION")
+    if too_long_error:
+        await update.message.reply_text(too_long_error, reply_markup=get_cancel_keyboard())
+        return ASK_TAROT_QUESTIONS
 
     user_data["tarot_questions"] = clean_text(questions_input.strip())
     user_data.pop("editing_this_specific_field", None)
@@ -719,6 +3521,10 @@ async def show_tarot_confirm_options_message(update: Update, context: ContextTyp
     if user_data and new_message_with_buttons:
         user_data["tarot_confirm_options_message_id"] = new_message_with_buttons.message_id
 
+    if update.effective_user:
+        user_prompt, max_tokens_val, _ = build_generation_request("tarot", user_data, update.effective_user.id)
+        await speculative_generator.start(update.effective_user.id, user_prompt, max_tokens_val, "tarot")
+
     return SHOW_TAROT_CONFIRM_OPTIONS
 
 async def edit_field_tarot_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -736,6 +3542,7 @@ async def edit_field_tarot_callback(update: Update, context: ContextTypes.DEFAUL
             logger.warning(f"Не удалось удалить сообщение ({query.message.message_id}) с выбором редактирования: {e}")
 
     field_to_edit_key_from_callback = query.data
+    speculative_generator.invalidate(query.from_user.id)
 
     user_data["editing_this_specific_field"] = field_to_edit_key_from_callback
 
@@ -762,6 +3569,43 @@ async def edit_field_tarot_callback(update: Update, context: ContextTypes.DEFAUL
     logger.warning(f"Неизвестное поле для редактирования Таро: {field_to_edit_key_from_callback}")
     return await show_tarot_confirm_options_message(update, context)
 
+def build_generation_request(service_type: str, user_data: Dict[str, Any], user_id: int) -> Tuple[str, int, Dict[str, Any]]:
+    input_for_gpt = ""
+    generation_extra: Dict[str, Any] = {}
+    user_prompt_base_template = ""
+    max_tokens_val = 0
+
+    if service_type == "tarot":
+        input_for_gpt = (
+            f"Основное имя (кверента): {user_data.get('tarot_main_person_name', 'Не указано')}\n"
+            f"Дата рождения (кверента): {user_data.get('tarot_main_person_dob', 'Не указано')}\n"
+            f"Описание ситуации: {user_data.get('tarot_backstory', 'Не указано')}\n"
+            f"Другие участники: {user_data.get('tarot_other_people', 'Не указано')}\n"
+            f"Вопросы к картам: {user_data.get('tarot_questions', 'Не указано')}")
+        user_prompt_base_template = "Данные клиента и его запрос: {input_text}"
+        max_tokens_val = CONFIG["OPENAI_MAX_TOKENS_TAROT"]
+    elif service_type == "matrix":
+        input_for_gpt = (
+            f"Имя: {user_data.get('matrix_name', 'Не указано')}\n"
+            f"Дата рождения: {user_data.get('matrix_dob', 'Не указано')}")
+        destiny_matrix = get_destiny_matrix(user_data.get('matrix_dob', ''))
+        if destiny_matrix:
+            input_for_gpt += "\n\n" + format_destiny_matrix_for_prompt(destiny_matrix)
+        generation_extra = {
+            "cache_inputs": [ResultCache.normalize_name(user_data.get('matrix_name', '')), user_data.get('matrix_dob', '')],
+        }
+        user_prompt_base_template = "Данные клиента: {input_text}"
+        max_tokens_val = CONFIG["OPENAI_MAX_TOKENS_MATRIX"]
+
+    return user_prompt_base_template.format(input_text=input_for_gpt), max_tokens_val, generation_extra
+
+async def end_duplicate_confirmation(query, user_data: Dict[str, Any], user_id: int, request_id: str, submission_status: str) -> int:
+    logger.info(f"Повторное подтверждение от {user_id}: заявка {request_id} уже в статусе {submission_status}")
+    await query.message.reply_text(clean_text(PRIVATE_MESSAGE if submission_status == "delivered" else SUBMISSION_IN_PROGRESS_TEXT))
+    if user_data:
+        user_data.clear()
+    return ConversationHandler.END
+
 async def process_final_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, service_type: str) -> int:
     query = update.callback_query
     await query.answer()
@@ -770,6 +3614,21 @@ async def process_final_confirmation(update: Update, context: ContextTypes.DEFAU
     user_name_for_log = query.from_user.full_name or str(user_id)
     user_data["user_name_for_log"] = user_name_for_log
 
+    # Повторное подтверждение уже принятой заявки не должно получать ответ об исчерпанном бюджете.
+    submission = await asyncio.to_thread(submission_registry.get, user_id)
+    if submission and submission[2] in SubmissionRegistry.ACTIVE_STATUSES + ("delivered",):
+        return await end_duplicate_confirmation(query, user_data, user_id, submission[0], submission[2])
+
+    if await asyncio.to_thread(daily_budget_exceeded, service_type):
+        logger.warning(f"Дневной бюджет токенов ({service_type}) исчерпан, заявка {user_id} не принята")
+        await query.message.reply_text(clean_text(DAILY_LIMIT_REACHED_TEXT))
+        if service_type not in usage_store.budget_alerted:
+            usage_store.budget_alerted.add(service_type)
+            tokens_today = await asyncio.to_thread(usage_store.tokens_today, service_type)
+            await send_admin_notification(context, f"⚠️ Дневной бюджет токенов OpenAI ({service_type}) исчерпан: "
+                                                   f"{tokens_today} токенов. Новые заявки не принимаются до завтра.")
+        return SHOW_TAROT_CONFIRM_OPTIONS if service_type == "tarot" else CONFIRM_MATRIX_DATA
+
     message_id_to_remove_or_edit = user_data.pop("tarot_confirm_options_message_id", None) if service_type == "tarot" else (query.message.message_id if query.message else None)
     response_wait_text = get_random_variant(RESPONSE_WAIT_VARIANTS)
 
@@ -779,39 +3638,43 @@ async def process_final_confirmation(update: Update, context: ContextTypes.DEFAU
     else:
         await query.message.reply_text(clean_text(response_wait_text))
 
-    input_for_gpt = ""
-    system_prompt_template = ""
-    user_prompt_base_template = ""
-    max_tokens_val = 0
-    confirm_text_on_error_template = ""
-    next_confirm_state_on_error = ConversationHandler.END
-
+    final_user_prompt, max_tokens_val, generation_extra = build_generation_request(service_type, user_data, user_id)
+    trace_id = user_data.setdefault("trace_id", Tracer.new_trace_id())
+    generation_extra["trace_id"] = trace_id
     if service_type == "tarot":
-        input_for_gpt = (
-            f"Основное имя (кверента): {user_data.get('tarot_main_person_name', 'Не указано')}\n"
-            f"Дата рождения (кверента): {user_data.get('tarot_main_person_dob', 'Не указано')}\n"
-            f"Описание ситуации: {user_data.get('tarot_backstory', 'Не указано')}\n"
-            f"Другие участники: {user_data.get('tarot_other_people', 'Не указано')}\n"
-            f"Вопросы к картам: {user_data.get('tarot_questions', 'Не указано')}")
-        system_prompt_template = PROMPT_TAROT_SYSTEM
-        user_prompt_base_template = "Данные клиента и его запрос: {input_text}"
-        max_tokens_val = CONFIG["OPENAI_MAX_TOKENS_TAROT"]
         confirm_text_on_error_template = CONFIRM_DETAILS_TAROT_TEXT_DISPLAY
         next_confirm_state_on_error = SHOW_TAROT_CONFIRM_OPTIONS
-    elif service_type == "matrix":
-        input_for_gpt = (
-            f"Имя: {user_data.get('matrix_name', 'Не указано')}\n"
-            f"Дата рождения: {user_data.get('matrix_dob', 'Не указано')}")
-        system_prompt_template = PROMPT_MATRIX_SYSTEM
-        user_prompt_base_template = "Данные клиента: {input_text}"
-        max_tokens_val = CONFIG["OPENAI_MAX_TOKENS_MATRIX"]
+        # Готовую спекулятивную заготовку воркер заберет по ключу промпта.
+        generation_extra["speculation_key"] = SpeculativeGenerator.prompt_key(final_user_prompt)
+    else:
         confirm_text_on_error_template = CONFIRM_DETAILS_MATRIX_TEXT
         next_confirm_state_on_error = CONFIRM_MATRIX_DATA
 
-    final_user_prompt = user_prompt_base_template.format(input_text=input_for_gpt)
-    result = await ask_gpt(system_prompt_template, final_user_prompt, max_tokens_val, context, user_id)
+    deliver_at = time.time() + CONFIG["DELAY_SECONDS_MAIN_SERVICE"]
+    queued = False
+    # Параллельные подтверждения одного пользователя разводит try_register: ключ user_id в submissions уникален,
+    # и новая заявка создается только одна (обновления пользователя к тому же обрабатываются по очереди).
+    try:
+        is_new, request_id, submission_status, bypass_cache = await asyncio.to_thread(submission_registry.try_register, user_id, service_type, trace_id)
+        if not is_new:
+            return await end_duplicate_confirmation(query, user_data, user_id, request_id, submission_status)
+        if bypass_cache:
+            generation_extra["bypass_cache"] = True
+        generation_status = "batch_pending" if CONFIG["OPENAI_BATCH_MODE"] else "pending"
+        try:
+            await asyncio.to_thread(generation_queue.enqueue, user_id, service_type, final_user_prompt, max_tokens_val, user_name_for_log, deliver_at,
+                                    generation_status, generation_extra, request_id)
+        except Exception:
+            await asyncio.to_thread(submission_registry.discard, request_id)
+            raise
+        speculative_generator.record_confirm(user_id, generation_extra.get("speculation_key"))
+        generation_wakeup.set()
+        METRIC_FUNNEL_TOTAL.inc("confirm", service_type)
+        queued = True
+    except Exception as e:
+        logger.error(f"Не удалось поставить заявку пользователя {user_id} в очередь генерации: {e}", exc_info=True)
 
-    if result is None:
+    if not queued:
         await query.message.reply_text(clean_text(OPENAI_ERROR_MESSAGE))
 
         if service_type == "tarot":
@@ -833,15 +3696,12 @@ async def process_final_confirmation(update: Update, context: ContextTypes.DEFAU
         try:
             await query.message.reply_text(text=clean_text(current_confirm_text_on_error), reply_markup=InlineKeyboardMarkup(keyboard_retry_buttons))
         except Exception as e_reply:
-            logger.error(f"Не удалось отправить кнопки повтора после ошибки OpenAI: {e_reply}")
+            logger.error(f"Не удалось отправить кнопки повтора после ошибки постановки в очередь: {e_reply}")
 
         return next_confirm_state_on_error
 
-    job_payload = {"user_id": user_id, "result": result, "service_type": service_type, "user_name_for_log": user_name_for_log}
-    context.job_queue.run_once(main_service_job, CONFIG["DELAY_SECONDS_MAIN_SERVICE"], data=job_payload, name=f"main_job_{user_id}")
-
-    logger.info(f"Заявка пользователя {user_name_for_log} ({user_id}) ({service_type}) принята и запланирована.")
-    await send_admin_notification(context, f"📨 Новая заявка от {user_name_for_log} (ID: {user_id}) на {service_type}. Запланирована.")
+    logger.info(f"Заявка пользователя {user_name_for_log} ({user_id}) ({service_type}) принята и поставлена в очередь генерации.")
+    await send_admin_notification(context, f"📨 Новая заявка от {user_name_for_log} (ID: {user_id}) на {service_type}. Поставлена в очередь генерации.")
     if user_data:
         user_data.clear()
     return ConversationHandler.END
@@ -854,6 +3714,8 @@ async def confirm_tarot_data_callback(update: Update, context: ContextTypes.DEFA
 
 async def common_cancel_logic(update: Update, context: ContextTypes.DEFAULT_TYPE, query: Optional[CallbackQuery] = None) -> int:
     user_data = context.user_data
+    if update.effective_user:
+        speculative_generator.invalidate(update.effective_user.id)
     if user_data:
         user_data.clear()
 
@@ -953,8 +3815,9 @@ async def handle_satisfaction_and_other_callbacks(update: Update, context: Conte
 
         if feedback_type != "skip":
             await query.message.reply_text(clean_text(REVIEW_PROMISE_TEXT))
-            job_payload = {"user_id": user_id, "service_type": service_type}
-            context.job_queue.run_once(review_request_job, CONFIG["DELAY_SECONDS_REVIEW_REQUEST"], data=job_payload, name=f"review_req_job_{user_id}")
+            trace_id = await asyncio.to_thread(submission_registry.trace_id, user_id)
+            job_payload = {"user_id": user_id, "service_type": service_type, "trace_id": trace_id}
+            await schedule_persistent_job(context.job_queue, "review", CONFIG["DELAY_SECONDS_REVIEW_REQUEST"], job_payload)
             logger.info(f"Запланирован запрос отзыва для {user_id} через {CONFIG['DELAY_SECONDS_REVIEW_REQUEST']} секунд после детального фидбека '{feedback_type}'.")
 
 async def post_fallback_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -981,6 +3844,32 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     active_jobs = context.job_queue.jobs() if context.job_queue else []
     pending_main_jobs = sum(1 for job in active_jobs if job.name and job.name.startswith("main_job_"))
     pending_review_jobs = sum(1 for job in active_jobs if job.name and job.name.startswith("review_req_job_"))
+    generation_queue_depth = await asyncio.to_thread(generation_queue.depth)
+    pacing = deadline_pacer.summary()
+    cache_stats = await asyncio.to_thread(result_cache.stats)
+    pacing_line = (f"Запас до срока генерации (мин/сред): {int(pacing['min_slack'])} / {int(pacing['avg_slack'])} с, "
+                   f"опозданий: {pacing['late_count']} из {pacing['count']} (макс. {int(pacing['max_lateness'])} с)\n") if pacing else ""
+    stream_lines = ""
+    for service in ("tarot", "matrix"):
+        stream_summary = stream_stats.summary(service)
+        if stream_summary:
+            stream_lines += (f"Генерация {service}: p50 {stream_summary['p50']:.0f} с, p95 {stream_summary['p95']:.0f} с, "
+                             f"первый токен в среднем через {stream_summary['first_token_avg']:.1f} с, "
+                             f"сэкономлено до ~{stream_summary['tokens_saved']} токенов\n")
+    early_stops_line = ", ".join(f"{key}: {count}" for key, count in sorted(stream_stats.early_stops.items())) or "нет"
+    retry_line = ", ".join(f"{kind}: {count}" for kind, count in sorted(openai_retry_policy.retries.items())) or "нет"
+    circuits_line = "; ".join(f"{c.name}: {c.state} (открывался {c.times_opened} раз, отклонено {c.rejected})"
+                              for c in openai_circuits.values()) or "запросов еще не было"
+    routing_line = "; ".join(
+        f"{service}: дублей {model_router.hedges_started.get(service, 0)} (выиграли {model_router.hedges_won.get(service, 0)}, "
+        f"~{model_router.hedge_tokens.get(service, 0)} токенов), переходов на запасную модель {model_router.fallbacks.get(service, 0)}"
+        for service in CONFIG["OPENAI_MODEL_ROUTES"]
+    )
+
+    batch_finished = batch_stats["completed"] + batch_stats["to_sync"]
+    batch_line = (f"Пакетный режим: отправлено {batch_stats['submitted']}, получено из пакета {batch_stats['completed']}, "
+                  f"сгенерировано синхронно {batch_stats['to_sync']}"
+                  + (f" (из пакета {100 * batch_stats['completed'] / batch_finished:.0f}%)" if batch_finished else "") + "\n") if CONFIG["OPENAI_BATCH_MODE"] else ""
 
     stats_message = (
         f"Статистика Бота Замиры 📊:\n"
@@ -988,11 +3877,101 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Всего выполненных бесплатных услуг: {completed_count}\n"
         f"Активных задач на выполнение услуги: {pending_main_jobs}\n"
         f"Активных задач на отправку запроса отзыва: {pending_review_jobs}\n"
+        f"Заявок в очереди генерации: {generation_queue_depth}\n"
+        f"{pacing_line}"
+        f"Запросов к OpenAI в очереди / в работе: {openai_scheduler.queue_depth} / {openai_scheduler.in_flight}\n"
+        f"Предохранители OpenAI: {circuits_line}\n"
+        f"Маршрутизация моделей: {routing_line}\n"
+        f"{stream_lines}"
+        f"Ранние остановки потока: {early_stops_line}\n"
+        f"Повторы OpenAI: {retry_line}, фатальных ошибок: {openai_retry_policy.fatal_errors}\n"
+        f"{batch_line}"
+        f"Запросов к Telegram в очереди: {outbound_rate_limiter.queue_depth}\n"
+        f"Кэш разборов: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, записей {cache_stats['entries']} (~{cache_stats['bytes']} байт)\n"
+        f"Спекулятивные генерации: запущено {speculative_generator.started}, использовано {speculative_generator.used}, "
+        f"впустую {speculative_generator.wasted} (~{speculative_generator.wasted_tokens} токенов)\n"
+        f"Закрыто брошенных диалогов: {conversation_sweeper.total_evicted} (~{conversation_sweeper.total_bytes_reclaimed} байт)\n"
+        f"Задержка event loop: макс. {loop_lag_monitor.max_lag:.3f} с, зависаний дольше {CONFIG['LOOP_LAG_STALL_THRESHOLD']} с: {loop_lag_monitor.stalls}\n"
         f"----------------------------\n"
         f"Время сервера: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
     await update.message.reply_text(stats_message)
 
+async def admin_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or user.id not in CONFIG["ADMIN_IDS"]:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+
+    args = context.args
+    days = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 1
+    first_day = UsageStore.day_of(time.time() - (days - 1) * 86400)
+    summary = await asyncio.to_thread(usage_store.summary, first_day)
+    budgets = CONFIG["OPENAI_DAILY_TOKEN_BUDGET"]
+
+    lines = [f"Расход токенов OpenAI с {first_day} ({days} дн.) 💰:", "----------------------------"]
+    total_cost = 0.0
+    for service_type, model, purpose, calls, prompt_tokens, completion_tokens in summary["totals"]:
+        cost = estimate_cost_usd(model, prompt_tokens, completion_tokens)
+        total_cost += cost or 0.0
+        cost_text = f"${cost:.2f}" if cost is not None else "цена неизвестна"
+        lines.append(f"{service_type} / {model} / {purpose}: вызовов {calls}, prompt {prompt_tokens}, completion {completion_tokens}, {cost_text}")
+    if not summary["totals"]:
+        lines.append("Вызовов за период не было.")
+    for service_type, max_tokens_key in (("tarot", "OPENAI_MAX_TOKENS_TAROT"), ("matrix", "OPENAI_MAX_TOKENS_MATRIX")):
+        percentiles = summary["percentiles"].get(service_type)
+        if percentiles:
+            lines.append(f"{service_type}: completion p50 ≤ {percentiles[50]}, p95 ≤ {percentiles[95]} токенов (лимит {CONFIG[max_tokens_key]})")
+    lines.append(f"Оценка стоимости за период: ${total_cost:.2f}")
+    lines.append("----------------------------")
+    for budget_key, budget in budgets.items():
+        used_today = await asyncio.to_thread(usage_store.tokens_today, None if budget_key == "total" else budget_key)
+        lines.append(f"Сегодня {budget_key}: {used_today} токенов" + (f" из {budget}" if budget else " (без лимита)"))
+    await update.message.reply_text("\n".join(lines))
+
+async def admin_trace(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or user.id not in CONFIG["ADMIN_IDS"]:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+
+    args = context.args
+    if not args or not args[0].isdigit():
+        await update.message.reply_text("Пожалуйста, укажите ID пользователя: /trace <ID>")
+        return
+
+    await flush_traces()
+    spans = await asyncio.to_thread(tracer.find_latest_trace, int(args[0]))
+    if not spans:
+        await update.message.reply_text(f"Трассировка для пользователя {args[0]} не найдена.")
+        return
+    await send_long_message(update.effective_chat.id, format_trace(spans), context.bot)
+    trace_json = json.dumps({"resourceSpans": [{"scopeSpans": [{"scope": {"name": "zamira"}, "spans": spans}]}]}, ensure_ascii=False, indent=1)
+    await update.message.reply_document(document=trace_json.encode("utf-8"), filename=f"trace_{args[0]}_{spans[0]['traceId']}.json")
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or user.id not in CONFIG["ADMIN_IDS"]:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+
+    args = context.args
+    if not args or not args[0].isdigit() or not 1 <= int(args[0]) <= CONFIG["PROFILE_MAX_SECONDS"]:
+        await update.message.reply_text(f"Пожалуйста, укажите длительность в секундах (1-{CONFIG['PROFILE_MAX_SECONDS']}): /profile <секунды>")
+        return
+    if profile_lock.locked():
+        await update.message.reply_text("Профилирование уже идет, дождитесь результата.")
+        return
+
+    seconds = int(args[0])
+    async with profile_lock:
+        await update.message.reply_text(f"Снимаю профиль {seconds} с...")
+        counts, samples = await asyncio.to_thread(sample_stacks, seconds, CONFIG["PROFILE_SAMPLE_INTERVAL"])
+    folded = "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda kv: -kv[1]))
+    await update.message.reply_document(document=gzip.compress(folded.encode("utf-8")),
+                                        filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded.gz",
+                                        caption=f"Сэмплов: {samples}, уникальных стеков: {len(counts)}. Формат collapsed stacks (flamegraph.pl, speedscope).")
+
 async def admin_clear_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user or user.id not in CONFIG["ADMIN_IDS"]:
@@ -1001,28 +3980,107 @@ async def admin_clear_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     args = context.args
     if not args or not args[0].isdigit():
-        await update.message.reply_text("Пожалуйста, укажите ID пользователя: /clear_user <ID>")
+        await update.message.reply_text("Пожалуйста, укажите ID пользователя: /clear_user <ID> [nocache]")
         return
 
     user_to_clear_id = int(args[0])
+    bypass_cache = len(args) > 1 and args[1] == "nocache"
+    await asyncio.to_thread(submission_registry.clear_user, user_to_clear_id, bypass_cache)
+    if bypass_cache:
+        await update.message.reply_text(f"Следующая заявка пользователя {user_to_clear_id} будет сгенерирована заново, без кэша.")
     if user_to_clear_id in completed_users:
         completed_users.remove(user_to_clear_id)
-        save_completed_users(completed_users)
+        await asyncio.to_thread(completed_users_store.remove, user_to_clear_id)
         await update.message.reply_text(f"Пользователь {user_to_clear_id} удален из списка 'completed'. Он сможет получить бесплатную услугу снова.")
         logger.info(f"Администратор {user.id} удалил {user_to_clear_id} из completed_users.")
         await send_admin_notification(context, f"Администратор {user.id} удалил пользователя {user_to_clear_id} из списка completed.")
     else:
         await update.message.reply_text(f"Пользователь {user_to_clear_id} не найден в списке 'completed'.")
 
+def parse_log_query(args: List[str]) -> Dict[str, Any]:
+    # Аргументы вида user=<ID> from=<YYYY-MM-DD[THH:MM]> to=<...> level=<WARNING> service=<tarot|matrix>.
+    query: Dict[str, Any] = {"user_id": None, "since": None, "until": None, "min_level": LOG_LEVEL_BITS["DEBUG"], "service": None}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if key == "user" and value.isdigit():
+            query["user_id"] = int(value)
+        elif key in ("from", "to"):
+            query["since" if key == "from" else "until"] = datetime.fromisoformat(value).timestamp()
+        elif key == "level" and value.upper() in LOG_LEVEL_BITS:
+            query["min_level"] = LOG_LEVEL_BITS[value.upper()]
+        elif key == "service" and value:
+            query["service"] = value
+        else:
+            raise ValueError(f"Непонятный аргумент: {arg}")
+    return query
+
+def log_line_matches(line: bytes, query: Dict[str, Any]) -> bool:
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return False
+    if query["user_id"] is not None and entry.get("user_id") != query["user_id"]:
+        return False
+    if query["service"] is not None and entry.get("service") != query["service"]:
+        return False
+    if LOG_LEVEL_BITS.get(entry.get("level"), 0) < query["min_level"]:
+        return False
+    if query["since"] is not None or query["until"] is not None:
+        timestamp = datetime.fromisoformat(entry["ts"]).timestamp()
+        if (query["since"] is not None and timestamp < query["since"]) or (query["until"] is not None and timestamp > query["until"]):
+            return False
+    return True
+
+def export_logs_gzip(query: Optional[Dict[str, Any]]) -> Tuple[Any, int]:
+    # Выполняется в отдельном потоке. Результат пишется потоково в gzip во временный файл (в памяти до 1 МБ).
+    # Без фильтров выгружаются все файлы целиком, с фильтрами - только строки из подходящих блоков индекса.
+    output = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    matched = 0
+    with gzip.GzipFile(fileobj=output, mode="wb") as gz:
+        if query is None:
+            for i in range(CONFIG["LOG_FILE_BACKUP_COUNT"], -1, -1):
+                path = f"{CONFIG['LOG_FILE']}.{i}" if i else CONFIG["LOG_FILE"]
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        for line in f:
+                            gz.write(line)
+                            matched += 1
+        else:
+            blocks = log_index.candidate_blocks(query["user_id"], query["since"], query["until"], query["min_level"], query["service"])
+            for segment, start, end in blocks:
+                age = log_index.segment - segment
+                path = f"{CONFIG['LOG_FILE']}.{age}" if age else CONFIG["LOG_FILE"]
+                try:
+                    with open(path, "rb") as f:
+                        f.seek(start)
+                        for line in f.read(end - start).splitlines(keepends=True):
+                            if log_line_matches(line, query):
+                                gz.write(line)
+                                matched += 1
+                except FileNotFoundError:
+                    continue
+    output.seek(0)
+    return output, matched
+
 async def admin_get_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user or user.id not in CONFIG["ADMIN_IDS"]:
         await update.message.reply_text("Эта команда доступна только администратору.")
         return
     try:
-        await update.message.reply_document(document=open("bot.log", "rb"), filename="bot_activity.log")
-    except FileNotFoundError:
-        await update.message.reply_text("Файл логов 'bot.log' не найден.")
+        query = parse_log_query(context.args) if context.args else None
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\nФормат: /get_logs [user=<ID>] [from=2025-01-31T10:00] [to=...] [level=WARNING] [service=tarot|matrix]")
+        return
+    try:
+        output, matched = await asyncio.to_thread(export_logs_gzip, query)
+        if query is not None and not matched:
+            output.close()
+            await update.message.reply_text("По этим условиям записей в логах не найдено.")
+            return
+        with output:
+            await update.message.reply_document(document=output, filename=f"bot_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl.gz",
+                                                caption=f"Строк: {matched}")
     except Exception as e:
         await update.message.reply_text(f"Ошибка при отправке логов: {e}")
         logger.error(f"Ошибка отправки логов администратору: {e}")
@@ -1033,6 +4091,7 @@ async def admin_get_completed_list(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("Эта команда доступна только администратору.")
         return
     try:
+        await asyncio.to_thread(snapshot_completed_users)
         await update.message.reply_document(document=open(CONFIG["COMPLETED_USERS_FILE"], "rb"), filename=CONFIG["COMPLETED_USERS_FILE"])
     except FileNotFoundError:
         await update.message.reply_text(f"Файл '{CONFIG['COMPLETED_USERS_FILE']}' не найден.")
@@ -1089,58 +4148,77 @@ async def faq_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await safe_edit_message_text(context.bot, query.message.chat.id, query.message.message_id, clean_text(help_text_faq_list), reply_markup=InlineKeyboardMarkup(keyboard_faq_list)):
             await context.bot.send_message(chat_id=query.message.chat_id, text=clean_text(help_text_faq_list), reply_markup=InlineKeyboardMarkup(keyboard_faq_list))
 
+def add_bot_handlers(application: Application):
+    logger.info("MAIN: Определение ConversationHandler...")
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start_command)],
+        states={
+            CHOOSE_SERVICE: [
+                CallbackQueryHandler(choose_service_callback, pattern="^(tarot|matrix|contact_direct|back_to_start|help_section)$")
+            ],
+            ASK_MATRIX_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_matrix_name_message)],
+            ASK_MATRIX_DOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_matrix_dob_message)],
+            CONFIRM_MATRIX_DATA: [CallbackQueryHandler(confirm_matrix_data_callback, pattern="^confirm_final_matrix$")],
+
+            ASK_TAROT_MAIN_PERSON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_main_person_name_message)],
+            ASK_TAROT_MAIN_PERSON_DOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_main_person_dob_message)],
+            ASK_TAROT_BACKSTORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_backstory_message)],
+            ASK_TAROT_OTHER_PEOPLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_other_people_message)],
+            ASK_TAROT_QUESTIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_questions_message)],
+            SHOW_TAROT_CONFIRM_OPTIONS: [
+                CallbackQueryHandler(edit_field_tarot_callback, pattern=f"^{EDIT_PREFIX_TAROT}"),
+                CallbackQueryHandler(confirm_tarot_data_callback, pattern="^confirm_final_tarot$")
+            ],
+        },
+        fallbacks=[
+            CommandHandler("cancel", cancel_conv_command),
+            CommandHandler("start", start_command),
+            CallbackQueryHandler(cancel_conv_inline_callback, pattern=f"^{CANCEL_CALLBACK_DATA}$")
+        ],
+        per_message=False,
+        name="main_conversation",
+        persistent=True,
+    )
+    logger.info("MAIN: ConversationHandler определен.")
+    conversation_sweeper.attach(conv_handler)
+    application.add_handler(TypeHandler(Update, touch_conversation_activity), group=-1)
+    application.add_handler(conv_handler)
+    logger.info("MAIN: ConversationHandler добавлен в приложение.")
+
+    logger.info("MAIN: Добавление обработчиков...")
+    application.add_handler(CallbackQueryHandler(handle_satisfaction_and_other_callbacks, pattern="^(satisfaction_|detailed_fb_)"))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CallbackQueryHandler(faq_callback, pattern="^faq_"))
+    application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("usage", admin_usage))
+    application.add_handler(CommandHandler("trace", admin_trace))
+    application.add_handler(CommandHandler("profile", admin_profile))
+    application.add_handler(CommandHandler("clear_user", admin_clear_user))
+    application.add_handler(CommandHandler("get_logs", admin_get_logs))
+    application.add_handler(CommandHandler("get_completed_list", admin_get_completed_list))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, post_fallback_message), group=1)
+    # В каждой группе срабатывает не больше одного обработчика, а TypeHandler(Update) подходит под любое обновление,
+    # поэтому замер времени идет в отдельной группе после всех групп с поведением.
+    application.add_handler(TypeHandler(Update, observe_handler_time), group=HANDLER_TIMING_GROUP)
+
 if __name__ == "__main__":
     logger.info("MAIN: Начало блока if __name__ == '__main__'")
     try:
         logger.info("MAIN: Создание ApplicationBuilder...")
-        app_builder = ApplicationBuilder().token(BOT_TOKEN)
+        app_builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(
+            PerUserUpdateProcessor(CONFIG["MAX_CONCURRENT_UPDATES"])
+        ).rate_limiter(outbound_rate_limiter).persistence(
+            SQLitePersistence(CONFIG["STATE_DB_FILE"], CONFIG["PERSISTENCE_UPDATE_INTERVAL"])
+        ).post_init(on_startup).post_shutdown(on_shutdown)
+        if TELEGRAM_API_BASE_URL:
+            app_builder.base_url(TELEGRAM_API_BASE_URL)
         logger.info("MAIN: ApplicationBuilder создан.")
 
         logger.info("MAIN: Сборка приложения...")
         application = app_builder.build()
         logger.info("MAIN: Приложение собрано.")
 
-        logger.info("MAIN: Определение ConversationHandler...")
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start_command)],
-            states={
-                CHOOSE_SERVICE: [
-                    CallbackQueryHandler(choose_service_callback, pattern="^(tarot|matrix|contact_direct|back_to_start|help_section)$")
-                ],
-                ASK_MATRIX_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_matrix_name_message)],
-                ASK_MATRIX_DOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_matrix_dob_message)],
-                CONFIRM_MATRIX_DATA: [CallbackQueryHandler(confirm_matrix_data_callback, pattern="^confirm_final_matrix$")],
-
-                ASK_TAROT_MAIN_PERSON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_main_person_name_message)],
-                ASK_TAROT_MAIN_PERSON_DOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_main_person_dob_message)],
-                ASK_TAROT_BACKSTORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_backstory_message)],
-                ASK_TAROT_OTHER_PEOPLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_other_people_message)],
-                ASK_TAROT_QUESTIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_tarot_questions_message)],
-                SHOW_TAROT_CONFIRM_OPTIONS: [
-                    CallbackQueryHandler(edit_field_tarot_callback, pattern=f"^{EDIT_PREFIX_TAROT}"),
-                    CallbackQueryHandler(confirm_tarot_data_callback, pattern="^confirm_final_tarot$")
-                ],
-            },
-            fallbacks=[
-                CommandHandler("cancel", cancel_conv_command),
-                CommandHandler("start", start_command),
-                CallbackQueryHandler(cancel_conv_inline_callback, pattern=f"^{CANCEL_CALLBACK_DATA}$")
-            ],
-            per_message=False,
-        )
-        logger.info("MAIN: ConversationHandler определен.")
-        application.add_handler(conv_handler)
-        logger.info("MAIN: ConversationHandler добавлен в приложение.")
-
-        logger.info("MAIN: Добавление обработчиков...")
-        application.add_handler(CallbackQueryHandler(handle_satisfaction_and_other_callbacks, pattern="^(satisfaction_|detailed_fb_)"))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CallbackQueryHandler(faq_callback, pattern="^faq_"))
-        application.add_handler(CommandHandler("stats", admin_stats))
-        application.add_handler(CommandHandler("clear_user", admin_clear_user))
-        application.add_handler(CommandHandler("get_logs", admin_get_logs))
-        application.add_handler(CommandHandler("get_completed_list", admin_get_completed_list))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, post_fallback_message), group=1)
+        add_bot_handlers(application)
         logger.info("MAIN: Все обработчики добавлены.")
 
         logger.info("MAIN: Запуск бота...")
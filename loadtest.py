@@ -0,0 +1,669 @@
+# Нагрузочный стенд для bot.py.
+# Бот запускается отдельным процессом против двух локальных заглушек: Telegram Bot API (getUpdates, sendMessage,
+# editMessageText, answerCallbackQuery и т.д.) и OpenAI chat completions (задержка, доля ошибок, 429).
+# N виртуальных пользователей проходят сценарии Таро и Матрицы через настоящий ConversationHandler: жмут только
+# кнопки, которые бот им действительно показал. Время DELAY_SECONDS_* сжимается в --time-scale раз; лимиты исходящих
+# сообщений Telegram (TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL) не сжимаются - это реальный потолок Bot API.
+# Итог печатается в JSON: пропускная способность, p50/p95/p99 задержек, опоздание доставки, пиковый RSS бота
+# и гистограммы из его /metrics.
+#
+#   python loadtest.py --users 200 --ramp-up 30 --mix tarot=0.6,matrix=0.3,tarot_edit=0.1 \
+#       --openai-latency 3 --openai-error-rate 0.02 --openai-429-rate 0.05 --output report.json
+import argparse
+import ast
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import resource
+import signal
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger("loadtest")
+
+# Параметры бота в секундах "по часам": сжимаются вместе с DELAY_SECONDS_*.
+TIME_SCALED_KEYS = ["DELAY_SECONDS_MAIN_SERVICE", "DELAY_SECONDS_REVIEW_REQUEST", "GENERATION_SAFETY_MARGIN",
+                    "GENERATION_RETRY_DELAY", "OPENAI_BATCH_SYNC_MARGIN", "REVIEW_REQUEST_MAX_LATENESS"]
+# Поминутные лимиты OpenAI растут обратно пропорционально, чтобы в окно доставки помещалось столько же заявок, сколько в бою.
+RATE_SCALED_KEYS = ["OPENAI_RPM_LIMIT", "OPENAI_TPM_LIMIT"]
+# Гистограммы из /metrics бота, попадающие в отчет (имя -> метка, по которой разбиваются ряды).
+BOT_HISTOGRAMS = {
+    "zamira_job_lag_seconds": "job",
+    "zamira_handler_seconds": "state",
+    "zamira_event_loop_lag_seconds": None,
+    "zamira_openai_request_seconds": "model",
+    "zamira_send_chunk_seconds": None,
+}
+
+# Шаг сценария: (метка, действие, аргумент, чего ждать от бота).
+# Действия: command/text - сообщение от пользователя, click - нажатие кнопки из последней показанной клавиатуры,
+# wait - только ожидание (доставка результата). Ожидания: keyboard - сообщение с инлайн-клавиатурой,
+# message - любое сообщение или правка, satisfaction - клавиатура оценки после доставки.
+TAROT_INPUT_STEPS = [
+    ("start", "command", "/start", "keyboard"),
+    ("choose_tarot", "click", "tarot", "keyboard"),
+    ("tarot_name", "text", "{name}", "keyboard"),
+    ("tarot_dob", "text", "{dob}", "keyboard"),
+    ("tarot_backstory", "text", "{backstory}", "keyboard"),
+    ("tarot_other_people", "text", "{other_people}", "keyboard"),
+    ("tarot_questions", "text", "{questions}", "keyboard"),
+]
+SCENARIOS = {
+    "tarot": TAROT_INPUT_STEPS + [
+        ("confirm", "click", "confirm_final_tarot", "message"),
+        ("delivery", "wait", None, "satisfaction"),
+    ],
+    "tarot_edit": TAROT_INPUT_STEPS + [
+        ("edit_backstory", "click", "edit_field_tarot_backstory", "keyboard"),
+        ("tarot_backstory_edited", "text", "{backstory_edited}", "keyboard"),
+        ("confirm", "click", "confirm_final_tarot", "message"),
+        ("delivery", "wait", None, "satisfaction"),
+    ],
+    "matrix": [
+        ("start", "command", "/start", "keyboard"),
+        ("choose_matrix", "click", "matrix", "keyboard"),
+        ("matrix_name", "text", "{name}", "keyboard"),
+        ("matrix_dob", "text", "{dob}", "keyboard"),
+        ("confirm", "click", "confirm_final_matrix", "message"),
+        ("delivery", "wait", None, "satisfaction"),
+    ],
+}
+
+FIRST_NAMES = ["Анна", "Мария", "Елена", "Ольга", "Наталья", "Ирина", "Светлана", "Татьяна", "Дмитрий", "Алексей",
+               "Сергей", "Андрей", "Павел", "Михаил", "Виктория", "Юлия", "Ксения", "Полина", "Артем", "Никита"]
+BACKSTORIES = [
+    "Полгода назад я сменила работу и переехала в другой город. Коллектив хороший, но я до сих пор не чувствую себя на своем месте "
+    "и часто думаю, не поторопилась ли с решением. Родители просят вернуться, а партнер считает, что стоит подождать еще год.",
+    "Мы вместе уже четыре года, но последние месяцы часто ссоримся из-за мелочей. Он много работает, я чувствую себя одинокой. "
+    "Недавно он предложил съехаться, а я не уверена, что это решит наши проблемы, а не добавит новых.",
+    "Я давно мечтаю открыть свою небольшую мастерскую керамики. Есть накопления и несколько постоянных заказчиков, "
+    "но страшно уходить со стабильной должности. Близкие поддерживают, хотя и говорят, что сейчас не лучшее время.",
+]
+QUESTIONS = [
+    "Стоит ли мне оставаться в новом городе еще на год? Что меня ждет в работе в ближайшие полгода и как наладить отношения с семьей?",
+    "Есть ли у наших отношений будущее? Что мне важно понять о себе и о партнере, прежде чем принимать решение о переезде к нему?",
+    "Благоприятно ли сейчас открывать свое дело? На что обратить внимание в первые месяцы и чего стоит опасаться в финансах?",
+]
+OTHER_PEOPLE = ["Партнер Игорь, 12.05.1988", "Мама Людмила и отец Виктор", "нет"]
+FILLER_SENTENCE = "Карты указывают на период перемен, в котором важно сохранять внутреннее равновесие и доверять своим решениям. "
+
+
+def read_bot_config(bot_path: str) -> Dict[str, Any]:
+    # Импорт bot.py запустил бы логирование и открыл базы, поэтому CONFIG вычисляется прямо из исходника.
+    with open(bot_path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), bot_path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "CONFIG" for t in node.targets):
+            return eval(compile(ast.Expression(node.value), bot_path, "eval"), {"__builtins__": {}})
+    raise ValueError(f"CONFIG не найден в {bot_path}")
+
+
+def build_config_overrides(bot_config: Dict[str, Any], args: argparse.Namespace, metrics_port: int) -> Dict[str, Any]:
+    overrides: Dict[str, Any] = {}
+    for key in TIME_SCALED_KEYS:
+        if bot_config.get(key) is not None:
+            overrides[key] = bot_config[key] * args.time_scale
+    for key in RATE_SCALED_KEYS:
+        if bot_config.get(key) is not None:
+            overrides[key] = int(bot_config[key] / args.time_scale)
+    overrides["METRICS_HOST"] = "127.0.0.1"
+    overrides["METRICS_PORT"] = metrics_port
+    # Дневной бюджет токенов обрывал бы прогон на середине; вернуть его можно через --set.
+    overrides["OPENAI_DAILY_TOKEN_BUDGET"] = {key: None for key in bot_config.get("OPENAI_DAILY_TOKEN_BUDGET", {})}
+    for assignment in args.set:
+        key, _, value = assignment.partition("=")
+        if key not in bot_config:
+            # Бот тоже отверг бы такой ключ, но уже после запуска заглушек.
+            raise ValueError(f"--set: в CONFIG бота нет параметра {key!r}")
+        overrides[key] = json.loads(value)
+    return overrides
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def quantile(q: float) -> float:
+        return ordered[min(len(ordered) - 1, max(math.ceil(q * len(ordered)) - 1, 0))]
+
+    return {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 4), "p50": round(quantile(0.5), 4),
+            "p95": round(quantile(0.95), 4), "p99": round(quantile(0.99), 4), "max": round(ordered[-1], 4)}
+
+
+# --- Минимальный HTTP/1.1 сервер (keep-alive, тела по Content-Length или chunked) ---
+async def read_http_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            body += chunk[:-2]
+        return method, target, headers, bytes(body)
+    return method, target, headers, await reader.readexactly(int(headers.get("content-length") or 0))
+
+
+def http_response(status: str, body: bytes, content_type: str = "application/json", extra_headers: Tuple[str, ...] = ()) -> bytes:
+    head = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}", *extra_headers]
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+
+async def serve_http(handler, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            request = await read_http_request(reader)
+            if request is None:
+                break
+            await handler(*request, writer)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except asyncio.CancelledError:
+        # Висящий long poll getUpdates при завершении стенда.
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка заглушки при обработке запроса: {e}", exc_info=True)
+    finally:
+        writer.close()
+
+
+# --- Заглушка Telegram Bot API ---
+class FakeTelegram:
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "Замира", "username": "zamira_loadtest_bot"}
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.users: Dict[int, "VirtualUser"] = {}
+        self.pending: List[Dict[str, Any]] = []
+        self.update_ids = itertools.count(1)
+        self.message_ids: Dict[int, itertools.count] = {}
+        self.new_updates = asyncio.Event()
+        self.polling_started = asyncio.Event()
+
+    def next_message_id(self, chat_id: int) -> int:
+        return next(self.message_ids.setdefault(chat_id, itertools.count(1)))
+
+    def push_update(self, update: Dict[str, Any]) -> float:
+        update["update_id"] = next(self.update_ids)
+        self.pending.append(update)
+        self.new_updates.set()
+        return time.monotonic()
+
+    def message(self, chat_id: int, text: str, message_id: Optional[int] = None, reply_markup: Optional[Dict[str, Any]] = None,
+                sender: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        message = {"message_id": message_id or self.next_message_id(chat_id), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "from": sender or self.BOT_USER, "text": text}
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        return message
+
+    async def get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self.polling_started.set()
+        offset = int(params.get("offset") or 0)
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:int(params.get("limit") or 100)]
+
+    async def handle(self, method: str, target: str, headers: Dict[str, str], body: bytes, writer: asyncio.StreamWriter):
+        api_method = urlsplit(target).path.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params: Dict[str, Any] = {}
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            params = json.loads(body or b"{}")
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            # PTB кодирует в форме все нестроковые параметры как JSON.
+            for key, value in parse_qsl(body.decode("utf-8")):
+                try:
+                    params[key] = json.loads(value) if key != "text" else value
+                except ValueError:
+                    params[key] = value
+        if api_method == "getUpdates":
+            result: Any = await self.get_updates(params)
+        else:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            result = self.call(api_method, params)
+        payload = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+        writer.write(http_response("200 OK", payload))
+
+    def call(self, api_method: str, params: Dict[str, Any]) -> Any:
+        if api_method == "getMe":
+            return self.BOT_USER
+        if api_method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            chat_id = int(params.get("chat_id") or 0)
+            message_id = int(params["message_id"]) if api_method == "editMessageText" else None
+            message = self.message(chat_id, params.get("text", ""), message_id, params.get("reply_markup"))
+            user = self.users.get(chat_id)
+            if user and api_method in ("sendMessage", "editMessageText"):
+                user.on_bot_message(message)
+            return message
+        # answerCallbackQuery, deleteMessage, sendChatAction, deleteWebhook, setMyCommands и прочее.
+        return True
+
+
+# --- Заглушка OpenAI chat completions ---
+class FakeOpenAI:
+    def __init__(self, latency: float, jitter: float, error_rate: float, rate_limit_rate: float, retry_after: float,
+                 response_chars: int, stream_chunks: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.response_chars = response_chars
+        self.stream_chunks = stream_chunks
+        self.stats: Counter = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def sample_latency(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.latency), self.jitter) if self.jitter else self.latency
+
+    def completion_text(self) -> str:
+        repeats = self.response_chars // len(FILLER_SENTENCE) + 1
+        return (FILLER_SENTENCE * repeats)[:self.response_chars]
+
+    @staticmethod
+    def error_body(message: str, error_type: str, code: Optional[str] = None) -> bytes:
+        return json.dumps({"error": {"message": message, "type": error_type, "param": None, "code": code}}).encode("utf-8")
+
+    async def handle(self, method: str, target: str, headers: Dict[str, str], body: bytes, writer: asyncio.StreamWriter):
+        if method != "POST" or not urlsplit(target).path.endswith("/chat/completions"):
+            writer.write(http_response("404 Not Found", self.error_body("Unknown endpoint (loadtest)", "invalid_request_error")))
+            return
+        payload = json.loads(body or b"{}")
+        self.stats["requests"] += 1
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            writer.write(http_response("429 Too Many Requests", self.error_body("Rate limit reached (loadtest)", "requests", "rate_limit_exceeded"),
+                                       extra_headers=(f"retry-after: {self.retry_after}",)))
+            return
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            duration = self.sample_latency()
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.stats["server_errors"] += 1
+                await asyncio.sleep(duration / 2)
+                writer.write(http_response("500 Internal Server Error", self.error_body("Injected server error (loadtest)", "server_error")))
+                return
+            if payload.get("stream"):
+                await self.stream_response(payload, duration, writer)
+            else:
+                await self.plain_response(payload, duration, writer)
+        finally:
+            self.in_flight -= 1
+
+    async def plain_response(self, payload: Dict[str, Any], duration: float, writer: asyncio.StreamWriter):
+        await asyncio.sleep(duration)
+        text = self.completion_text()
+        prompt_tokens = sum(len(m.get("content") or "") for m in payload.get("messages", [])) // 3
+        completion_tokens = len(text) // 3
+        response = {
+            "id": f"chatcmpl-loadtest-{self.stats['requests']}", "object": "chat.completion", "created": int(time.time()),
+            "model": payload.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+        self.stats["completed"] += 1
+        writer.write(http_response("200 OK", json.dumps(response, ensure_ascii=False).encode("utf-8")))
+
+    async def stream_response(self, payload: Dict[str, Any], duration: float, writer: asyncio.StreamWriter):
+        # Первый токен приходит через 20% задержки, остальной текст - равными частями за оставшееся время.
+        self.stats["streamed"] += 1
+        head = ["HTTP/1.1 200 OK", "Content-Type: text/event-stream", "Transfer-Encoding: chunked"]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        text = self.completion_text()
+        piece_size = max(len(text) // self.stream_chunks, 1)
+        pieces = [text[i:i + piece_size] for i in range(0, len(text), piece_size)]
+        base = {"id": f"chatcmpl-loadtest-{self.stats['requests']}", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": payload.get("model", "gpt-4o")}
+
+        async def send_event(data: str):
+            event = f"data: {data}\n\n".encode("utf-8")
+            writer.write(f"{len(event):x}\r\n".encode("latin-1") + event + b"\r\n")
+            await writer.drain()
+
+        try:
+            await asyncio.sleep(duration * 0.2)
+            await send_event(json.dumps({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}))
+            for piece in pieces:
+                await asyncio.sleep(duration * 0.8 / len(pieces))
+                await send_event(json.dumps({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}, ensure_ascii=False))
+            await send_event(json.dumps({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                prompt_tokens = sum(len(m.get("content") or "") for m in payload.get("messages", [])) // 3
+                completion_tokens = len(text) // 3
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+                await send_event(json.dumps({**base, "choices": [], "usage": usage}))
+            await send_event("[DONE]")
+            writer.write(b"0\r\n\r\n")
+            self.stats["completed"] += 1
+        except ConnectionError:
+            # Бот закрыл поток раньше (StreamLengthGuard) - для настоящего API это обрыв генерации.
+            self.stats["stream_closed_by_client"] += 1
+            raise
+
+
+# --- Виртуальный пользователь ---
+class VirtualUser:
+    def __init__(self, user_id: int, scenario: str, telegram: FakeTelegram, args: argparse.Namespace, delivery_delay: float):
+        self.user_id = user_id
+        self.scenario = scenario
+        self.telegram = telegram
+        self.args = args
+        self.delivery_delay = delivery_delay
+        self.profile = self.make_profile()
+        self.user = {"id": user_id, "is_bot": False, "first_name": self.profile["name"], "language_code": "ru"}
+        self.keyboard_message: Optional[Dict[str, Any]] = None
+        self.waiter: Optional[Tuple[str, asyncio.Future]] = None
+        self.latencies: Dict[str, float] = {}
+        self.failure: Optional[str] = None
+        self.completed = False
+        telegram.users[user_id] = self
+
+    @staticmethod
+    def make_profile() -> Dict[str, str]:
+        dob = date(1960, 1, 1) + timedelta(days=random.randrange(45 * 365))
+        backstory = random.choice(BACKSTORIES)
+        return {"name": random.choice(FIRST_NAMES), "dob": dob.strftime("%d.%m.%Y"), "backstory": backstory,
+                "backstory_edited": backstory + " Добавлю, что решение нужно принять до конца месяца.",
+                "other_people": random.choice(OTHER_PEOPLE), "questions": random.choice(QUESTIONS)}
+
+    @staticmethod
+    def keyboard_callbacks(message: Dict[str, Any]) -> List[str]:
+        rows = (message.get("reply_markup") or {}).get("inline_keyboard") or []
+        return [button.get("callback_data", "") for row in rows for button in row]
+
+    def on_bot_message(self, message: Dict[str, Any]):
+        callbacks = self.keyboard_callbacks(message)
+        if callbacks:
+            self.keyboard_message = message
+        if not self.waiter or self.waiter[1].done():
+            return
+        expect, future = self.waiter
+        if (expect == "message" or (expect == "keyboard" and callbacks)
+                or (expect == "satisfaction" and any(c.startswith("satisfaction_") for c in callbacks))):
+            future.set_result(time.monotonic())
+
+    def send(self, action: str, argument: str) -> float:
+        if action in ("command", "text"):
+            text = argument.format(**self.profile)
+            message = self.telegram.message(self.user_id, text, sender=self.user)
+            if action == "command":
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            return self.telegram.push_update({"message": message})
+        if not self.keyboard_message or argument not in self.keyboard_callbacks(self.keyboard_message):
+            raise LookupError(f"button_missing:{argument}")
+        return self.telegram.push_update({"callback_query": {
+            "id": f"{self.user_id}-{time.monotonic_ns()}", "from": self.user, "chat_instance": str(self.user_id),
+            "message": self.keyboard_message, "data": argument}})
+
+    async def run(self, start_delay: float):
+        await asyncio.sleep(start_delay)
+        confirm_sent_at = 0.0
+        for label, action, argument, expect in SCENARIOS[self.scenario]:
+            if action != "wait":
+                await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.think_time)
+            future = asyncio.get_running_loop().create_future()
+            self.waiter = (expect, future)
+            if action == "wait":
+                sent_at = confirm_sent_at + self.delivery_delay
+                timeout = max(sent_at - time.monotonic(), 0) + self.args.delivery_grace
+            else:
+                try:
+                    sent_at = self.send(action, argument)
+                except LookupError as e:
+                    self.failure = str(e)
+                    return
+                timeout = self.args.step_timeout
+            if label == "confirm":
+                confirm_sent_at = sent_at
+            try:
+                answered_at = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self.failure = f"timeout:{label}"
+                return
+            self.latencies[label] = answered_at - sent_at
+        self.completed = True
+
+
+# --- Метрики бота ---
+def scrape_bot_metrics(port: int) -> Dict[str, Any]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=10) as response:
+        text = response.read().decode("utf-8")
+    buckets: Dict[Tuple[str, str], List[Tuple[float, float]]] = {}
+    for line in text.splitlines():
+        if line.startswith("#") or "_bucket{" not in line:
+            continue
+        series, value = line.rsplit(" ", 1)
+        name, _, raw_labels = series.partition("_bucket{")
+        if name not in BOT_HISTOGRAMS:
+            continue
+        labels = dict(item.split("=", 1) for item in raw_labels.rstrip("}").split(",") if item)
+        labels = {k: v.strip('"') for k, v in labels.items()}
+        series_key = labels.get(BOT_HISTOGRAMS[name] or "", "all")
+        buckets.setdefault((name, series_key), []).append((float(labels["le"]), float(value)))
+    report: Dict[str, Any] = {}
+    for (name, series_key), cumulative in buckets.items():
+        cumulative.sort()
+        total = cumulative[-1][1]
+        estimate = {"count": int(total)}
+        for q in (0.5, 0.95, 0.99):
+            estimate[f"p{int(q * 100)}"] = histogram_quantile(cumulative, q)
+        report.setdefault(name, {})[series_key] = estimate
+    return report
+
+
+def histogram_quantile(cumulative: List[Tuple[float, float]], q: float) -> Optional[float]:
+    # Оценка как у histogram_quantile в Prometheus: линейная интерполяция внутри корзины.
+    total = cumulative[-1][1]
+    if not total:
+        return None
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in cumulative:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower_bound
+            fraction = (rank - lower_count) / (count - lower_count) if count > lower_count else 0.0
+            return round(lower_bound + (bound - lower_bound) * fraction, 4)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий {name!r}, доступны: {', '.join(SCENARIOS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def peak_rss_mb(who: int) -> float:
+    # ru_maxrss в Linux - в килобайтах, в macOS - в байтах.
+    maxrss = resource.getrusage(who).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def run_load_test(args: argparse.Namespace) -> Tuple[Dict[str, Any], int]:
+    bot_path = os.path.abspath(args.bot)
+    bot_config = read_bot_config(bot_path)
+    metrics_port = free_port()
+    overrides = build_config_overrides(bot_config, args, metrics_port)
+    delivery_delay = overrides.get("DELAY_SECONDS_MAIN_SERVICE", bot_config["DELAY_SECONDS_MAIN_SERVICE"])
+
+    telegram = FakeTelegram(args.telegram_latency)
+    fake_openai = FakeOpenAI(args.openai_latency, args.openai_jitter, args.openai_error_rate, args.openai_429_rate,
+                             args.openai_retry_after, args.openai_response_chars, args.openai_stream_chunks)
+    telegram_server = await asyncio.start_server(lambda r, w: serve_http(telegram.handle, r, w), "127.0.0.1", 0)
+    openai_server = await asyncio.start_server(lambda r, w: serve_http(fake_openai.handle, r, w), "127.0.0.1", 0)
+    telegram_port = telegram_server.sockets[0].getsockname()[1]
+    openai_port = openai_server.sockets[0].getsockname()[1]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="zamira-loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ, TELEGRAM_TOKEN="123456:LOADTEST", OPENAI_API_KEY="sk-loadtest",
+               TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{telegram_port}/bot", OPENAI_BASE_URL=f"http://127.0.0.1:{openai_port}/v1",
+               BOT_CONFIG_OVERRIDES=json.dumps(overrides))
+    scenario_weights = args.mix
+    scenarios = random.choices(list(scenario_weights), weights=list(scenario_weights.values()), k=args.users)
+    users = [VirtualUser(args.first_user_id + index, scenario, telegram, args, delivery_delay) for index, scenario in enumerate(scenarios)]
+
+    logger.info(f"Рабочий каталог бота: {workdir}; Telegram-заглушка :{telegram_port}, OpenAI-заглушка :{openai_port}, /metrics :{metrics_port}")
+    bot_metrics: Dict[str, Any] = {}
+    elapsed = 0.0
+    exit_code = 0
+    with open(os.path.join(workdir, "bot.stdout.log"), "wb") as bot_output:
+        process = await asyncio.create_subprocess_exec(sys.executable, bot_path, cwd=workdir, env=env,
+                                                       stdout=bot_output, stderr=asyncio.subprocess.STDOUT)
+        try:
+            ready = asyncio.ensure_future(telegram.polling_started.wait())
+            exited = asyncio.ensure_future(process.wait())
+            await asyncio.wait({ready, exited}, timeout=args.startup_timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not ready.done():
+                ready.cancel()
+                exit_code = 2
+                logger.error(f"Бот не начал опрос getUpdates за {args.startup_timeout} с, см. {workdir}/bot.stdout.log")
+            else:
+                logger.info(f"Бот готов, запускаю {args.users} виртуальных пользователей (разгон {args.ramp_up} с)")
+                started = time.monotonic()
+                await asyncio.gather(*(user.run(args.ramp_up * index / max(args.users, 1)) for index, user in enumerate(users)))
+                elapsed = time.monotonic() - started
+                try:
+                    bot_metrics = await asyncio.to_thread(scrape_bot_metrics, metrics_port)
+                except Exception as e:
+                    logger.warning(f"Не удалось снять /metrics бота: {e}")
+        finally:
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            telegram_server.close()
+            openai_server.close()
+
+    completed = [user for user in users if user.completed]
+    step_latencies: Dict[str, List[float]] = {}
+    for user in users:
+        for label, latency in user.latencies.items():
+            step_latencies.setdefault(label, []).append(latency)
+    interactive = [latency for label, values in step_latencies.items() if label != "delivery" for latency in values]
+    report = {
+        "users": args.users,
+        "scenarios": dict(Counter(scenarios)),
+        "completed": len(completed),
+        "failed": args.users - len(completed),
+        "failures": dict(Counter(user.failure or "unfinished" for user in users if not user.completed)),
+        "duration_seconds": round(elapsed, 3),
+        "throughput": {
+            "completed_flows_per_second": round(len(completed) / elapsed, 3) if elapsed else 0.0,
+            "updates_per_second": round((next(telegram.update_ids) - 1) / elapsed, 3) if elapsed else 0.0,
+            "telegram_calls_per_second": round(sum(telegram.calls.values()) / elapsed, 3) if elapsed else 0.0,
+            "openai_requests_per_second": round(fake_openai.stats["requests"] / elapsed, 3) if elapsed else 0.0,
+        },
+        "latency_seconds": {
+            "step": summarize(interactive),
+            "confirm": summarize(step_latencies.get("confirm", [])),
+            # Время от плановой доставки (подтверждение + DELAY_SECONDS_MAIN_SERVICE) до клавиатуры оценки.
+            "delivery_lateness": summarize(step_latencies.get("delivery", [])),
+            "by_step": {label: summarize(values) for label, values in step_latencies.items()},
+        },
+        "telegram": {"calls": dict(telegram.calls)},
+        "openai": {**fake_openai.stats, "max_in_flight": fake_openai.max_in_flight},
+        "bot": {"exit_code": process.returncode, "peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+                "workdir": workdir, "metrics": bot_metrics},
+        "harness": {"peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF)},
+        "config_overrides": overrides,
+    }
+    return report, exit_code
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон bot.py против заглушек Telegram Bot API и OpenAI")
+    parser.add_argument("--bot", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py"))
+    parser.add_argument("--users", type=int, default=50, help="число виртуальных пользователей")
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="за сколько секунд стартуют все пользователи")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("tarot=0.6,matrix=0.3,tarot_edit=0.1"),
+                        help="доли сценариев: " + ",".join(f"{name}=W" for name in SCENARIOS))
+    parser.add_argument("--think-time", type=float, default=1.0, help="средняя пауза пользователя между шагами, с")
+    parser.add_argument("--time-scale", type=float, default=0.001, help="множитель для DELAY_SECONDS_* и связанных сроков")
+    parser.add_argument("--step-timeout", type=float, default=60.0, help="сколько ждать ответа бота на шаг, с")
+    parser.add_argument("--delivery-grace", type=float, default=120.0, help="допустимое опоздание доставки сверх плановой задержки, с")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа заглушки Bot API, с")
+    parser.add_argument("--openai-latency", type=float, default=2.0, help="медиана длительности запроса к заглушке OpenAI, с")
+    parser.add_argument("--openai-jitter", type=float, default=0.3, help="sigma логнормального разброса длительности")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--openai-429-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--openai-retry-after", type=float, default=1.0, help="Retry-After в ответах 429, с")
+    parser.add_argument("--openai-response-chars", type=int, default=3000)
+    parser.add_argument("--openai-stream-chunks", type=int, default=50)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=JSON", help="переопределить параметр CONFIG бота")
+    parser.add_argument("--first-user-id", type=int, default=900_000_001)
+    parser.add_argument("--workdir", help="каталог для базы, логов и трасс бота (по умолчанию временный)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="файл для JSON-отчета (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", stream=sys.stderr)
+    random.seed(args.seed)
+    report, exit_code = asyncio.run(run_load_test(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
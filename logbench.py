@@ -0,0 +1,90 @@
+# Замер стоимости логирования для потока event loop bot.py.
+# Одна итерация повторяет типичный обработчик: одна запись logger.info с полями контекста и два отрывка промпта
+# через prompt_logger. Режим "queue" - как в боте (ContextQueueHandler, запись в bot.log и консоль в потоке
+# QueueListener), режим "direct" - те же обработчики и форматтеры, но вызываемые синхронно в вызывающем потоке.
+# Консольный вывод по умолчанию уходит в /dev/null, чтобы замер не зависел от терминала.
+#
+#   python logbench.py --iterations 5000 --mode direct --mode queue
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+
+def load_bot(workdir: str):
+    # bot.py создает bot.log, базу и трассы в текущем каталоге при импорте.
+    os.chdir(workdir)
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCH")
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ.setdefault("BOT_CONFIG_OVERRIDES", json.dumps({"METRICS_PORT": None}))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    return bot
+
+
+def use_mode(bot, mode: str, console_stream):
+    bot._log_console_handler.setStream(console_stream)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if mode == "queue":
+        root.addHandler(bot.ContextQueueHandler(bot.log_queue))
+    else:
+        root.addHandler(bot._log_file_handler)
+        root.addHandler(bot._log_console_handler)
+
+
+def run_iterations(bot, iterations: int) -> List[int]:
+    prompt_text = "Данные клиента и его запрос: " + "Описание ситуации. " * 40
+    durations = []
+    for index in range(iterations):
+        user_id = 900_000_000 + index % 100
+        started = time.perf_counter_ns()
+        with bot.log_fields(user_id=user_id, state="ASK_TAROT_QUESTIONS", service="tarot"):
+            bot.logger.info(f"Пользователь {user_id} ответил на шаг ASK_TAROT_QUESTIONS")
+            bot.prompt_logger.info("OpenAI запрос для %s: system_prompt (начало): %.200s...", user_id, bot.PROMPT_TAROT_SYSTEM)
+            bot.prompt_logger.info("OpenAI запрос для %s: user_prompt (начало): %.200s...", user_id, prompt_text)
+        durations.append(time.perf_counter_ns() - started)
+    return durations
+
+
+def summarize_us(durations: List[int]) -> Dict[str, Any]:
+    ordered = sorted(durations)
+    return {
+        "iterations": len(ordered),
+        "mean_us": round(sum(ordered) / len(ordered) / 1000, 1),
+        "p50_us": round(ordered[len(ordered) // 2] / 1000, 1),
+        "p99_us": round(ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)] / 1000, 1),
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Замер времени логирования в потоке event loop bot.py")
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=500)
+    parser.add_argument("--mode", action="append", choices=("direct", "queue"), help="можно указать несколько раз (по умолчанию оба)")
+    parser.add_argument("--console", action="store_true", help="выводить консольный лог в stderr, а не в /dev/null")
+    parser.add_argument("--workdir", help="каталог для bot.log и базы (по умолчанию временный)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    bot = load_bot(args.workdir or tempfile.mkdtemp(prefix="zamira-logbench-"))
+    console_stream = sys.stderr if args.console else open(os.devnull, "w")
+    report = {}
+    for mode in args.mode or ["direct", "queue"]:
+        use_mode(bot, mode, console_stream)
+        run_iterations(bot, args.warmup)
+        report[mode] = summarize_us(run_iterations(bot, args.iterations))
+    use_mode(bot, "queue", sys.stderr)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
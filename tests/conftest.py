@@ -0,0 +1,14 @@
+# bot.py при импорте открывает базу, bot.log и traces.jsonl в текущем каталоге и требует токены в окружении,
+# поэтому тесты импортируют его из временного каталога с фиктивными токенами и выключенным /metrics.
+import json
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+os.chdir(tempfile.mkdtemp(prefix="zamira-tests-"))
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["BOT_CONFIG_OVERRIDES"] = json.dumps({"METRICS_PORT": None})
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Dict
+
+import bot
+
+
+class FakeBatchBackend:
+    # Локальная эмуляция Batch API: пакет "выполняется" через latency секунд, ответы содержат usage как у OpenAI.
+    def __init__(self, latency: float = 5.0, responder=None):
+        self.latency = latency
+        self.responder = responder or (lambda body: f"Тестовый ответ (max_tokens={body.get('max_tokens')})")
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._files: Dict[str, bytes] = {}
+
+    async def submit(self, jsonl: bytes) -> str:
+        batch_id = f"batch_fake_{uuid.uuid4().hex}"
+        self._batches[batch_id] = {"id": batch_id, "status": "in_progress", "input": jsonl, "ready_at": time.monotonic() + self.latency}
+        return batch_id
+
+    async def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            return {"id": batch_id, "status": "failed"}
+        if batch["status"] == "in_progress" and time.monotonic() >= batch["ready_at"]:
+            output_lines = []
+            for line in batch["input"].decode("utf-8").splitlines():
+                request = json.loads(line)
+                completion = {"model": request["body"]["model"],
+                              "choices": [{"index": 0, "message": {"role": "assistant", "content": self.responder(request["body"])}}],
+                              "usage": {"prompt_tokens": 100, "completion_tokens": request["body"]["max_tokens"],
+                                        "total_tokens": 100 + request["body"]["max_tokens"]}}
+                output_lines.append(json.dumps({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": completion}, "error": None}, ensure_ascii=False))
+            output_file_id = f"file_fake_{uuid.uuid4().hex}"
+            self._files[output_file_id] = "\n".join(output_lines).encode("utf-8")
+            batch.update(status="completed", output_file_id=output_file_id)
+        return {k: v for k, v in batch.items() if k not in ("input", "ready_at")}
+
+    async def download(self, file_id: str) -> bytes:
+        return self._files[file_id]
+
+
+def make_queue(tmp_path, monkeypatch, latency=0.0):
+    queue = bot.GenerationQueue(str(tmp_path / "state.db"))
+    monkeypatch.setattr(bot, "generation_queue", queue)
+    monkeypatch.setattr(bot, "batch_backend", FakeBatchBackend(latency))
+    monkeypatch.setattr(bot, "batch_stats", {"submitted": 0, "completed": 0, "to_sync": 0})
+    monkeypatch.setattr(bot, "usage_store", bot.UsageStore(str(tmp_path / "state.db"), bot.CONFIG["USAGE_HISTOGRAM_BIN"]))
+    delivered = []
+
+    async def no_cached_result(item):
+        return None
+
+    async def record_hand_off(context, item, result, model=None):
+        delivered.append((item["request_id"], result))
+        await asyncio.to_thread(queue.complete, item["request_id"])
+
+    monkeypatch.setattr(bot, "lookup_cached_result", no_cached_result)
+    monkeypatch.setattr(bot, "hand_off_generated_result", record_hand_off)
+    return queue, delivered
+
+
+def enqueue(queue, user_id, deliver_in):
+    return queue.enqueue(user_id, "tarot", f"вопрос {user_id}", 700, f"user{user_id}", time.time() + deliver_in, status="batch_pending")
+
+
+def test_fake_backend_roundtrip_keeps_custom_ids():
+    async def scenario():
+        backend = FakeBatchBackend(0)
+        items = [{"request_id": "r1", "service_type": "tarot", "user_prompt": "q1", "max_tokens": 100},
+                 {"request_id": "r2", "service_type": "matrix", "user_prompt": "q2", "max_tokens": 200}]
+        batch_id = await backend.submit(bot.build_batch_jsonl(items))
+        batch = await backend.retrieve(batch_id)
+        assert batch["status"] == "completed"
+        records = [json.loads(line) for line in (await backend.download(batch["output_file_id"])).decode("utf-8").splitlines()]
+        assert [record["custom_id"] for record in records] == ["r1:tarot", "r2:matrix"]
+        assert records[1]["response"]["body"]["choices"][0]["message"]["content"] == "Тестовый ответ (max_tokens=200)"
+        assert (await backend.retrieve("batch_unknown"))["status"] == "failed"
+
+    asyncio.run(scenario())
+
+
+def test_batch_results_are_delivered_and_late_items_go_sync(tmp_path, monkeypatch):
+    queue, delivered = make_queue(tmp_path, monkeypatch)
+    on_time = [enqueue(queue, user_id, 3600) for user_id in (1, 2)]
+    late = enqueue(queue, 3, 0)
+
+    async def scenario():
+        await bot.submit_pending_batch(object())
+        [batch_id] = queue.open_batches()
+        await bot.poll_open_batch(object(), batch_id)
+
+    asyncio.run(scenario())
+    assert sorted(request_id for request_id, _ in delivered) == sorted(on_time)
+    assert queue.open_batches() == []
+    assert queue.claim()["request_id"] == late
+    assert bot.batch_stats == {"submitted": 2, "completed": 2, "to_sync": 1}
+
+
+def test_failed_submit_moves_items_to_sync(tmp_path, monkeypatch):
+    queue, delivered = make_queue(tmp_path, monkeypatch)
+    request_id = enqueue(queue, 1, 3600)
+
+    async def failing_submit(jsonl):
+        raise RuntimeError("batch endpoint unavailable")
+
+    monkeypatch.setattr(bot.batch_backend, "submit", failing_submit)
+    asyncio.run(bot.submit_pending_batch(object()))
+    assert delivered == [] and queue.open_batches() == []
+    assert queue.claim()["request_id"] == request_id
+    assert bot.batch_stats["to_sync"] == 1
+
+
+def test_unfinished_batch_hands_items_near_deadline_to_sync(tmp_path, monkeypatch):
+    queue, delivered = make_queue(tmp_path, monkeypatch, latency=3600)
+    request_id = enqueue(queue, 1, bot.CONFIG["OPENAI_BATCH_SYNC_MARGIN"] + 60)
+
+    async def scenario():
+        await bot.submit_pending_batch(object())
+        [batch_id] = queue.open_batches()
+        await bot.poll_open_batch(object(), batch_id)
+        assert queue.claim() is None
+        monkeypatch.setitem(bot.CONFIG, "OPENAI_BATCH_SYNC_MARGIN", bot.CONFIG["OPENAI_BATCH_SYNC_MARGIN"] + 120)
+        await bot.poll_open_batch(object(), batch_id)
+
+    asyncio.run(scenario())
+    assert delivered == []
+    assert queue.claim()["request_id"] == request_id
+    assert bot.batch_stats == {"submitted": 1, "completed": 0, "to_sync": 1}
+
+
+def test_batch_results_are_recorded_in_usage_store(tmp_path, monkeypatch):
+    queue, delivered = make_queue(tmp_path, monkeypatch, latency=3600)
+    enqueue(queue, 1, 3600)
+    enqueue(queue, 2, 3600)
+
+    async def scenario():
+        await bot.submit_pending_batch(object())
+        [batch_id] = queue.open_batches()
+        # Одна заявка уходит в синхронный режим до прихода результата: ее вызов в пакете все равно оплачен.
+        queue.to_sync([queue.batch_members(batch_id)[0][0]])
+        bot.batch_backend.latency = 0
+        for batch in bot.batch_backend._batches.values():
+            batch["ready_at"] = 0
+        await bot.poll_open_batch(object(), batch_id)
+
+    asyncio.run(scenario())
+    assert len(delivered) == 1
+    assert bot.usage_store.tokens_today("tarot") == 2 * (100 + 700)
+    [(service_type, model, purpose, calls, prompt_tokens, completion_tokens)] = bot.usage_store.summary("0000-00-00")["totals"]
+    assert (service_type, model, purpose, calls) == ("tarot", bot.model_router.models("tarot")[0], "batch", 2)
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+def open_breaker():
+    breaker = bot.CircuitBreaker("test-model", 1, 60)
+    breaker.record_failure()
+    breaker.opened_at = time.time() - 61
+    return breaker
+
+
+def test_cancelled_probe_is_released():
+    breaker = open_breaker()
+    policy = bot.RetryPolicy(3, 0, 0)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow_operation():
+            started.set()
+            await asyncio.sleep(10)
+
+        probe = asyncio.create_task(policy.run(slow_operation, breaker))
+        await started.wait()
+        with pytest.raises(bot.CircuitOpenError):
+            breaker.before_call()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(scenario())
+    assert breaker.state == "half_open"
+    breaker.before_call()
+
+
+def test_router_treats_half_open_with_probe_in_flight_as_unavailable(monkeypatch):
+    breaker = open_breaker()
+    monkeypatch.setitem(bot.openai_circuits, "test-model", breaker)
+    router = bot.ModelRouter({"tarot": {"models": ["test-model"]}})
+    assert router.unavailable_until("tarot") is None
+    breaker.before_call()
+    assert router.unavailable_until("tarot") > time.time()
+    breaker.record_success()
+    assert router.unavailable_until("tarot") is None
@@ -0,0 +1,43 @@
+import json
+
+import bot
+
+
+def test_legacy_json_is_imported_once(tmp_path):
+    db_path = str(tmp_path / "state.db")
+    legacy_path = tmp_path / "completed_users.json"
+    legacy_path.write_text(json.dumps([1, "2", 3, 3]), encoding="utf-8")
+
+    store = bot.CompletedUsersStore(db_path, str(legacy_path))
+    assert sorted(store.iter_user_ids()) == [1, 2, 3]
+
+    # JSON теперь только снимок: при следующем запуске база не перезаписывается его содержимым.
+    store.remove(2)
+    legacy_path.write_text(json.dumps([1, 2, 3, 4]), encoding="utf-8")
+    assert sorted(bot.CompletedUsersStore(db_path, str(legacy_path)).iter_user_ids()) == [1, 3]
+
+
+def test_broken_legacy_json_does_not_prevent_startup(tmp_path):
+    legacy_path = tmp_path / "completed_users.json"
+    legacy_path.write_text("[1, 2", encoding="utf-8")
+    store = bot.CompletedUsersStore(str(tmp_path / "state.db"), str(legacy_path))
+    assert list(store.iter_user_ids()) == []
+
+
+def test_add_and_remove_round_trip_and_snapshot(tmp_path):
+    db_path = str(tmp_path / "state.db")
+    store = bot.CompletedUsersStore(db_path, str(tmp_path / "missing.json"))
+    assert not store.dirty
+    for user_id in (10, 20, 10):
+        store.add(user_id)
+    store.remove(30)
+    assert store.dirty
+
+    restarted = bot.CompletedUsersStore(db_path, str(tmp_path / "missing.json"))
+    assert 10 in set(restarted.iter_user_ids())
+    assert sorted(restarted.iter_user_ids()) == [10, 20]
+
+    snapshot_path = tmp_path / "snapshot.json"
+    assert store.write_snapshot(str(snapshot_path)) == 2
+    assert sorted(json.loads(snapshot_path.read_text(encoding="utf-8"))) == [10, 20]
+    assert not store.dirty and not (tmp_path / "snapshot.json.tmp").exists()
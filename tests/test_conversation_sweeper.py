@@ -0,0 +1,44 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram.ext import CommandHandler, ConversationHandler
+
+import bot
+
+
+async def noop(update, context):
+    pass
+
+
+def make_conv_handler():
+    return ConversationHandler(entry_points=[CommandHandler("start", noop)], states={bot.ASK_TAROT_BACKSTORY: []}, fallbacks=[])
+
+
+def test_sweeper_private_ptb_api_is_available():
+    # ConversationSweeper опирается на приватные атрибуты ConversationHandler: при обновлении PTB тест покажет, что они пропали.
+    conv_handler = make_conv_handler()
+    for name in bot.ConversationSweeper.PTB_PRIVATE_ATTRIBUTES:
+        assert hasattr(conv_handler, name), name
+    bot.ConversationSweeper().attach(conv_handler)
+
+
+def test_sweep_ends_stale_conversation_and_drops_user_data(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "CONVERSATION_EXPIRY_NUDGE", False)
+    conv_handler = make_conv_handler()
+    sweeper = bot.ConversationSweeper()
+    sweeper.attach(conv_handler)
+    conv_handler._update_state(bot.ASK_TAROT_BACKSTORY, (1, 1))
+    conv_handler._update_state(bot.ASK_TAROT_BACKSTORY, (2, 2))
+    sweeper.touch(1)
+    sweeper.touch(2)
+    sweeper.last_seen[1] = time.time() - bot.ConversationSweeper.state_timeout(bot.ASK_TAROT_BACKSTORY) - 1
+
+    dropped = []
+    application = SimpleNamespace(user_data={1: {"tarot_backstory": "x" * 100}}, drop_user_data=dropped.append)
+    asyncio.run(sweeper.sweep(SimpleNamespace(application=application)))
+
+    assert sweeper.current_state(1, 1) is None
+    assert sweeper.current_state(2, 2) == bot.ASK_TAROT_BACKSTORY
+    assert dropped == [1]
+    assert sweeper.total_evicted == 1 and sweeper.total_bytes_reclaimed > 100
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def busy_pacer(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "GENERATION_SAFETY_MARGIN", 100)
+    monkeypatch.setitem(bot.CONFIG, "GENERATION_IDLE_UTILIZATION", 0.5)
+    monkeypatch.setattr(bot.openai_scheduler, "utilization", lambda: 1.0)
+    return bot.DeadlinePacer()
+
+
+def test_queue_serves_earliest_deadline_first(tmp_path):
+    queue = bot.GenerationQueue(str(tmp_path / "state.db"))
+    now = time.time()
+    late = queue.enqueue(1, "tarot", "q1", 100, "user1", now + 9000)
+    early = queue.enqueue(2, "matrix", "q2", 100, "user2", now + 3000)
+    middle = queue.enqueue(3, "tarot", "q3", 100, "user3", now + 6000)
+    assert queue.ready_deliver_times() == sorted(queue.ready_deliver_times())
+    assert [queue.claim()["request_id"] for _ in range(3)] == [early, middle, late]
+
+
+def test_idle_openai_starts_work_immediately(busy_pacer, monkeypatch):
+    monkeypatch.setattr(bot.openai_scheduler, "utilization", lambda: 0.1)
+    busy_pacer.last_start = time.time()
+    assert busy_pacer.start_delay([time.time() + 10_000]) == 0.0
+
+
+def test_deferral_never_pushes_a_start_past_its_deadline(busy_pacer, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: clock[0])
+    deliver_times = [clock[0] + offset for offset in (700, 400, 1600, 1000, 2200)]
+    busy_pacer.last_start = clock[0]
+    pending = sorted(deliver_times)
+    starts = []
+    while pending:
+        delay = busy_pacer.start_delay(pending)
+        assert delay > 0  # при загруженном OpenAI старты разносятся
+        clock[0] += delay
+        busy_pacer.last_start = clock[0]
+        # EDF: стартует заявка с ближайшим сроком.
+        starts.append((clock[0], pending.pop(0)))
+    assert all(started <= busy_pacer.deadline(deliver_at) for started, deliver_at in starts)
+
+
+def test_overdue_item_is_not_deferred_for_long(busy_pacer):
+    now = time.time()
+    busy_pacer.last_start = now
+    assert busy_pacer.start_delay([now + 50]) <= 1.0
+
+
+def test_record_finish_tracks_slack_and_lateness(busy_pacer, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: clock[0])
+    on_time = {"request_id": "r1", "deliver_at": clock[0] + 400}
+    late = {"request_id": "r2", "deliver_at": clock[0] + 150}
+    for item in (on_time, late):
+        busy_pacer.record_start(item)
+    clock[0] += 120
+    for item in (on_time, late):
+        busy_pacer.record_finish(item)
+    assert busy_pacer.summary() == {"count": 2, "min_slack": 50, "avg_slack": 175, "late_count": 1, "max_lateness": 70}
@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError
+
+import bot
+from test_job_store import RecordingJobQueue
+
+
+class FlakyBot:
+    # Падает на отправке с номером fail_on (считая с 1), остальные отправки записывает.
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.calls = 0
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise NetworkError("connection reset")
+        self.sent.append(text)
+
+
+@pytest.fixture
+def stores(monkeypatch, tmp_path):
+    path = str(tmp_path / "state.db")
+    monkeypatch.setattr(bot, "job_store", bot.JobStore(path))
+    monkeypatch.setattr(bot, "submission_registry", bot.SubmissionRegistry(path))
+    monkeypatch.setattr(bot, "completed_users_store", bot.CompletedUsersStore(path, str(tmp_path / "completed.json")))
+    monkeypatch.setattr(bot, "completed_users", set())
+    monkeypatch.setitem(bot.CONFIG, "ADMIN_IDS", [])
+    monkeypatch.setitem(bot.CONFIG, "MAX_MESSAGE_LENGTH", 10)
+    return bot.job_store, bot.submission_registry
+
+
+def schedule_delivery(stores, result):
+    job_store, registry = stores
+    _, request_id, _, _ = registry.try_register(1, "tarot")
+    registry.transition(request_id, "scheduled", ("queued",))
+    payload = {"user_id": 1, "result": result, "service_type": "tarot", "request_id": request_id}
+    return job_store.add("main", 1, 0, payload), request_id
+
+
+def run_job(job_id, fake_bot, job_queue):
+    context = SimpleNamespace(job=SimpleNamespace(data={"job_id": job_id}), bot=fake_bot, job_queue=job_queue)
+    asyncio.run(bot.main_service_job(context))
+
+
+def test_send_long_message_resumes_from_progress(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "MAX_MESSAGE_LENGTH", 10)
+    fake_bot = FlakyBot(fail_on=[2])
+    progress = {}
+    with pytest.raises(NetworkError):
+        asyncio.run(bot.send_long_message(1, "a" * 25, fake_bot, progress))
+    assert progress == {"parts_sent": 1}
+    asyncio.run(bot.send_long_message(1, "a" * 25, fake_bot, progress))
+    assert fake_bot.sent == ["a" * 10, "a" * 10, "a" * 5] and progress == {"parts_sent": 3}
+
+
+def test_partial_delivery_is_resumed_without_discarding_submission(stores):
+    job_store, registry = stores
+    job_id, request_id = schedule_delivery(stores, "0123456789abcdefghijXYZ")
+    fake_bot = FlakyBot(fail_on=[2])
+    job_queue = RecordingJobQueue()
+    run_job(job_id, fake_bot, job_queue)
+
+    assert fake_bot.sent == ["0123456789"]
+    assert registry.get(1)[2] == "delivering"
+    assert job_store.get_payload(job_id)["parts_sent"] == 1
+    (_, _, data, name), = job_queue.scheduled
+    assert data["job_id"] == job_id and name == "main_job_1"
+
+    run_job(job_id, fake_bot, job_queue)
+    # Остаток и кнопки оценки, без повтора первой части и без сообщения об ошибке.
+    assert fake_bot.sent[1:3] == ["abcdefghij", "XYZ"] and len(fake_bot.sent) == 4
+    assert registry.get(1)[2] == "delivered"
+    assert job_store.get_payload(job_id) is None
+
+
+def test_failure_before_any_part_discards_submission(stores):
+    job_store, registry = stores
+    job_id, _ = schedule_delivery(stores, "short")
+    fake_bot = FlakyBot(fail_on=[1])
+    run_job(job_id, fake_bot, RecordingJobQueue())
+    assert registry.get(1) is None
+    assert job_store.get_payload(job_id) is None
+    assert "серьезная ошибка" in fake_bot.sent[0]
+
+
+def test_partial_delivery_gives_up_after_max_attempts(stores, monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "DELIVERY_MAX_ATTEMPTS", 1)
+    job_store, registry = stores
+    job_id, _ = schedule_delivery(stores, "0123456789abcdefghij")
+    job_queue = RecordingJobQueue()
+    run_job(job_id, FlakyBot(fail_on=[2]), job_queue)
+    assert not job_queue.scheduled
+    assert job_store.get_payload(job_id) is None
+    # Заявка остается активной: повторная (платная) заявка не создается.
+    assert registry.get(1)[2] == "delivering"
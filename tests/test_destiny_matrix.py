@@ -0,0 +1,71 @@
+from datetime import date, timedelta
+
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("value, expected", [
+    (1, 1), (9, 9), (10, 10), (22, 22), (23, 5), (29, 11), (31, 4), (99, 18), (199, 19), (499, 22), (599, 5), (2025, 9),
+])
+def test_reduce_arcana(value, expected):
+    assert bot.reduce_arcana(value) == expected
+
+
+@pytest.mark.parametrize("dob, expected", [
+    # Внешние точки: день и месяц сводятся к 22, год - через сумму цифр.
+    ((15, 3, 1990), {"A": 15, "B": 3, "C": 19, "D": 10, "E": 11}),
+    ((22, 12, 1993), {"A": 22, "B": 12, "C": 22, "D": 11, "E": 13}),
+    ((23, 1, 2000), {"A": 5, "B": 1, "C": 2, "D": 8, "E": 16}),
+    ((31, 12, 1999), {"A": 4, "B": 12, "C": 10, "D": 8, "E": 7}),
+    ((29, 2, 2000), {"A": 11, "B": 2, "C": 2, "D": 15, "E": 3}),
+])
+def test_outer_points(dob, expected):
+    positions = dict(zip((key for key, _ in bot.MATRIX_BASE_FIELDS), bot.compute_destiny_matrix(*dob)))
+    assert {key: positions[key] for key in expected} == expected
+
+
+def test_corners_inner_points_and_lines():
+    positions = dict(zip((key for key, _ in bot.MATRIX_BASE_FIELDS), bot.compute_destiny_matrix(15, 3, 1990)))
+    assert positions == {
+        "A": 15, "B": 3, "C": 19, "D": 10, "E": 11,
+        "F": 18, "G": 22, "H": 11, "I": 7,
+        "A1": 8, "B1": 14, "C1": 3, "D1": 21,
+        "A2": 5, "B2": 17, "C2": 22, "D2": 4,
+        "X": 6, "SKY": 13, "EARTH": 7, "PERSONAL": 20,
+        "MALE": 11, "FEMALE": 11, "SOCIAL": 22, "SPIRITUAL": 6, "PLANETARY": 10,
+    }
+
+
+def test_period_ages_step_by_one_and_a_quarter_years():
+    assert len(bot.MATRIX_PERIOD_AGES) == 64
+    assert bot.MATRIX_PERIOD_AGES[:9] == [0, 1.25, 2.5, 3.75, 5, 6.25, 7.5, 8.75, 10]
+    assert bot.MATRIX_PERIOD_AGES[-1] == 78.75
+    assert bot.MATRIX_ROW_SIZE == len(bot.MATRIX_BASE_FIELDS) + 64
+
+
+def test_period_arcana_between_anchors():
+    periods = bot.compute_destiny_matrix(15, 3, 1990)[len(bot.MATRIX_BASE_FIELDS):]
+    # 0-10 лет: от A (15) к F (18); 70-80 лет: от I (7) обратно к A (15).
+    assert periods[:8] == [15, 9, 21, 9, 6, 12, 6, 6]
+    assert periods[-8:] == [7, 18, 11, 6, 22, 5, 10, 7]
+    assert periods[8::8] == [18, 3, 22, 19, 11, 10, 7]
+
+
+def test_leap_day_and_invalid_dates():
+    leap = bot.get_destiny_matrix("29.02.2000")
+    assert leap["positions"]["A"] == 11 and leap["periods"][0] == (0, 11)
+    assert bot.get_destiny_matrix("29.02.1900") is None
+    assert bot.get_destiny_matrix("31.04.1990") is None
+
+
+def test_table_matches_direct_computation_for_every_date():
+    table = bot.destiny_matrix_table
+    day = date(bot.MATRIX_TABLE_FIRST_YEAR, 1, 1)
+    last_day = date(date.today().year + 5, 12, 31)
+    while day <= last_day:
+        row = table.lookup(day)
+        assert row == bot.compute_destiny_matrix(day.day, day.month, day.year), day
+        assert all(1 <= arcana <= 22 for arcana in row), day
+        day += timedelta(days=1)
+    assert table.lookup(date(1899, 12, 31)) == bot.compute_destiny_matrix(31, 12, 1899)
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class RecordingJobQueue:
+    def __init__(self):
+        self.scheduled = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        self.scheduled.append((callback, when, data, name))
+
+    def get_jobs_by_name(self, name):
+        return [job for job in self.scheduled if job[3] == name]
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    job_store = bot.JobStore(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(bot, "job_store", job_store)
+    return job_store
+
+
+def test_overdue_job_reports_lateness_from_stored_run_at(store):
+    run_at = time.time() - 600
+    store.add("main", 1, run_at, {"user_id": 1})
+    job_queue = RecordingJobQueue()
+    bot.rehydrate_persistent_jobs(job_queue)
+    (_, delay, data, _), = job_queue.scheduled
+    assert delay == 0
+    # Задержка из-за перезапуска должна попасть в zamira_job_lag_seconds.
+    assert data["due_at"] == run_at
+
+
+def test_job_payload_survives_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    payload = {"user_id": 1, "result": "Разбор " * 500, "service_type": "matrix"}
+    job_id = bot.JobStore(path).add("main", 1, 1000.0, payload)
+
+    restarted = bot.JobStore(path)
+    assert restarted.pending() == [(job_id, "main", 1, 1000.0)]
+    assert restarted.get_payload(job_id) == payload
+    restarted.remove(job_id)
+    assert restarted.pending() == [] and restarted.get_payload(job_id) is None
+
+
+def test_schedule_persistent_job_stores_and_schedules_once(store):
+    job_queue = RecordingJobQueue()
+
+    async def scenario():
+        first = await bot.schedule_persistent_job(job_queue, "review", 60, {"user_id": 7, "service_type": "tarot"})
+        second = await bot.schedule_persistent_job(job_queue, "review", 60, {"user_id": 7, "service_type": "tarot"})
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert second is None
+    (callback, delay, data, name), = job_queue.scheduled
+    assert (callback, delay, name) == (bot.review_request_job, 60, "review_req_job_7")
+    [(job_id, kind, user_id, run_at)] = store.pending()
+    assert (job_id, kind, user_id) == (first, "review", 7) and data == {"job_id": first, "due_at": run_at}
+
+
+def test_rehydrate_restores_future_jobs_and_spaces_overdue_ones(store, monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "JOB_CATCHUP_SPACING_SECONDS", 5)
+    now = time.time()
+    future = store.add("main", 1, now + 3600, {"user_id": 1})
+    overdue = [store.add("main", user_id, now - 60 * user_id, {"user_id": user_id}) for user_id in (2, 3)]
+    job_queue = RecordingJobQueue()
+
+    assert bot.rehydrate_persistent_jobs(job_queue) == (3, 0)
+    scheduled = {data["job_id"]: (delay, name) for _, delay, data, name in job_queue.scheduled}
+    assert 3590 < scheduled[future][0] <= 3600
+    # Просроченные выполняются сразу, по одной каждые JOB_CATCHUP_SPACING_SECONDS, начиная с самой старой.
+    assert sorted(delay for delay, _ in (scheduled[job_id] for job_id in overdue)) == [0, 5]
+    assert scheduled[overdue[1]] == (0, "main_job_3")
+
+
+def test_rehydrate_drops_stale_reviews_and_unknown_kinds(store, monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "REVIEW_REQUEST_MAX_LATENESS", 3600)
+    now = time.time()
+    recent_review = store.add("review", 1, now - 60, {"user_id": 1})
+    store.add("review", 2, now - 7200, {"user_id": 2})
+    store.add("unknown", 3, now, {"user_id": 3})
+    job_queue = RecordingJobQueue()
+
+    assert bot.rehydrate_persistent_jobs(job_queue) == (1, 2)
+    assert [data["job_id"] for _, _, data, _ in job_queue.scheduled] == [recent_review]
+    assert [row[0] for row in store.pending()] == [recent_review]
+
+
+def test_overdue_job_runs_on_catch_up(store, monkeypatch):
+    sent = []
+
+    class RecordingBot:
+        async def send_message(self, chat_id, text, reply_markup=None):
+            sent.append((chat_id, text))
+
+    monkeypatch.setitem(bot.CONFIG, "ADMIN_IDS", [])
+    job_id = store.add("review", 5, time.time() - 60, {"user_id": 5, "service_type": "tarot"})
+    job_queue = RecordingJobQueue()
+    bot.rehydrate_persistent_jobs(job_queue)
+    (callback, delay, data, _), = job_queue.scheduled
+    assert delay == 0
+
+    context = SimpleNamespace(job=SimpleNamespace(data=data), bot=RecordingBot(), job_queue=job_queue)
+    asyncio.run(callback(context))
+    assert [chat_id for chat_id, _ in sent] == [5]
+    assert store.get_payload(job_id) is None
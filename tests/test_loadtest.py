@@ -0,0 +1,50 @@
+import json
+import math
+import os
+
+import pytest
+
+import bot
+import loadtest
+
+
+@pytest.mark.parametrize("cumulative, q, expected", [
+    ([(1.0, 0), (2.0, 0), (math.inf, 0)], 0.5, None),
+    ([(1.0, 10), (2.0, 20), (math.inf, 20)], 0.5, 1.0),
+    ([(1.0, 10), (2.0, 20), (math.inf, 20)], 0.75, 1.5),
+    ([(1.0, 0), (2.0, 4), (math.inf, 4)], 0.5, 1.5),
+    ([(1.0, 5), (2.0, 5), (math.inf, 10)], 0.99, 2.0),
+])
+def test_histogram_quantile(cumulative, q, expected):
+    assert loadtest.histogram_quantile(cumulative, q) == expected
+
+
+def test_summarize():
+    assert loadtest.summarize([]) == {"count": 0}
+    assert loadtest.summarize([3.0, 1.0, 2.0, 4.0]) == {"count": 4, "mean": 2.5, "p50": 2.0, "p95": 4.0, "p99": 4.0, "max": 4.0}
+    summary = loadtest.summarize([float(value) for value in range(1, 101)])
+    assert (summary["p50"], summary["p95"], summary["p99"], summary["max"]) == (50.0, 95.0, 99.0, 100.0)
+
+
+def test_config_overrides_reject_unknown_keys_and_merge_nested():
+    config = {"LIMIT": 1, "ROUTES": {"tarot": {"models": ["a"], "hedge_after": 60}, "matrix": {"models": ["a"]}}}
+    bot.apply_config_overrides(config, {"LIMIT": 2, "ROUTES": {"tarot": {"models": ["b"]}}})
+    assert config == {"LIMIT": 2, "ROUTES": {"tarot": {"models": ["b"], "hedge_after": 60}, "matrix": {"models": ["a"]}}}
+    with pytest.raises(ValueError):
+        bot.apply_config_overrides(config, {"LIMT": 3})
+
+    args = loadtest.parse_args(["--set", "OPENAI_STREAMNG=false"])
+    with pytest.raises(ValueError):
+        loadtest.build_config_overrides(loadtest.read_bot_config(args.bot), args, 0)
+
+
+def test_small_load_test_completes_every_flow(tmp_path):
+    # Дымовой прогон настоящего bot.py против заглушек: несколько пользователей, сжатое время.
+    output = tmp_path / "report.json"
+    exit_code = loadtest.main(["--users", "3", "--ramp-up", "0.5", "--think-time", "0.05", "--openai-latency", "0.1",
+                               "--time-scale", "0.0001", "--seed", "1", "--workdir", str(tmp_path / "bot"), "--output", str(output)])
+    report = json.loads(output.read_text(encoding="utf-8"))
+    assert exit_code == 0 and report["bot"]["exit_code"] == 0
+    assert report["failed"] == 0 and report["completed"] == 3
+    assert report["openai"]["requests"] >= 3
+    assert os.path.exists(tmp_path / "bot" / "bot.log")
@@ -0,0 +1,55 @@
+import gzip
+import logging
+
+import bot
+
+
+def open_handler(tmp_path):
+    log_index = bot.LogIndex(str(tmp_path / "state.db"), 256)
+    handler = bot.IndexedRotatingFileHandler(str(tmp_path / "bot.log"), log_index, maxBytes=64 * 1024, backupCount=3, encoding="utf-8")
+    handler.setFormatter(bot.JSON_LOG_FORMATTER)
+    return log_index, handler
+
+
+def log(handler, user_id, text):
+    handler.emit(logging.makeLogRecord({"msg": text, "levelname": "INFO", "levelno": logging.INFO, "name": "bot",
+                                        "context_fields": {"user_id": user_id, "service": "tarot"}}))
+
+
+def export_user_lines(monkeypatch, tmp_path, log_index, user_id):
+    monkeypatch.setattr(bot, "log_index", log_index)
+    monkeypatch.setitem(bot.CONFIG, "LOG_FILE", str(tmp_path / "bot.log"))
+    monkeypatch.setitem(bot.CONFIG, "LOG_FILE_BACKUP_COUNT", 3)
+    output, matched = bot.export_logs_gzip(bot.parse_log_query([f"user={user_id}"]))
+    lines = gzip.decompress(output.read()).decode("utf-8").splitlines()
+    assert matched == len(lines)
+    return [line for line in lines if "сообщение" in line]
+
+
+def test_rotation_then_restart_keeps_segments(tmp_path, monkeypatch):
+    log_index, handler = open_handler(tmp_path)
+    for index in range(3):
+        log(handler, 1, f"сообщение {index} до ротации")
+    handler.doRollover()
+    handler.close()
+
+    # Перезапуск сразу после ротации: в новом bot.log еще нет ни одного закрытого блока.
+    log_index, handler = open_handler(tmp_path)
+    assert log_index.segment == 1
+    for index in range(3):
+        log(handler, 2, f"сообщение {index} после перезапуска")
+
+    assert len(export_user_lines(monkeypatch, tmp_path, log_index, 1)) == 3
+    assert len(export_user_lines(monkeypatch, tmp_path, log_index, 2)) == 3
+    handler.close()
+
+
+def test_open_block_is_indexed_on_close(tmp_path, monkeypatch):
+    log_index, handler = open_handler(tmp_path)
+    log(handler, 5, "сообщение перед остановкой")
+    handler.close()
+
+    log_index, handler = open_handler(tmp_path)
+    assert [block[0] for block in log_index.candidate_blocks(5, None, None, 0, None)] == [0]
+    assert len(export_user_lines(monkeypatch, tmp_path, log_index, 5)) == 1
+    handler.close()
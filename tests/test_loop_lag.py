@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import time
+
+import bot
+
+
+def blocking_call(seconds):
+    time.sleep(seconds)
+
+
+def test_watchdog_logs_loop_stack_during_stall(caplog):
+    monitor = bot.LoopLagMonitor(interval=0.02, stall_threshold=0.1)
+
+    async def scenario():
+        monitor.start()
+        await asyncio.sleep(0.1)
+        blocking_call(0.4)
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+
+    with caplog.at_level("WARNING"):
+        asyncio.run(scenario())
+    assert monitor.stalls == 1
+    assert monitor.max_lag >= 0.3
+    # Стек снят во время зависания: в нем виден блокирующий вызов.
+    assert "Event loop заблокирован" in caplog.text and "blocking_call" in caplog.text
+
+
+def test_sample_stacks_collapses_stacks_per_thread():
+    stop = threading.Event()
+    running = threading.Event()
+
+    def spin_here():
+        running.set()
+        while not stop.is_set():
+            sum(range(1000))
+
+    worker = threading.Thread(target=spin_here, name="busy worker")
+    worker.start()
+    running.wait()
+    try:
+        counts, samples = bot.sample_stacks(0.2, 0.005)
+    finally:
+        stop.set()
+        worker.join()
+    assert samples > 10
+    busy = {stack: count for stack, count in counts.items() if stack.startswith("busy_worker;")}
+    assert busy and all("test_loop_lag.py:spin_here" in stack for stack in busy)
+    assert sum(busy.values()) == samples
+    # Собственный поток профилировщика в выборку не попадает.
+    assert not any("sample_stacks" in stack for stack in counts)
@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def make_context():
+    async def send_chat_action(**kwargs):
+        pass
+
+    return SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))
+
+
+@pytest.mark.parametrize("error, outcome", [(RuntimeError("boom"), "error"), (bot.CircuitOpenError(0), "circuit_open")])
+def test_ask_gpt_latency_is_recorded_for_failures(monkeypatch, error, outcome):
+    async def failing_completion(*args, **kwargs):
+        raise error
+
+    async def no_notification(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(bot, "generate_completion", failing_completion)
+    monkeypatch.setattr(bot, "send_admin_notification", no_notification)
+    monkeypatch.setattr(bot.METRIC_ASK_GPT_SECONDS, "series", {})
+    try:
+        asyncio.run(bot.ask_gpt(bot.PROMPT_TAROT_SYSTEM, "вопрос", 100, make_context(), 1, "matrix", attempt=2))
+    except bot.CircuitOpenError:
+        pass
+    assert list(bot.METRIC_ASK_GPT_SECONDS.series) == [("matrix", "2", outcome)]
@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+import bot
+
+
+def test_fallback_model_is_used_when_primary_is_not_found(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "OPENAI_STREAMING", False)
+    monkeypatch.setattr(bot, "model_router", bot.ModelRouter({"tarot": {"models": ["retired-model", "fallback-model"]}}))
+    requested = []
+
+    async def create(model, **kwargs):
+        requested.append(model)
+        if model == "retired-model":
+            response = httpx.Response(404, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+            raise openai.NotFoundError("The model `retired-model` does not exist", response=response, body={"code": "model_not_found"})
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" ответ "))], usage=usage)
+
+    monkeypatch.setattr(bot.openai_client.chat.completions, "create", create)
+    result = asyncio.run(bot.generate_completion(bot.PROMPT_TAROT_SYSTEM, "вопрос", 100, 1))
+    assert result == "ответ"
+    assert requested == ["retired-model", "fallback-model"]
+    assert bot.model_router.fallbacks == {"tarot": 1}
+
+
+def test_hedge_loser_is_charged_for_streamed_tokens(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "TOKEN_ESTIMATE_CHARS_PER_TOKEN", 4)
+    router = bot.ModelRouter({"tarot": {"hedge_after": 0.01}})
+
+    async def call_model(model, purpose, progress):
+        progress.update(prompt_tokens=100, chars=400)
+        if purpose == "hedge":
+            return "ответ", 300
+        await asyncio.sleep(10)
+
+    assert asyncio.run(router.hedged_call("tarot", "model", call_model, "main")) == ("ответ", 300)
+    assert router.hedges_won == {"tarot": 1}
+    assert router.hedge_tokens == {"tarot": 100 + 101}
@@ -0,0 +1,16 @@
+from datetime import datetime
+
+import bot
+
+
+def test_matrix_prompt_keeps_year_range_in_date_block_only():
+    prompt = bot.render_system_prompt(bot.PROMPT_MATRIX_SYSTEM, datetime(2026, 10, 16))
+    static_part, date_block = prompt.split("ВРЕМЕННЫЕ РАМКИ:\n")
+    assert "В. **Заключение по периодам:**" in static_part
+    assert " гг." not in static_part
+    assert "Прогнозный период:" in date_block and date_block.count(" гг.") == 1
+
+
+def test_final_section_markers_match_prompt_headers():
+    for service_type, template in (("tarot", bot.PROMPT_TAROT_SYSTEM), ("matrix", bot.PROMPT_MATRIX_SYSTEM)):
+        assert bot.CONFIG["STREAM_LENGTH_LIMITS"][service_type]["final_section"] in template
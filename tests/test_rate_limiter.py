@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import bot
+
+
+def run_request(error, endpoint):
+    limiter = bot.OutboundRateLimiter(1000, 0, 3)
+    calls = []
+
+    async def callback():
+        calls.append(endpoint)
+        if len(calls) == 1:
+            raise error
+        return True
+
+    async def scenario():
+        return await limiter.process_request(callback, (), {}, endpoint, {"chat_id": 1}, None)
+
+    return asyncio.run(scenario()), calls
+
+
+@pytest.mark.parametrize("error", [BadRequest("Message is too long"), Forbidden("bot was blocked by the user")])
+def test_client_errors_are_not_retried(error):
+    with pytest.raises(type(error)):
+        run_request(error, "sendMessage")
+
+
+def test_timed_out_send_is_not_retried():
+    with pytest.raises(TimedOut):
+        run_request(TimedOut(), "sendMessage")
+
+
+def test_connection_errors_are_retried(monkeypatch):
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(bot.asyncio, "sleep", no_sleep)
+    assert run_request(NetworkError("connection reset"), "sendMessage") == (True, ["sendMessage", "sendMessage"])
+    assert run_request(TimedOut(), "editMessageText") == (True, ["editMessageText", "editMessageText"])
+
+
+def test_token_bucket_allows_burst_then_paces_at_rate():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=20, capacity=2)
+        started = time.monotonic()
+        for _ in range(2):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(2):
+            await bucket.acquire()
+        paced = time.monotonic() - started
+        return burst, paced
+
+    burst, paced = asyncio.run(scenario())
+    assert burst < 0.02
+    # Два токена сверх емкости при 20 токенах/с - около 0.1 с.
+    assert 0.09 <= paced < 0.5
+
+
+def test_token_bucket_refill_is_capped_by_capacity():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=20, capacity=2)
+        await bucket.acquire()
+        await bucket.acquire()
+        await asyncio.sleep(0.3)
+        started = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        refilled = time.monotonic() - started
+        await bucket.acquire()
+        return refilled, time.monotonic() - started
+
+    refilled, third = asyncio.run(scenario())
+    # За 0.3 с накопилось бы 6 токенов, но емкость 2: третий ждет пополнения.
+    assert refilled < 0.02 and third >= 0.04
+
+
+def test_retry_after_pauses_all_sends_and_retries(monkeypatch):
+    limiter = bot.OutboundRateLimiter(1000, 0, 3)
+    sleeps = []
+    calls = []
+    real_sleep = asyncio.sleep
+
+    async def recording_sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(bot.asyncio, "sleep", recording_sleep)
+
+    async def flood_limited():
+        calls.append("first")
+        if len(calls) == 1:
+            raise RetryAfter(3)
+        return "sent"
+
+    async def other_chat():
+        calls.append("other")
+        return "sent"
+
+    async def scenario():
+        first = await limiter.process_request(flood_limited, (), {}, "sendMessage", {"chat_id": 1}, None)
+        other = await limiter.process_request(other_chat, (), {}, "sendMessage", {"chat_id": 2}, None)
+        return first, other
+
+    assert asyncio.run(scenario()) == ("sent", "sent")
+    assert calls == ["first", "first", "other"]
+    # Пауза RetryAfter действует и на повтор, и на отправку в другой чат.
+    assert len([delay for delay in sleeps if 2.9 < delay <= 3.1]) == 2
+
+
+def run_request_always_failing(error, max_retries):
+    limiter = bot.OutboundRateLimiter(1000, 0, max_retries)
+
+    async def callback():
+        raise error
+
+    return asyncio.run(limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 1}, None))
+
+
+def test_retry_after_is_raised_after_max_retries(monkeypatch):
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(bot.asyncio, "sleep", no_sleep)
+    with pytest.raises(RetryAfter):
+        run_request_always_failing(RetryAfter(1), max_retries=2)
+
+
+def test_per_chat_interval_does_not_delay_other_chats():
+    limiter = bot.OutboundRateLimiter(1000, 0.2, 0)
+    sent_at = {}
+
+    def make_callback(key):
+        async def callback():
+            sent_at[key] = time.monotonic()
+            return key
+        return callback
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(
+            limiter.process_request(make_callback("chat1_a"), (), {}, "sendMessage", {"chat_id": 1}, None),
+            limiter.process_request(make_callback("chat1_b"), (), {}, "sendMessage", {"chat_id": 1}, None),
+            limiter.process_request(make_callback("chat2"), (), {}, "sendMessage", {"chat_id": 2}, None),
+        )
+        return started
+
+    started = asyncio.run(scenario())
+    assert sent_at["chat1_b"] - sent_at["chat1_a"] >= 0.19
+    assert sent_at["chat2"] - started < 0.1
+    assert limiter.queue_depth == 0 and not limiter._chat_locks
+
+
+def test_global_rate_applies_across_chats():
+    limiter = bot.OutboundRateLimiter(10, 0, 0)
+
+    async def callback():
+        return True
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, None) for chat_id in range(12)))
+        return time.monotonic() - started
+
+    # Емкость 10 токенов, еще два - по 0.1 с при 10 токенах/с.
+    assert 0.18 <= asyncio.run(scenario()) < 0.6
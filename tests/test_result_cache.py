@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    path = str(tmp_path / "state.db")
+    result_cache = bot.ResultCache(path, 1024 * 1024)
+    monkeypatch.setattr(bot, "result_cache", result_cache)
+    monkeypatch.setattr(bot, "generation_queue", bot.GenerationQueue(path))
+    # Заявка уже снята: hand_off_generated_result только кладет результат в кэш и выходит.
+    monkeypatch.setattr(bot, "submission_registry", bot.SubmissionRegistry(path))
+    monkeypatch.setitem(bot.CONFIG, "RESULT_CACHE_ENABLED", True)
+    return result_cache
+
+
+def matrix_item(request_id):
+    return {"request_id": request_id, "user_id": 1, "service_type": "matrix", "user_name_for_log": "user1",
+            "deliver_at": time.time(), "cache_inputs": ["анна", "01.02.1990"]}
+
+
+def test_fallback_model_result_is_not_served_from_cache(cache):
+    primary, fallback = bot.model_router.models("matrix")[:2]
+
+    async def scenario():
+        await bot.hand_off_generated_result(None, matrix_item("r1"), "ответ запасной модели", fallback)
+        assert await bot.lookup_cached_result(matrix_item("r2")) is None
+        await bot.hand_off_generated_result(None, matrix_item("r3"), "ответ основной модели", primary)
+        return await bot.lookup_cached_result(matrix_item("r4"))
+
+    assert asyncio.run(scenario()) == "ответ основной модели"
+
+
+def test_cache_key_depends_on_model():
+    item = matrix_item("r1")
+    assert bot.result_cache_key(item, "gpt-4o")[0] != bot.result_cache_key(item, "gpt-4o-mini")[0]
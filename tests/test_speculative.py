@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def generator(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "SPECULATIVE_GENERATION", True)
+    monkeypatch.setitem(bot.CONFIG, "TOKEN_ESTIMATE_CHARS_PER_TOKEN", 4)
+    monkeypatch.setattr(bot.openai_scheduler, "utilization", lambda: 0.0)
+    monkeypatch.setattr(bot, "daily_budget_exceeded", lambda service_type: False)
+    return bot.SpeculativeGenerator()
+
+
+def fake_completion(streamed_chars, finish):
+    async def generate_completion(system_prompt_template, user_prompt, max_tokens, user_id, service_type, usage_sink=None, purpose="main"):
+        usage_sink.setdefault("progress", {}).update(prompt_tokens=100, chars=streamed_chars)
+        await finish.wait()
+        usage_sink["total_tokens"] = 500
+        return "расклад"
+    return generate_completion
+
+
+def test_cancelled_generation_counts_estimated_tokens(generator, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(bot, "generate_completion", fake_completion(400, asyncio.Event()))
+        await generator.start(1, "prompt", 1000, "tarot")
+        await asyncio.sleep(0)
+        generator.invalidate(1)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert generator.wasted == 1 and generator.wasted_tokens == 100 + 101
+
+
+def test_unclaimed_result_expires(generator, monkeypatch):
+    async def scenario():
+        finish = asyncio.Event()
+        finish.set()
+        monkeypatch.setattr(bot, "generate_completion", fake_completion(0, finish))
+        await generator.start(1, "prompt", 1000, "tarot")
+        await generator.start(2, "prompt", 1000, "tarot")
+        await asyncio.sleep(0.01)
+        generator.evict_expired()
+        assert generator.wasted == 0
+        assert await generator.take(2, bot.SpeculativeGenerator.prompt_key("prompt")) == "расклад"
+        monkeypatch.setitem(bot.CONFIG, "SPECULATIVE_RESULT_TTL", -1)
+        generator.evict_expired()
+        assert await generator.take(1, bot.SpeculativeGenerator.prompt_key("prompt")) is None
+
+    asyncio.run(scenario())
+    assert (generator.used, generator.wasted, generator.wasted_tokens) == (1, 1, 500)
+    assert not generator._tasks and not generator._finished_at
+
+
+def test_failed_generation_is_logged(generator, monkeypatch, caplog):
+    async def failing_completion(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    async def scenario():
+        monkeypatch.setattr(bot, "generate_completion", failing_completion)
+        await generator.start(1, "prompt", 1000, "tarot")
+        await asyncio.sleep(0.01)
+
+    with caplog.at_level("WARNING"):
+        asyncio.run(scenario())
+    assert "boom" in caplog.text
+
+
+def test_confirmed_result_survives_eviction_until_taken(generator, monkeypatch):
+    async def scenario():
+        finish = asyncio.Event()
+        finish.set()
+        monkeypatch.setattr(bot, "generate_completion", fake_completion(0, finish))
+        key = bot.SpeculativeGenerator.prompt_key("prompt")
+        await generator.start(1, "prompt", 1000, "tarot")
+        await asyncio.sleep(0.01)
+        generator.record_confirm(1, key)
+        # Воркер отложен DeadlinePacer: заготовка уже старше SPECULATIVE_RESULT_TTL, но подтверждена.
+        monkeypatch.setitem(bot.CONFIG, "SPECULATIVE_RESULT_TTL", -1)
+        generator.evict_expired()
+        assert await generator.take(1, key) == "расклад"
+
+    asyncio.run(scenario())
+    assert (generator.used, generator.wasted) == (1, 0)
+    assert not generator._tasks and not generator._confirmed_at
+
+
+def test_confirmed_result_is_dropped_after_delivery_deadline(generator, monkeypatch):
+    async def scenario():
+        finish = asyncio.Event()
+        finish.set()
+        monkeypatch.setattr(bot, "generate_completion", fake_completion(0, finish))
+        await generator.start(1, "prompt", 1000, "tarot")
+        await asyncio.sleep(0.01)
+        generator.record_confirm(1, bot.SpeculativeGenerator.prompt_key("prompt"))
+        monkeypatch.setitem(bot.CONFIG, "DELAY_SECONDS_MAIN_SERVICE", 0)
+        monkeypatch.setitem(bot.CONFIG, "SPECULATIVE_RESULT_TTL", -1)
+        generator.evict_expired()
+
+    asyncio.run(scenario())
+    assert generator.wasted == 1
+    assert not generator._tasks and not generator._confirmed_at
@@ -0,0 +1,87 @@
+import asyncio
+
+from openai.types.chat import ChatCompletionChunk
+
+import bot
+
+LIMITS = {"final_section": "Итог расклада", "final_section_max_chars": 60, "hard_cap_chars": 200}
+
+
+def feed_all(guard, pieces):
+    for piece in pieces:
+        if guard.feed(piece):
+            break
+    return guard
+
+
+def test_text_is_returned_whole_without_stop():
+    guard = feed_all(bot.StreamLengthGuard(LIMITS), ["Карта дня. ", "Шут\n\n", "Итог расклада: все хорошо. "])
+    assert guard.stop_reason is None
+    assert guard.text() == "Карта дня. Шут\n\nИтог расклада: все хорошо."
+
+
+def test_final_section_keeps_finished_sentences_of_closing_paragraph():
+    pieces = ["Разбор карт.\n\n", "Итог ", "расклада:\n\n", "Вас ждет перемена.\n\n", "Доверьтесь себе. ", "И действуйте смело, ", "не оглядываясь на"]
+    guard = feed_all(bot.StreamLengthGuard(LIMITS), pieces)
+    assert guard.stop_reason == "final_section"
+    assert guard.text() == "Разбор карт.\n\nИтог расклада:\n\nВас ждет перемена.\n\nДоверьтесь себе."
+
+
+def test_hard_cap_cuts_at_sentence_boundary():
+    guard = feed_all(bot.StreamLengthGuard(LIMITS), ["Первое предложение. " * 9, "Оборванное предложение без конца"])
+    assert guard.stop_reason == "hard_cap"
+    assert guard.text().endswith("Первое предложение.")
+
+
+def test_no_boundary_after_final_marker_keeps_text():
+    guard = feed_all(bot.StreamLengthGuard(LIMITS), ["Вступление. Итог расклада: ", "x" * 80])
+    assert guard.stop_reason == "final_section"
+    assert guard.text() == "Вступление. Итог расклада: " + "x" * 80
+
+
+def make_chunk(content=None, usage=None):
+    choices = [] if content is None else [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    data = {"id": "c", "object": "chat.completion.chunk", "created": 0, "model": "m", "choices": choices}
+    if usage:
+        data["usage"] = usage
+    return ChatCompletionChunk.model_validate(data)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def run_stream(monkeypatch, chunks):
+    stream = FakeStream(chunks)
+    requests = []
+
+    async def create(**kwargs):
+        requests.append(kwargs)
+        return stream
+
+    monkeypatch.setitem(bot.CONFIG["STREAM_LENGTH_LIMITS"], "tarot", LIMITS)
+    monkeypatch.setattr(bot.openai_client.chat.completions, "create", create)
+    result = asyncio.run(bot.stream_completion("m", [{"role": "user", "content": "вопрос"}], 100, "tarot"))
+    assert stream.closed and requests[0]["extra_body"] == {"stream_options": {"include_usage": True}}
+    return result
+
+
+def test_stream_usage_is_read_from_final_chunk(monkeypatch):
+    chunks = [make_chunk("Ответ."), make_chunk(usage={"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15})]
+    assert run_stream(monkeypatch, chunks) == ("Ответ.", (12, 3))
+
+
+def test_stopped_stream_usage_is_estimated(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, "TOKEN_ESTIMATE_CHARS_PER_TOKEN", 4)
+    text, usage = run_stream(monkeypatch, [make_chunk("Фраза. " * 40)])
+    assert text.endswith("Фраза.")
+    assert usage == (bot.estimate_tokens("вопрос"), 280 // 4 + 1)
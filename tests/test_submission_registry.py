@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import bot
+
+
+def test_nocache_flag_survives_restart_and_is_consumed_once(tmp_path):
+    path = str(tmp_path / "state.db")
+    registry = bot.SubmissionRegistry(path)
+    is_new, request_id, status, bypass_cache = registry.try_register(1, "matrix")
+    assert (is_new, status, bypass_cache) == (True, "queued", False)
+    registry.transition(request_id, "delivered", ("queued",))
+    registry.clear_user(1, bypass_cache=True)
+
+    registry = bot.SubmissionRegistry(path)
+    assert registry.try_register(1, "matrix")[0::3] == (True, True)
+    registry.clear_user(1)
+    assert registry.try_register(1, "matrix")[0::3] == (True, False)
+
+
+def test_active_submission_is_not_replaced(tmp_path):
+    registry = bot.SubmissionRegistry(str(tmp_path / "state.db"))
+    _, request_id, _, _ = registry.try_register(1, "tarot")
+    assert registry.try_register(1, "tarot") == (False, request_id, "queued", False)
+
+
+def test_concurrent_confirmations_create_one_submission(tmp_path):
+    registry = bot.SubmissionRegistry(str(tmp_path / "state.db"))
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: registry.try_register(1, "tarot"), range(16)))
+    assert sum(is_new for is_new, _, _, _ in results) == 1
+    assert len({request_id for _, request_id, _, _ in results}) == 1
+
+
+def test_trace_id_is_kept_with_submission_after_delivery(tmp_path):
+    path = str(tmp_path / "state.db")
+    conn = bot.open_sqlite(path)
+    # Схема до появления bypass_cache и trace_id.
+    conn.execute("CREATE TABLE submissions (user_id INTEGER PRIMARY KEY, request_id TEXT NOT NULL UNIQUE, "
+                 "service_type TEXT NOT NULL, status TEXT NOT NULL, updated_at REAL NOT NULL)")
+    conn.close()
+    registry = bot.SubmissionRegistry(path)
+    _, request_id, _, _ = registry.try_register(1, "tarot", "trace-1")
+    registry.transition(request_id, "delivered", ("queued",))
+    assert bot.SubmissionRegistry(path).trace_id(1) == "trace-1"
+    assert registry.trace_id(2) is None
@@ -0,0 +1,42 @@
+import bot
+
+
+def make_tracer(tmp_path, max_buffered_spans=100):
+    return bot.Tracer(str(tmp_path / "traces.jsonl"), 10 * 1024 * 1024, 2, max_buffered_spans)
+
+
+def test_buffer_drops_oldest_spans(tmp_path):
+    tracer = make_tracer(tmp_path, max_buffered_spans=3)
+    for index in range(5):
+        with tracer.span(f"span{index}", trace_id="t", user_id=1):
+            pass
+    assert [span["name"] for span in tracer.take_buffer()] == ["span2", "span3", "span4"]
+    assert tracer.dropped_spans == 2 and tracer.take_buffer() == []
+
+
+def test_latest_trace_spans_rotated_files(tmp_path):
+    tracer = make_tracer(tmp_path)
+
+    def flush_to(path_suffix, spans):
+        tracer.write(spans)
+        tracer._handler.close()
+        (tmp_path / "traces.jsonl").rename(tmp_path / f"traces.jsonl{path_suffix}")
+
+    with tracer.span("old", trace_id="old-trace", user_id=1):
+        pass
+    with tracer.span("start", trace_id="new-trace", user_id=1):
+        pass
+    flush_to(".2", tracer.take_buffer())
+    with tracer.span("generation", trace_id="new-trace", user_id=1):
+        with tracer.span("openai.request"):
+            pass
+    with tracer.span("other", trace_id="other-trace", user_id=2):
+        pass
+    flush_to(".1", tracer.take_buffer())
+    with tracer.span("delivery", trace_id="new-trace", user_id=1):
+        pass
+    tracer.write(tracer.take_buffer())
+
+    assert [span["name"] for span in tracer.find_latest_trace(1)] == ["start", "generation", "openai.request", "delivery"]
+    assert [span["name"] for span in tracer.find_latest_trace(2)] == ["other"]
+    assert tracer.find_latest_trace(3) == []
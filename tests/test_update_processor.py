@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import ExtBot
+
+import bot
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, "Test", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, "private"), from_user=user, text="hi")
+    return Update(update_id, message=message)
+
+
+def test_queued_updates_of_one_user_do_not_hold_global_slots():
+    async def scenario():
+        processor = bot.PerUserUpdateProcessor(2)
+        release_busy_user = asyncio.Event()
+        finished = []
+
+        async def busy_user_update(index):
+            await release_busy_user.wait()
+            finished.append(("busy", index))
+
+        async def other_user_update():
+            finished.append(("other", 0))
+
+        busy = [asyncio.create_task(processor.process_update(make_update(i, 1), busy_user_update(i))) for i in range(5)]
+        await asyncio.sleep(0)
+        # Пять обновлений одного пользователя при двух слотах: второму пользователю слот все равно достается сразу.
+        await asyncio.wait_for(processor.process_update(make_update(10, 2), other_user_update()), timeout=1)
+        assert finished == [("other", 0)]
+        release_busy_user.set()
+        await asyncio.gather(*busy)
+        assert finished[1:] == [("busy", i) for i in range(5)]
+        assert not processor._user_locks and not processor._user_waiters
+
+    asyncio.run(scenario())
+
+
+def test_log_context_set_by_handlers_is_reset_after_update():
+    async def scenario():
+        processor = bot.PerUserUpdateProcessor(2)
+
+        async def handler():
+            bot.log_context.set({"user_id": 1, "state": "ASK_TAROT_QUESTIONS"})
+
+        await processor.process_update(make_update(1, 1), handler())
+        return bot.log_context.get()
+
+    assert asyncio.run(scenario()) == {}
+
+
+def test_free_text_outside_conversation_reaches_fallback_and_timing(monkeypatch, tmp_path):
+    calls = []
+
+    async def fake_fallback(update, context):
+        calls.append("fallback")
+
+    async def fake_observe(update, context):
+        calls.append("timing")
+
+    async def offline_bot_initialize(self):
+        pass
+
+    monkeypatch.setattr(bot, "post_fallback_message", fake_fallback)
+    monkeypatch.setattr(bot, "observe_handler_time", fake_observe)
+    monkeypatch.setattr(bot.conversation_sweeper, "conv_handler", None)
+    # Application.initialize вызывает getMe; сети в тестах нет.
+    monkeypatch.setattr(ExtBot, "initialize", offline_bot_initialize)
+
+    async def scenario():
+        application = bot.ApplicationBuilder().token("123456:TEST").persistence(
+            bot.SQLitePersistence(str(tmp_path / "state.db"), 60)
+        ).build()
+        bot.add_bot_handlers(application)
+        await application.initialize()
+        update = make_update(1, 42)
+        update.message.set_bot(application.bot)
+        await application.process_update(update)
+        await application.shutdown()
+
+    asyncio.run(scenario())
+    # TypeHandler(Update) замера времени не должен занимать группу post_fallback_message.
+    assert calls == ["fallback", "timing"]
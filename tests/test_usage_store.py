@@ -0,0 +1,69 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Местное время: day_of и почасовые корзины считаются от time.time().
+    now = [bot.datetime(2026, 3, 10, 23, 30).timestamp()]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    return now
+
+
+def test_calls_in_one_hour_share_a_bucket(tmp_path, clock):
+    store = bot.UsageStore(str(tmp_path / "state.db"), 50)
+    store.record("tarot", "gpt-4o", "main", 1000, 300)
+    clock[0] += 20 * 60
+    store.record("tarot", "gpt-4o", "main", 800, 200)
+    store.record("tarot", "gpt-4o", "hedge", 800, 120)
+    store.record("matrix", "gpt-4o-mini", "main", 500, 900)
+
+    totals = store.summary("2026-03-10")["totals"]
+    assert totals == [
+        ("matrix", "gpt-4o-mini", "main", 1, 500, 900),
+        ("tarot", "gpt-4o", "hedge", 1, 800, 120),
+        ("tarot", "gpt-4o", "main", 2, 1800, 500),
+    ]
+    assert store.tokens_today("tarot") == 1300 + 1000 + 920
+    assert store.tokens_today() == 1300 + 1000 + 920 + 1400
+
+
+def test_bucket_and_day_boundaries(tmp_path, clock):
+    path = str(tmp_path / "state.db")
+    store = bot.UsageStore(path, 50)
+    store.record("tarot", "gpt-4o", "main", 100, 100)
+    clock[0] += 29 * 60 + 59  # 23:59:59 - та же корзина
+    store.record("tarot", "gpt-4o", "main", 100, 100)
+    clock[0] += 1  # 00:00:00 следующего дня - новая корзина и новый день
+    store.record("tarot", "gpt-4o", "main", 100, 100)
+
+    rows = store._conn.execute("SELECT bucket_start, day, calls FROM openai_usage ORDER BY bucket_start").fetchall()
+    assert [(day, calls) for _, day, calls in rows] == [("2026-03-10", 2), ("2026-03-11", 1)]
+    assert rows[1][0] - rows[0][0] == 3600
+    # Дневной счетчик бюджета сбрасывается при смене дня и переживает перезапуск.
+    assert store.tokens_today("tarot") == 200
+    assert bot.UsageStore(path, 50).tokens_today("tarot") == 200
+    assert store.summary("2026-03-11")["totals"] == [("tarot", "gpt-4o", "main", 1, 100, 100)]
+
+
+def test_completion_histogram_percentiles(tmp_path, clock):
+    store = bot.UsageStore(str(tmp_path / "state.db"), 50)
+    for completion_tokens in [10] * 10 + [120] * 8 + [49, 50, 990]:
+        store.record("matrix", "gpt-4o", "main", 100, completion_tokens)
+    store.record("tarot", "gpt-4o", "main", 100, 0)
+
+    percentiles = store.summary("2026-03-10")["percentiles"]
+    # Корзины по 50 токенов, перцентиль - верхняя граница корзины: 11 из 21 вызова в [0, 50).
+    assert percentiles["matrix"] == {50: 50, 95: 150}
+    assert percentiles["tarot"] == {50: 50, 95: 50}
+
+
+def test_prune_drops_old_days(tmp_path, clock):
+    store = bot.UsageStore(str(tmp_path / "state.db"), 50)
+    store.record("tarot", "gpt-4o", "main", 100, 100)
+    clock[0] += 3 * 86400
+    store.record("tarot", "gpt-4o", "main", 100, 100)
+    store.prune(2)
+    assert store.summary("0000-00-00")["totals"] == [("tarot", "gpt-4o", "main", 1, 100, 100)]
+    assert store.summary("0000-00-00")["percentiles"] == {"tarot": {50: 150, 95: 150}}